@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+#
+# benchmark.py
+#
+# Messaging benchmarks
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Repeatable benchmarks for the messaging framework.
+
+    The topology is built from a configuration file, see config/framework_bench.cfg.
+    The first LOCAL process runs here and its first task is the driver gen-server which
+    sends the benchmark messages. The second LOCAL process, if there is one, is started
+    as a child process. If the first REMOTE process is on localhost a stand-in for it is
+    started as a separate topology using a mirror of the configuration. All other tasks
+    are sinks which record the one-way latency of each message they receive.
+
+    Scenarios are:
+        gs-gs           - driver to a gen-server in the same process
+        parent-child    - driver to a gen-server in the child process
+        imc             - driver to a gen-server in the remote process over localhost IMC
+        pubsub          - driver publishes to 1..n subscribing gen-servers in this process
+
+    Each scenario is run for each payload size in two modes. The latency mode sends at a
+    fixed interval so the figures are not dominated by queueing. The throughput mode sends
+    as fast as possible and measures the sustained delivery rate. Messages not delivered
+    within the timeout, or once the count has stopped changing, are counted as lost.
+
+    Each message carries the tag of its case and the sinks keep their counts by tag so a
+    message which arrives late is never counted in the next case. The counts are collected
+    over the results queue, not the path being measured, from the sinks in this process
+    directly and from the other processes through their control queues.
+
+    Latencies are in nanoseconds using the monotonic clock which is common to all processes
+    on the machine. Results are written as JSON so runs can be compared between commits.
+
+    Usage:
+        python benchmark.py <config> [--out file] [--count n] [--latency-count n]
+                                     [--interval s] [--sizes n,n,...] [--fanout n,n,...]
+                                     [--timeout s]
+"""
+
+# System imports
+import os, sys
+import argparse
+import json
+import platform
+import subprocess
+import threading
+import multiprocessing as mp
+import queue
+from time import sleep, monotonic_ns, time
+from datetime import datetime
+
+# Application imports
+from defs import *
+import framework_mgr
+import metrics as mt
+import harness
+
+# Benchmark message tags
+BENCH_MSG = "BENCH-MSG"
+BENCH_REPORT = "BENCH-REPORT"
+BENCH_RUN = "BENCH-RUN"
+# Result tags
+SENT = "SENT"
+RESULT = "RESULT"
+# Seconds between looking at the counts and without a change before a case is over
+POLL = 0.05
+SETTLE = 1.0
+
+# ====================================================================
+# Gen-server roles
+
+# Records the latency of each message received by case
+class Sink:
+
+    def __init__(self, name):
+        self.__name = name
+        self.__lock = threading.Lock()
+        # {tag: [count, last, Histogram]}
+        self.__cases = {}
+        # Messages of this case and earlier ones have been reported for the last time
+        self.__closed = 0
+
+    def dispatch(self, msg):
+        if type(msg) is list and len(msg) == 1 and type(msg[0]) is list:
+            # Published, unwrap
+            msg = msg[0]
+        match msg:
+            case [BENCH_MSG, tag, t, _]:
+                now = monotonic_ns()
+                with self.__lock:
+                    if tag <= self.__closed:
+                        return
+                    case = self.__cases.get(tag)
+                    if case == None:
+                        case = [0, 0, mt.Histogram()]
+                        self.__cases[tag] = case
+                    case[0] += 1
+                    case[1] = now
+                    case[2].record(now - t)
+            case _:
+                pass
+
+    # [name, count, last, Histogram] for a case, the histogram only when final
+    def report(self, tag, final):
+        with self.__lock:
+            if final:
+                case = self.__cases.pop(tag, None)
+                self.__closed = max(self.__closed, tag)
+            else:
+                case = self.__cases.get(tag)
+            if case == None:
+                return [self.__name, 0, 0, mt.Histogram() if final else None]
+            return [self.__name, case[0], case[1], case[2] if final else None]
+
+# Sends the benchmark messages on its own thread
+class Driver:
+
+    def __init__(self, gs_inst, ps_inst, results):
+        self.__gs_inst = gs_inst
+        self.__ps_inst = ps_inst
+        self.__results = results
+
+    def dispatch(self, msg):
+        match msg:
+            case [BENCH_RUN, tag, kind, dest, n, size, interval]:
+                if kind == 'pubsub':
+                    send = lambda m: self.__ps_inst.ps_publish(dest, m)
+                else:
+                    send = lambda m: self.__gs_inst.server_msg(dest, m)
+                blob = bytes(size)
+                t0 = monotonic_ns()
+                for _ in range(n):
+                    send([BENCH_MSG, tag, monotonic_ns(), blob])
+                    if interval > 0:
+                        sleep(interval)
+                t1 = monotonic_ns()
+                self.__results.put([SENT, tag, n, t0, t1])
+            case _:
+                pass
+
+# ====================================================================
+# Processes
+
+# Every task of a child or stand-in process is a sink
+def make_sink(gs_inst, task):
+    return Sink(task)
+
+# Reports asked for on the control queue [BENCH_REPORT, tag, final, request]
+def send_reports(msg, proc, sinks, params, results):
+    _, tag, final, request = msg
+    results.put([RESULT, request, [sink.report(tag, final) for sink in sinks]])
+
+# ====================================================================
+# Benchmark runner
+
+class Bench:
+
+    def __init__(self, gs_inst, results, driver, timeout, sinks, ctls):
+        # sinks - the Sinks in this process
+        # ctls - the control queues of the other processes
+        self.__gs_inst = gs_inst
+        self.__results = results
+        self.__driver = driver
+        self.__timeout = timeout
+        self.__sinks = sinks
+        self.__ctls = ctls
+        self.__tag = 0
+        self.__request = 0
+
+    # Run one case and return the result record
+    def run(self, scenario, mode, kind, dest, receivers, n, size, interval):
+        self.__tag += 1
+        tag = self.__tag
+        expected = n * receivers
+        self.__gs_inst.server_msg(self.__driver, [BENCH_RUN, tag, kind, dest, n, size, interval])
+        deadline = time() + self.__timeout + n * interval
+        sent = None
+        while sent == None and time() < deadline:
+            try:
+                r = self.__results.get(timeout=max(0.01, deadline - time()))
+            except queue.Empty:
+                break
+            if r[0] == SENT and r[1] == tag:
+                sent = r
+        # Wait for everything to arrive or the count to stop changing
+        received = -1
+        changed = time()
+        while sent != None and time() < deadline:
+            reports = self.__collect(tag, False)
+            count = sum([r[1] for r in reports]) if reports != None else received
+            if count >= expected:
+                break
+            if count != received:
+                received = count
+                changed = time()
+            elif time() - changed >= SETTLE:
+                break
+            sleep(POLL)
+        reports = self.__collect(tag, True)
+        complete = sent != None and reports != None
+        if reports == None:
+            reports = []
+        hist = mt.Histogram()
+        received = 0
+        last = 0
+        for _, count, t_last, h in reports:
+            hist.merge(h)
+            received += count
+            last = max(last, t_last)
+        record = {'scenario': scenario, 'mode': mode, 'payload': size, 'receivers': receivers,
+                  'sent': expected, 'received': received, 'lost': expected - received,
+                  'complete': complete}
+        if sent != None and received > 0 and last > sent[3]:
+            duration = (last - sent[3]) / 1e9
+            record['duration_s'] = duration
+            record['msgs_per_s'] = received / duration
+        record['latency_ns'] = hist.snapshot()
+        print('%-12s %-10s %6d bytes x%-3d sent %6d received %6d %s' % (
+            scenario, mode, size, receivers, expected, received,
+            '%.0f msg/s' % record['msgs_per_s'] if 'msgs_per_s' in record else ''))
+        return record
+
+    # The reports of every sink for a case or None if a process did not answer
+    def __collect(self, tag, final):
+        self.__request += 1
+        request = self.__request
+        for ctl in self.__ctls:
+            ctl.put([BENCH_REPORT, tag, final, request])
+        reports = [sink.report(tag, final) for sink in self.__sinks]
+        answers = 0
+        deadline = time() + self.__timeout
+        while answers < len(self.__ctls):
+            try:
+                r = self.__results.get(timeout=max(0.01, deadline - time()))
+            except queue.Empty:
+                return None
+            if r[0] == RESULT and r[1] == request:
+                reports.extend(r[2])
+                answers += 1
+        return reports
+
+def git_commit():
+    try:
+        r = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                           capture_output=True, text=True, timeout=5)
+        return r.stdout.strip()
+    except Exception:
+        return None
+
+# =======================================================================================================
+# Main path code
+def main(args):
+
+    fm = framework_mgr.GlobalInit(args.config)
+    r, g = fm.start_of_day()
+    if not r:
+        return
+    local = g[LOCAL]
+    remote = g[REMOTE]
+    results = mp.Queue()
+    agents = []
+
+    # Child process
+    if len(local[1]) > 1:
+        ctl = mp.Queue()
+        child = local[1][1]
+        p = mp.Process(target=harness.run_agent, args=([LOCAL, child], remote, g['IMC'], g['CHILDREN'][child[0]], g['ROUTES'], results, ctl, make_sink, send_reports))
+        p.start()
+        agents.append((p, ctl))
+    # Remote stand-in
+    peer_cfg = None
+    if remote != None and len(remote[1]) > 0 and harness.is_loopback(remote[1][0][2]):
+        ctl = mp.Queue()
+        peer_cfg = harness.mirror_config(local, remote, 'framework_peer_')
+        p = mp.Process(target=harness.run_standin, args=(peer_cfg, results, ctl, make_sink, send_reports))
+        p.start()
+        agents.append((p, ctl))
+
+    # This process
+    pfm = framework_mgr.ProcessInit([LOCAL, local[1][0]], remote, g['IMC'], g['PARENT'], g['ROUTES'])
+    params = pfm.start_of_day()
+    gs_inst = params['GS']
+    ps_inst = params['PS']
+    tasks = local[1][0][1]
+    driver = tasks[0]
+    gs_inst.server_new(driver, Driver(gs_inst, ps_inst, results).dispatch)
+    sinks = []
+    for task in tasks[1:]:
+        sinks.append(Sink(task))
+        gs_inst.server_new(task, sinks[-1].dispatch)
+    # Subscribers for the fan-out cases
+    for i in range(max(args.fanout)):
+        name = 'BENCH-SUB-%d' % i
+        sinks.append(Sink(name))
+        gs_inst.server_new(name, sinks[-1].dispatch)
+    for k in args.fanout:
+        for i in range(k):
+            ps_inst.ps_subscribe('BENCH-SUB-%d' % i, 'BENCH-%d' % k)
+
+    # Wait for the other processes to be ready
+    ready = 0
+    while ready < len(agents):
+        try:
+            r = results.get(timeout=10)
+        except queue.Empty:
+            print('Timeout waiting for processes to start!')
+            break
+        if r[0] == harness.READY:
+            ready += 1
+    sleep(0.5)
+
+    # Scenarios as [name, kind, dest, receivers]
+    scenarios = []
+    if len(tasks) > 1:
+        scenarios.append(['gs-gs', 'direct', tasks[1], 1])
+    if len(local[1]) > 1:
+        scenarios.append(['parent-child', 'direct', local[1][1][1][0], 1])
+    if peer_cfg != None:
+        scenarios.append(['imc', 'direct', remote[1][0][1][0], 1])
+    for k in args.fanout:
+        scenarios.append(['pubsub', 'pubsub', 'BENCH-%d' % k, k])
+
+    bench = Bench(gs_inst, results, driver, args.timeout, sinks, [ctl for p, ctl in agents])
+    records = []
+    for name, kind, dest, receivers in scenarios:
+        for size in args.sizes:
+            records.append(bench.run(name, 'latency', kind, dest, receivers, args.latency_count, size, args.interval))
+            records.append(bench.run(name, 'throughput', kind, dest, receivers, args.count, size, 0))
+
+    out = {'meta': {'time': datetime.now().isoformat(),
+                    'commit': git_commit(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'config': os.path.abspath(args.config),
+                    'count': args.count,
+                    'latency_count': args.latency_count,
+                    'interval': args.interval},
+           'results': records}
+    with open(args.out, 'w') as f:
+        json.dump(out, f, indent=2)
+    print('Results written to %s' % args.out)
+
+    # Close down
+    for p, ctl in agents:
+        ctl.put(harness.QUIT)
+    for p, ctl in agents:
+        p.join()
+    pfm.end_of_day()
+    gs_inst.server_term_all()
+    fm.end_of_day()
+    if peer_cfg != None:
+        os.remove(peer_cfg)
+
+def int_list(s):
+    return [int(v) for v in s.split(',')]
+
+# =======================================================================================================
+# Entry point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Messaging framework benchmarks')
+    parser.add_argument('config', help='full path to configuration file')
+    parser.add_argument('--out', default='bench_results.json', help='JSON results file')
+    parser.add_argument('--count', type=int, default=2000, help='messages per throughput case')
+    parser.add_argument('--latency-count', type=int, default=200, help='messages per latency case')
+    parser.add_argument('--interval', type=float, default=0.001, help='seconds between latency messages')
+    parser.add_argument('--sizes', type=int_list, default=[16, 1024, 8192], help='payload sizes in bytes')
+    parser.add_argument('--fanout', type=int_list, default=[1, 4, 16], help='pub/sub subscriber counts')
+    parser.add_argument('--timeout', type=float, default=20.0, help='seconds to wait for each case')
+    args = parser.parse_args()
+    if not os.path.isfile(args.config):
+        print("Configuration file at %s does not exist!" % args.config)
+    else:
+        main(args)
@@ -23,6 +23,36 @@
 #     bob@bobcowdery.plus.com
 #
 
+# The message each dispatcher receives once its gen-server is running
+INIT = "INIT"
+
 # Target location
 LOCAL = "LOCAL"
-REMOTE = "REMOTE"
\ No newline at end of file
+REMOTE = "REMOTE"
+# Optional policies for tasks served by more than one process
+GROUPS = "GROUPS"
+# Optional links between LOCAL processes, a full mesh if not given
+LINKS = "LINKS"
+
+# Reserved destination name for a batch of messages
+# The envelope payload is [[name, message], [name, message], ...]
+BATCH = "__BATCH__"
+
+# Reserved name for pub/sub over multicast
+# To the IMC server [MCAST, [op, topic-class, [topic, data, key]]]
+# and from it to the process an envelope for MCAST with payload [topic, data, key]
+MCAST = "__MCAST__"
+# Optional multicast groups for pub/sub topic classes
+MULTICAST = "MULTICAST"
+
+# Tags of the messages a requester receives from gen_server_request()
+# [REPLY, request-id, response] or [TIMEOUT, request-id, None]
+REPLY = "__REPLY__"
+TIMEOUT = "__TIMEOUT__"
+
+# Default directory for the journals of durable gen-server mailboxes
+JOURNAL_DIR = "journal"
+
+# Reserved name of the message which stops a gen-server
+# It goes to the head of the mailbox as an urgent envelope with no payload
+STOP = "__STOP__"
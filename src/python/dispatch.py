@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# dispatch.py
+#
+# Handler tables for gen-server dispatchers
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    A dispatcher written as a match statement tries each case in turn and one that defines its message
+    values in an Enum builds a new class for every message. A Dispatcher subclass marks its handler
+    methods with @handles and the handlers are put in tables keyed by message tag once, when the class
+    is defined. Dispatching a message is then a dictionary lookup.
+
+    The tag of the data in a message is the data itself if it is a string or number, else its first
+    element if it is a list or tuple, so "PING" and ["PING", 1, 2] both have the tag "PING". The forms are
+        INIT                        handler(self)
+        [data]                      handler(self, data)
+        [sender, data]              handler(self, sender, data) for a handler with request=True
+        [REPLY, id, response]       handler(self, id, response)
+        [TIMEOUT, id, None]         handler(self, id, None)
+    A handler for ANY takes the messages of its form which have no handler of their own. Anything else
+    goes to unhandled() which logs it and can be overridden. Handlers are inherited and a subclass
+    can replace the handler for a tag.
+
+    PUBLIC INTERFACE:
+
+    Mark a method as the handler for one or more tags.
+
+        class Server(Dispatcher):
+            @handles( INIT )
+            def init(self):
+            @handles( 'PING', 'STATUS' )
+            def ping(self, data):
+            @handles( 'QUERY', request=True )
+            def query(self, sender, data):
+            @handles( REPLY, TIMEOUT )
+            def reply(self, id, response):
+            @handles( ANY )
+            def other(self, data):
+
+    An instance is the dispatcher given to gen_server_new() or gen_server_reg().
+
+        gen_server_new( name, Server() )
+"""
+
+# Application imports
+from defs import *
+import log
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Tag of the handler for messages with no handler of their own
+ANY = "__ANY__"
+
+# Decorator marking a handler
+def handles(*tags, request=False):
+    def mark(fn):
+        fn.handles = (tags, request)
+        return fn
+    return mark
+
+class Dispatcher:
+
+    # Tables of the base class, each subclass has its own
+    # {tag: function} for INIT, REPLY and TIMEOUT, [data] and [sender, data]
+    __control = {}
+    __messages = {}
+    __requests = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        control = {}
+        messages = {}
+        requests = {}
+        # Base classes first so a subclass replaces their handlers
+        for klass in reversed(cls.__mro__):
+            for fn in vars(klass).values():
+                marks = getattr(fn, 'handles', None)
+                if marks == None or not callable(fn):
+                    continue
+                tags, request = marks
+                for tag in tags:
+                    if tag in (INIT, REPLY, TIMEOUT):
+                        control[tag] = fn
+                    elif request:
+                        requests[tag] = fn
+                    else:
+                        messages[tag] = fn
+        cls.__control = control
+        cls.__messages = messages
+        cls.__requests = requests
+
+    def __call__(self, msg):
+        if msg == INIT:
+            fn = self.__control.get(INIT)
+            if fn != None:
+                return fn(self)
+        elif isinstance(msg, (list, tuple)):
+            n = len(msg)
+            if n == 1:
+                fn = self.__lookup(self.__messages, msg[0])
+                if fn != None:
+                    return fn(self, msg[0])
+            elif n == 2:
+                fn = self.__lookup(self.__requests, msg[1])
+                if fn != None:
+                    return fn(self, msg[0], msg[1])
+            elif n == 3 and (msg[0] == REPLY or msg[0] == TIMEOUT):
+                fn = self.__control.get(msg[0])
+                if fn != None:
+                    return fn(self, msg[1], msg[2])
+        self.unhandled(msg)
+
+    def unhandled(self, msg):
+        log.warning("%s - unknown message %s", type(self).__name__, msg)
+
+    # ====================================================================
+    # PRIVATE
+
+    # The handler for the tag of data, else for ANY, else None
+    def __lookup(self, table, data):
+        t = type(data)
+        if t is list or t is tuple:
+            tag = data[0] if len(data) > 0 else None
+        else:
+            tag = data
+        try:
+            fn = table.get(tag)
+        except TypeError:
+            # Not hashable so cannot have a handler
+            fn = None
+        if fn == None:
+            fn = table.get(ANY)
+        return fn
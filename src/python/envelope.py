@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# envelope.py
+#
+# The message envelope
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Every message travels in an envelope. The envelope carries the destination task and the
+    metadata about the message so nothing needs to look inside the payload to route it or to
+    find out about it.
+
+        dest        the task name, task@process for one instance of a task group or BATCH
+        sender      the requester of a request or response, else None
+        corr        the request id of a request or response, else 0
+        priority    NORMAL or URGENT, an urgent message goes to the head of a mailbox
+        sent        wall clock time in ns when the message was sent
+        trace       the trace header of a sampled message or None, see tracing
+        payload     the message as given to gen_server_msg(), opaque to the framework
+    and while in a mailbox
+        queued      monotonic time in ns it was queued, set by the mailbox
+
+    Within a process the envelope object is queued as it is. Between processes and machines it
+    is encoded as a fixed binary header followed by the names and the pickled payload
+        magic(2) flags(1) priority(1) corr(8) sent(8) dest-length(2) sender-length(2) dest sender payload
+    so the forwarder and the IMC server can route on the header with peek() and retarget() without
+    unpickling the payload. The trace header is pickled with the payload and flagged in the header.
+    Numbers in the header are big-endian and the names are UTF-8.
+
+    With the WIRE flag the payload, or [payload, trace] when traced, is in the language neutral wire
+    format instead of pickled so the envelope can be read by gen-servers in other languages, see wire.
+
+    The payload of a BATCH envelope is [[dest, payload], ...] for one mailbox or link.
+
+    PUBLIC INTERFACE:
+
+    Make an envelope.
+
+        env = Envelope( dest, payload, sender=None, corr=0, priority=NORMAL, trace=None )
+
+    Encode and decode.
+
+        data = env.encode( wire=False )
+        env = decode( data )
+
+    The destination of encoded data, encoded data with another destination, whether it carries
+    a trace header and whether it is in the wire format.
+
+        dest = peek( data )
+        data = retarget( data, dest )
+        traced( data )
+        is_wire( data )
+"""
+
+# System imports
+import struct
+import pickle
+from time import time_ns
+
+# Application imports
+from defs import *
+import wire as wf
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Encoded header
+HEADER = struct.Struct('!2sBBQQHH')
+MAGIC = b'FE'
+# Flags
+TRACED = 0x01
+WIRE = 0x02
+# Priority
+NORMAL = 0
+URGENT = 1
+
+class Envelope:
+
+    __slots__ = ('dest', 'sender', 'corr', 'priority', 'sent', 'trace', 'payload', 'queued')
+
+    def __init__(self, dest, payload, sender=None, corr=0, priority=NORMAL, trace=None, sent=None):
+        self.dest = dest
+        self.payload = payload
+        self.sender = sender
+        self.corr = corr
+        self.priority = priority
+        self.trace = trace
+        self.sent = time_ns() if sent == None else sent
+        self.queued = 0
+
+    def encode(self, wire=False):
+        dest = self.dest.encode('utf-8')
+        sender = b'' if self.sender == None else self.sender.encode('utf-8')
+        if self.trace == None:
+            flags = 0
+            body = self.payload
+        else:
+            flags = TRACED
+            body = (self.payload, self.trace)
+        if wire:
+            flags |= WIRE
+            body = wf.dumps(body)
+        else:
+            body = pickle.dumps(body, pickle.HIGHEST_PROTOCOL)
+        return b''.join((HEADER.pack(MAGIC, flags, self.priority, self.corr, self.sent, len(dest), len(sender)), dest, sender, body))
+
+    def __repr__(self):
+        return 'Envelope(%r, %r)' % (self.dest, self.payload)
+
+def decode(data):
+    magic, flags, priority, corr, sent, dest_len, sender_len = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('not an envelope')
+    off = HEADER.size
+    dest = bytes(data[off:off + dest_len]).decode('utf-8')
+    off += dest_len
+    sender = bytes(data[off:off + sender_len]).decode('utf-8') if sender_len > 0 else None
+    if flags & WIRE:
+        body = wf.loads(data[off + sender_len:])
+    else:
+        body = pickle.loads(data[off + sender_len:])
+    if flags & TRACED:
+        payload, trace = body
+    else:
+        payload, trace = body, None
+    return Envelope(dest, payload, sender, corr, priority, trace, sent)
+
+def peek(data):
+    dest_len = HEADER.unpack_from(data)[5]
+    return bytes(data[HEADER.size:HEADER.size + dest_len]).decode('utf-8')
+
+def retarget(data, dest):
+    magic, flags, priority, corr, sent, dest_len, sender_len = HEADER.unpack_from(data)
+    name = dest.encode('utf-8')
+    return b''.join((HEADER.pack(magic, flags, priority, corr, sent, len(name), sender_len), name, data[HEADER.size + dest_len:]))
+
+def traced(data):
+    return (data[2] & TRACED) != 0
+
+def is_wire(data):
+    return (data[2] & WIRE) != 0
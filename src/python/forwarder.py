@@ -26,11 +26,16 @@
 # System imports
 import threading
 import queue
-from time import sleep
 
 # Application imports
 from defs import *
+import log
 import td_manager
+import tracing
+import gen_server as gs
+import recorder as rec
+import envelope
+from envelope import Envelope
 
 # ====================================================================
 # PUBLIC
@@ -39,38 +44,107 @@ import td_manager
 # The forwarding task
 class FwdServer(threading.Thread):
     
-    def __init__(self, td_man, qs):
+    def __init__(self, td_man, qs, metrics=None, router=None, recorder=None):
         super(FwdServer, self).__init__()
         self.__td_man = td_man
         self.__qs = qs
+        # The router is used to pass on messages for other processes
+        self.__router = router
+        # Optional traffic recorder for this process
+        self.__recorder = recorder
         self.__term = False
+        # Count of messages received
+        if metrics != None:
+            self.__count = metrics.counter('fwd.msgs_in')
+        else:
+            self.__count = None
         
     def terminate(self):
         self.__term = True
         
     def run(self):
-        while not self.__term:
-            for (q, _) in self.__qs.values():
-                try:
-                    item = q.get(block=False)
-                    # Process message
-                    self.__process(item)
-                except queue.Empty:
-                    continue
-            sleep(0.05)
+        # A reader for each q so a busy link never holds up another
+        readers = []
+        for (q, _) in self.__qs.values():
+            readers.append(threading.Thread(target=self.__read, args=(q,), daemon=True))
+        for r in readers:
+            r.start()
+        for r in readers:
+            r.join()
         print("FwdServer terminating...")
+    
+    def __read(self, q):
+        while not self.__term:
+            try:
+                item = q.get(timeout=1)
+            except queue.Empty:
+                continue
+            if self.__count != None:
+                self.__count.inc()
+            # Process message
+            self.__process(item)
             
-    def __process(self, msg):
-        # A message is of this form but data is opaque to us
-        # [name, [*] | [sender, [*]]]
-        name, data = msg
-        # Lookup the destination
-        item = self.__td_man.get_task_ref(name)
+    def __process(self, data):
+        # The data is an encoded envelope, see envelope
+        # The envelope is handed to the mailbox of the destination and the
+        # gen-server dispatches it on its own thread
+        dest = envelope.peek(data)
+        if dest == BATCH:
+            # Unpack a batch into one batch per mailbox
+            batches = {}
+            for m in envelope.decode(data).payload:
+                if self.__recorder != None:
+                    self.__recorder.record(rec.FWD, m[0], m[1])
+                name, item = self.__lookup(m[0])
+                if item == None:
+                    self.__relay(name, Envelope(m[0], m[1]).encode())
+                elif isinstance(item[0], gs.ThrdServer):
+                    if id(item[2]) not in batches:
+                        batches[id(item[2])] = [item[2], []]
+                    batches[id(item[2])][1].append([name, m[1]])
+                else:
+                    # Registered task, messages are retrieved individually
+                    item[2].put(Envelope(name, m[1]))
+            for q, batch in batches.values():
+                q.put(Envelope(BATCH, batch))
+            return
+        name, item = self.__lookup(dest)
         if item == None:
+            # Passed on as it is, the payload is not touched
+            if self.__recorder != None:
+                env = envelope.decode(data)
+                self.__recorder.record(rec.FWD, env.dest, env.payload)
+            self.__relay(name, data)
+        else:
+            env = envelope.decode(data)
+            env.dest = name
+            if env.trace != None:
+                tracing.stamp(env.trace, 'fwd')
+            if self.__recorder != None:
+                self.__recorder.record(rec.FWD, dest, env.payload)
+            item[2].put(env)
+    
+    # Find the task reference, a task group instance of this process is task@process
+    def __lookup(self, name):
+        if '@' in name:
+            task, _, proc = name.partition('@')
+            if self.__router != None and proc == self.__router.name():
+                name = task
+        return name, self.__td_man.get_task_ref(name)
+    
+    # Pass an encoded envelope on towards a LOCAL process with no direct link to the sender
+    def __relay(self, name, data):
+        qs = None
+        if self.__router != None:
+            task, _, proc = name.partition('@')
+            if proc == '':
+                proc, qs = self.__router.process_for_task(name)
+            else:
+                _, qs = self.__router.get_route(proc)
+            if proc == None or proc == self.__router.name() or self.__router.is_remote_process(proc):
+                qs = None
+        if qs == None:
             # No destination 
-            print("FwdServer - destination %s not found!" % (name))
+            log.error("FwdServer - destination %s not found!", name)
         else:
-            # Dispatch
-            _, d, q = item
-            d(data)
-            
+            qs[1].put(data)
@@ -32,12 +32,19 @@ from time import sleep
 
 # Application imports
 from defs import *
+import log
 import td_manager
 import routing
 import forwarder
 import imc_server
 import imc_dispatcher
+import link
 import gen_server as gs
+import pub_sub as ps
+import metrics as mt
+import tracing
+import profiler as pf
+import recorder as rec
 
 """
 There are two startup routines which offload boilerplate stuff from the user.
@@ -58,13 +65,19 @@ file for each will be different.
 class GlobalInit:
     
     #==============================================================================================  
-    def __init__(self, cfg):
+    def __init__(self, cfg, record_dir=None):
         self.__cfg = cfg
+        # Record messages received by the IMC server to a log in this directory, see recorder
+        self.__record_dir = record_dir
         
         self.__local = None
         self.__remote = None
+        self.__groups = {}
+        self.__links = None
         self.__is_local = False
         self.__is_remote = False
+        self.__multicast = {}
+        self.__imc_queues = {}
      
     #==============================================================================================   
     # Call this after any startup local initialisation
@@ -100,80 +113,118 @@ class GlobalInit:
                 for key in topology['REMOTE']:
                     # Retrieve and split value
                     val = topology['REMOTE'][key]
-                    tasks, params = val.split(':')
+                    # An optional third field has the link options
+                    tasks, params, *opts = val.split(':')
                     tasks = tasks.strip().split(',')
                     ip, inport, outport = params.strip().split(',')
-                    self.__remote[1].append([key, tasks, ip, int(inport), int(outport)])
-                    print('Found process %s with tasks %s and parameters %s, %s, %s' % ( key, tasks, ip, inport, outport))
+                    opts = link.parse_opts(opts[0] if len(opts) > 0 else '')
+                    self.__remote[1].append([key, tasks, ip, int(inport), int(outport), opts])
+                    print('Found process %s with tasks %s and parameters %s, %s, %s %s' % ( key, tasks, ip, inport, outport, link.format_opts(opts)))
+            if GROUPS in sections:
+                print('Found GROUPS section, parsing policies...')
+                for key in topology['GROUPS']:
+                    policy = topology['GROUPS'][key].strip()
+                    if policy not in routing.POLICIES:
+                        raise ValueError('Unknown policy %s for group %s' % (policy, key))
+                    self.__groups[key] = policy
+                    print('Found group %s with policy %s' % (key, policy))
+            if MULTICAST in sections:
+                print('Found MULTICAST section, parsing groups...')
+                for key in topology['MULTICAST']:
+                    # group, port and optionally the interface address
+                    params = [p.strip() for p in topology['MULTICAST'][key].split(',')]
+                    self.__multicast[key] = (params[0], int(params[1]), params[2] if len(params) > 2 else None)
+                    print('Found topic class %s with group %s' % (key, self.__multicast[key]))
+            if LINKS in sections:
+                print('Found LINKS section, parsing links...')
+                self.__links = []
+                names = [proc[0] for proc in self.__local[1]]
+                for key in topology['LINKS']:
+                    peers = [p.strip() for p in topology['LINKS'][key].split(',') if p.strip() != '']
+                    for peer in [key] + peers:
+                        if peer not in names:
+                            raise ValueError('Link to unknown LOCAL process %s' % peer)
+                    for peer in peers:
+                        self.__links.append((key, peer))
+                    print('Found links from %s to %s' % (key, peers))
         except Exception as e:
             print('There was a problem with the configuration [%s]' % str(e))
             return False, {}
 
         #===================================================================
-        # Setup global Manager
-        # The one and only multiprocessing.Manager
-        self.__mp_manager = mp.Manager()
-        # Make the shared dictionary
-        self.__mp_dict = self.__mp_manager.dict()
+        # Compile the topology into the shared read-only route table
+        self.__routes = routing.RouteTable(self.__local, self.__remote, self.__groups, self.__make_links(), list(self.__multicast))
         # Make a shared startup event
-        self.__mp_event = self.__mp_manager.Event()
+        self.__mp_event = mp.Event()
         
         #===================================================================
         # Create local q's
         if self.__is_local:
             #===================================================================
-            # We need a pair of multiprocessor.Queue between each communicating instance
+            # We need a pair of multiprocessor.Queue between each linked pair of processes
             # The first in the pair listens for messages from 'name'.
             # The second sends messages to 'name'.
-            # q_local will be of the form {name: {name: [task_name, task_name, ...]}, name: ...}
-            # The parent process wants all of the child q's for receive and send
-            # Each child wants the parent q's
-            self.__q_local_children = {}
-            first = True
-            parent_name = ''
-            for proc in self.__local[1]:
+            # q_local will be of the form {name: {peer-name: [in_q, out_q], ...}, name: ...}
+            # The parent process wants the q's to all its peers and so does each child
+            # Messages between processes with no link are relayed along the links
+            q_local = {proc[0]: {} for proc in self.__local[1]}
+            for a, b in self.__make_links():
                 q1 = mp.Queue()
                 q2 = mp.Queue()
-                if first:
-                    # Main process
-                    # Note name
-                    parent_name = proc[0]
-                    first = False
-                else:
-                    # Child process
-                    self.__q_local_children[proc[0]] = {parent_name: [q1, q2]}
-        
-            # We now have all the child procs with q's that point to the parent
-            # Add all q's to the parent but reverse the receive/send q's
-            self.__q_local_parent = {}
-            for proc in self.__q_local_children.keys():
-                self.__q_local_parent[proc] = [self.__q_local_children[proc][parent_name][1], self.__q_local_children[proc][parent_name][0]]
+                q_local[a][b] = [q1, q2]
+                q_local[b][a] = [q2, q1]
+            parent_name = self.__local[1][0][0]
+            self.__q_local_parent = q_local[parent_name]
+            self.__q_local_children = {name: qs for name, qs in q_local.items() if name != parent_name}
     
         #===================================================================
         # Make an IMC server which runs as a remote service
-        if self.__is_remote:
+        # It is also needed for pub/sub multicast
+        self.__is_imc = self.__is_remote or len(self.__multicast) > 0
+        if self.__is_imc:
+            remote = self.__remote[1] if self.__is_remote else []
             # Create ports list
             # This is the ports to listen on
             # Ports can be repeated if there are multiple processes on a node
             # We only want to have each listen port once
             ports = []
-            for desc in self.__remote[1]:
+            for desc in remote:
                 if desc[3] not in ports:
                     ports.append(desc[3])
             # Create queues
             # there is an in and out q for each process on this machine
-            # to talk to the IMC server. These must be added to the router.
-            # {proc_name: (q, q), ...}
+            # to talk to the IMC server. Each process picks out its own pair.
+            # {local_proc_name: (q, q), ...}
+            # The IMC server needs to know which process each local task is in
+            # so it can put received messages on the right q.
+            # {task_name: local_proc_name, ...}
             self.__imc_queues = {}
-            for proc in self.__remote[1]:   
+            tasks = {}
+            for proc in self.__local[1]:   
                 q1 = mp.Queue()
                 q2 = mp.Queue()
                 self.__imc_queues[proc[0]] = (q1, q2)
+                for task in proc[1]:
+                    tasks[task] = proc[0]
             # Special control q to send control messages
             self.__imc_ctl_q = mp.Queue()
+            # Shared counters written by the IMC process
+            self.__imc_counters = mt.imc_counters()
             # Create and start the IMC process            
-            self.__imc = mp.Process(target=imc_server.ImcServer(ports, self.__imc_queues, self.__imc_ctl_q).run)
+            # Options for each link {(ip, port): opts}
+            links = {(desc[2], desc[4]): desc[5] for desc in remote}
+            # and the port each link sends from, its listen port
+            sources = {(desc[2], desc[4]): desc[3] for desc in remote}
+            record = None
+            if self.__record_dir != None:
+                os.makedirs(self.__record_dir, exist_ok=True)
+                record = os.path.join(self.__record_dir, 'imc.rec')
+            server = imc_server.ImcServer(ports, self.__imc_queues, self.__imc_ctl_q, self.__imc_counters, tasks, links,
+                                          multicast_groups=self.__multicast, record=record, sources=sources)
+            self.__imc = mp.Process(target=server.run)
             self.__imc.start()
+            # The IMC process has its own copies of the sockets
+            server.close()
     
         #===================================================================
         # Return the startup objects
@@ -182,17 +233,47 @@ class GlobalInit:
                       'IMC': self.__imc_queues,
                       'PARENT': self.__q_local_parent,
                       'CHILDREN': self.__q_local_children,
-                      'DICT': self.__mp_dict,
+                      'ROUTES': self.__routes.name(),
                       'EVENT': self.__mp_event}
 
     #==============================================================================================   
     # Call this at end of day
     def end_of_day(self):
-        if self.__is_remote: 
+        if self.__is_imc: 
             # Send QUIT to imc control q
             self.__imc_ctl_q.put("QUIT")
             self.__imc.join()
-        pass
+        # Release the route table
+        self.__routes.close()
+        log.flush()
+    
+    #==============================================================================================   
+    # Snapshot of the IMC server packet and byte counts
+    def imc_metrics(self):
+        if self.__is_imc:
+            return mt.imc_snapshot(self.__imc_counters)
+        return {}
+    
+    #==============================================================================================      
+    # The links between LOCAL processes as [(name, name), ...]
+    # The main process is always linked to each child, the children are linked to
+    # each other as declared or all to all if there is no LINKS section
+    def __make_links(self):
+        if self.__local == None:
+            return []
+        names = [proc[0] for proc in self.__local[1]]
+        links = []
+        for peer in names[1:]:
+            links.append((names[0], peer))
+        if self.__links == None:
+            for i, a in enumerate(names[1:], 1):
+                for b in names[i+1:]:
+                    links.append((a, b))
+        else:
+            for a, b in self.__links:
+                if a != b and (a, b) not in links and (b, a) not in links:
+                    links.append((a, b))
+        return links
     
     #==============================================================================================      
     # This reader ensures we retain the case of the options
@@ -204,7 +285,7 @@ class GlobalInit:
             config.read(cfg)
             return config
         except Exception as e:
-            log.error(e)
+            log.error("GlobalInit - problem reading configuration %s, %s", cfg, e)
 
 
 #==================================================
@@ -212,12 +293,30 @@ class GlobalInit:
 class ProcessInit:
     
     #==============================================================================================   
-    def __init__(self, local_procs, remote_procs, imc_queues, local_queues, mp_dict):
+    def __init__(self, local_procs, remote_procs, imc_queues, local_queues, routes, trace_every=0, slow_threshold=None, journal_dir=JOURNAL_DIR, record_dir=None):
         self.__local_procs = local_procs
         self.__remote_procs = remote_procs
-        self.__imc_queues = imc_queues
+        # Our own pair of IMC queues, all remote processes are reached through it
+        self.__imc_queues = {}
+        self.__imc_routes = {}
+        name = local_procs[1][0]
+        self.__name = name
+        if name in imc_queues:
+            self.__imc_queues[name] = imc_queues[name]
+            if remote_procs != None:
+                for desc in remote_procs[1]:
+                    self.__imc_routes[desc[0]] = imc_queues[name]
         self.__local_queues = local_queues
-        self.__mp_dict = mp_dict
+        # Name of the shared route table
+        self.__routes = routes
+        # Trace one in every n messages or 0 for no tracing
+        self.__trace_every = trace_every
+        # Flag dispatcher calls over this many seconds or None for no profiling
+        self.__slow_threshold = slow_threshold
+        # Where durable gen-server mailboxes keep their journals
+        self.__journal_dir = journal_dir
+        # Record the traffic of this process to a log in this directory, see recorder
+        self.__record_dir = record_dir
         
     #==============================================================================================   
     # Call for each process startup
@@ -226,29 +325,51 @@ class ProcessInit:
         # General setup for each process
         # Make a task data manager
         self.__td_man = td_manager.TdManager()
+        
+        # Make the metrics registry for this process
+        self.__metrics = mt.MetricsRegistry()
+        
+        # Make the tracer if tracing is wanted
+        if self.__trace_every > 0:
+            self.__tracer = tracing.Tracer(self.__trace_every)
+        else:
+            self.__tracer = None
+        
+        # Make the dispatcher profiler if wanted
+        if self.__slow_threshold != None:
+            self.__profiler = pf.DispatchProfiler(self.__slow_threshold)
+        else:
+            self.__profiler = None
     
+        # Make the traffic recorder if wanted
+        if self.__record_dir != None:
+            os.makedirs(self.__record_dir, exist_ok=True)
+            self.__recorder = rec.Recorder(os.path.join(self.__record_dir, '%s.rec' % (self.__name)))
+        else:
+            self.__recorder = None
+    
+        # Make a router
+        # The routes for all processes are already in the shared table
+        self.__router = routing.Routing(self.__routes, self.__local_queues, self.__imc_routes, self.__name)
+        
         # Make and run a forward server
-        self.__fwds = forwarder.FwdServer(self.__td_man, self.__local_queues)
+        self.__fwds = forwarder.FwdServer(self.__td_man, self.__local_queues, self.__metrics, self.__router, self.__recorder)
         self.__fwds.start()
     
         # Make and run a imc dispatcher
-        self.__imc_disp = imc_dispatcher.ImcDispatcher(self.__td_man, self.__imc_queues)
+        self.__imc_disp = imc_dispatcher.ImcDispatcher(self.__td_man, self.__imc_queues, self.__metrics)
         self.__imc_disp.start()
         
-        # Make a router
-        self.__router = routing.Routing(self.__mp_dict, self.__local_queues, self.__imc_queues)
-        # Add routes for this process
-        self.__router.add_route(self.__local_procs[0], self.__local_procs[1])
-
-        # Add IMC routes
-        for desc in self.__remote_procs[1]:
-            self.__router.add_route(self.__remote_procs[0], desc)
-        
         # Make a GenServer instance to manage gen servers in this process
-        self.__gs_inst = gs.GenServer(self.__td_man, self.__router)
+        self.__gs_inst = gs.GenServer(self.__td_man, self.__router, self.__metrics, self.__tracer, self.__profiler, self.__journal_dir, self.__recorder)
+        
+        # Make a PubSub instance to manage topics for the tasks in this process
+        # Topics with a multicast group go through our IMC queue
+        imc_q = self.__imc_queues[self.__name][1] if self.__name in self.__imc_queues else None
+        self.__ps_inst = ps.PubSub(self.__gs_inst, self.__td_man, self.__router, imc_q)
         
         # Return the process specific objects
-        return {'TD': self.__td_man, 'ROUTER': self.__router, 'GS': self.__gs_inst}
+        return {'TD': self.__td_man, 'ROUTER': self.__router, 'GS': self.__gs_inst, 'PS': self.__ps_inst, 'METRICS': self.__metrics, 'TRACE': self.__tracer, 'PROFILER': self.__profiler, 'RECORDER': self.__recorder}
     
     #==============================================================================================   
     # Call this at end of process
@@ -257,4 +378,10 @@ class ProcessInit:
         self.__fwds.join()
         self.__imc_disp.terminate()
         self.__imc_disp.join()
+        if self.__profiler != None:
+            self.__profiler.stop()
+        if self.__recorder != None:
+            self.__recorder.close()
+        # Children end with os._exit() so write out the log now
+        log.flush()
     
\ No newline at end of file
@@ -29,13 +29,14 @@ import multiprocessing as mp
 import threading
 import queue
 from time import sleep
-from enum import Enum
 import pprint
 
 # Application imports
 from defs import *
 import framework_mgr
 import gen_server as gs
+import dispatch
+from dispatch import handles, ANY
 import pub_sub as ps
 import td_manager
 import routing
@@ -49,14 +50,14 @@ import imc_server
 
 class AppMain:
 
-    def __init__(self, local, remote, imc_queues, local_queues, multiproc_dict, multiproc_event):
+    def __init__(self, local, remote, imc_queues, local_queues, routes, multiproc_event):
         
         # Save params
         self.__local = local
         self.__remote = remote
         self.__imc_queues = imc_queues
         self.__local_queues = local_queues
-        self.__multiproc_dict = multiproc_dict
+        self.__routes = routes
         self.__multiproc_event = multiproc_event
         
     # Entry point for process
@@ -64,7 +65,7 @@ class AppMain:
         
         # ======================================================
         # For each process we perform a process initialisation which does the boiler plate stuff
-        fm = framework_mgr.ProcessInit(self.__local, self.__remote, self.__imc_queues, self.__local_queues, self.__multiproc_dict)
+        fm = framework_mgr.ProcessInit(self.__local, self.__remote, self.__imc_queues, self.__local_queues, self.__routes)
         # Call start_of_day() to get the task data instance that tracks the tasks this instance creates and the
         # router instance that merges together the data about which process containes which tasks and the
         # associated queues for processes to communicate.
@@ -72,6 +73,7 @@ class AppMain:
         td_man = params['TD']           # The task data manager
         router = params['ROUTER']       # The router reference
         self.__gs_inst = params['GS']   # Instance of the gen server class to manage gen server instances
+        self.__ps_inst = params['PS']   # Instance of the publish/subscribe class for this process
         
         # ======================================================
         # Get the local proc in a more usable state
@@ -96,8 +98,8 @@ class AppMain:
         # and dispatch messages.
         # We use the gs_inst to create new servers. We don't need a refernece as they are self
         # managing.
-        self.__gs_inst.server_new(self.GS1, self.gs1_dispatch)
-        self.__gs_inst.server_new(self.GS2, self.gs2_dispatch)
+        self.__gs_inst.server_new(self.GS1, ServerDispatcher(self.__gs_inst, self.GS1, self.__name, self.GS2))
+        self.__gs_inst.server_new(self.GS2, ServerDispatcher(self.__gs_inst, self.GS2, self.__name, self.GS1))
         
         # The gen servers start on their own thread. However we might want to send messages to this
         # thread which is not a gen server and could be the main GUI thread.
@@ -107,7 +109,7 @@ class AppMain:
         # It also needs a q on which to receive messages
         q = queue.Queue()
         # We register the main thread (task) as its own process name for messaging
-        self.__gs_inst.server_reg(self.__name, None, self.main_dispatch, q)
+        self.__gs_inst.server_reg(self.__name, None, MainDispatcher(self.__gs_inst, self.__name), q)
         
         # Now all the initialisation is done we wait for the start signal
         self.__multiproc_event.wait()
@@ -117,16 +119,16 @@ class AppMain:
         # Just send and receive a few messages to prove operation and to provide sample exchanges.
         
         # Send one way message to our gen servers from main thread (A&B or C&D)
-        self.__gs_inst.server_msg(self.GS1, ["Message to %s from %s main thread" % (self.GS1, self.__name)])
-        self.__gs_inst.server_msg(self.GS2, ["Message to %s from %s main thread" % (self.GS2, self.__name)])
+        self.__gs_inst.server_msg(self.GS1, [["FROM_MAIN", self.__name]])
+        self.__gs_inst.server_msg(self.GS2, [["FROM_MAIN", self.__name]])
         
         # Now send one way message from main thread, parent -> child or child -> parent to first gen server
         if self.__name == "PARENT":
             # This is parent so A and B gen servers, so send to C
-            self.__gs_inst.server_msg("C", ["Interprocess to C from %s main thread" % self.__name])
+            self.__gs_inst.server_msg("C", [["INTERPROCESS", self.__name]])
         else:
             # This is child so B and C gen servers, so send to A
-            self.__gs_inst.server_msg("A", ["Interprocess to A from %s main thread" % self.__name])
+            self.__gs_inst.server_msg("A", [["INTERPROCESS", self.__name]])
         
         # In this template example the gen servers send a one way message back to this thread
         # As we are not a gen server we have to manually retrieve messages using our task name
@@ -138,8 +140,8 @@ class AppMain:
         # Now send message from main thread to our gen servers that require a response
         # For a response we simply add the name of the task to reply to.
         # For the main task the task name is the same as the process name
-        self.__gs_inst.server_msg(self.GS1, [self.__name, "Message to %s from %s expects response" % (self.GS1, self.__name)])
-        self.__gs_inst.server_msg(self.GS2, [self.__name, "Message to %s from %s expects response" % (self.GS2, self.__name)])
+        self.__gs_inst.server_msg(self.GS1, [self.__name, ["REQUEST", self.__name]])
+        self.__gs_inst.server_msg(self.GS2, [self.__name, ["REQUEST", self.__name]])
         
         # As we now expect a response retrieve our messages as before
         resp = self.__gs_inst.server_response_get(self.__name)
@@ -158,9 +160,9 @@ class AppMain:
         # not listening there will be no error or a timeout on the reply.
         
         # One-way message
-        self.__gs_inst.server_msg("E", ["Intermachine to E from %s" % self.__name])
+        self.__gs_inst.server_msg("E", [["INTERMACHINE", self.__name]])
         # Response expected
-        #self.__gs_inst.server_msg("G", [self.__name, "Intermachine to G from %s expects response" % self.__name])
+        #self.__gs_inst.server_msg("G", [self.__name, ["REQUEST", self.__name]])
         
         # As we now expect a response retrieve our messages as before
         #resp = self.__gs_inst.server_response_get(self.__name)
@@ -173,14 +175,19 @@ class AppMain:
         # This uses the underlying gen server messaging system but decouples the sender and
         # receiver.
         # Subscribe A & B to a topic
-        #ps.ps_subscribe( "GS1", "TOPIC-1")
-        #ps.ps_subscribe( "GS2", "TOPIC-1")
+        #self.__ps_inst.ps_subscribe( self.GS1, "TOPIC-1")
+        #self.__ps_inst.ps_subscribe( self.GS2, "TOPIC-1")
         
         # Publish TOPIC-1
-        #ps.ps_publish( "TOPIC-1", "Publish to TOPIC-1" )
+        #self.__ps_inst.ps_publish( "TOPIC-1", ["TOPIC-1", self.__name] )
         
         # Get topic list
-        #print("Subscribers: ", ps.ps_list("TOPIC-1"))
+        #print("Subscribers: ", self.__ps_inst.ps_list("TOPIC-1"))
+        
+        # A conflating topic only delivers the newest value to a slow subscriber
+        # and new subscribers immediately get the last value published
+        #self.__ps_inst.ps_conflate( "METER" )
+        #self.__ps_inst.ps_publish( "METER", -73.5 )
         
         # ======================================================
         # Clean up
@@ -189,118 +196,89 @@ class AppMain:
         fm.end_of_day()
         # Terminate all our gen servers
         self.__gs_inst.server_term_all()
-     
-    # ======================================================
-    # Start dispatch methods
-    # Dispatcher for main thread
-    def main_dispatch(self, msg):
-        # We expect two message types from each local gen server
-        # We need to match on the exact message text but in reality could be
-        # on a msg id as the data is opaque to the framework.
-        class MSGS(Enum):
-            MSG = "Message to %s" % (self.__name)
-        match msg:
-            case [data]:
-                # Local one way message
-                match data:
-                    case MSGS.MSG.value:
-                        print("%s Message ", (self.__name, data))
-            case [sender, data]:
-                # RPC type message that requires a response
-                print("%s RPC [%s, %s] " % (self.__name, sender, data))
-                # Send response to sender
-                self.__gs_inst.server_response( sender, "Response to %s from %s" % (sender, self.__name) )
-            case _:
-                # Message not understood
-                print("%s [unknown message %s]" % (self.__name, msg)) 
+
+
+# ======================================================
+# Start dispatchers
+# A dispatcher is any callable taking the message. Subclassing dispatch.Dispatcher and marking
+# methods with @handles gives each message tag its own method, looked up in a table built once
+# when the class is defined rather than matched case by case for every message.
+# The data of each message here is [tag, sender-task] so the tag says what it is.
+
+# Dispatcher for main thread
+class MainDispatcher(dispatch.Dispatcher):
     
-    # ======================================================
-    # Dispatcher for gen server 1
-    def gs1_dispatch(self, msg):
-        class MSGS(Enum):
-            MSG1 = "Message to %s from PARENT main thread" % (self.GS1)
-            MSG2 = "Message to %s from CHILD main thread" % (self.GS1)
-            MSG3 = "Message to %s from %s" % (self.GS1, self.GS2)
-        
-        match msg:
-            case "INIT":
-                # Each dispatcher receives an INIT message at start of day
-                # so it can perform any necessary initialisation
-                print("INIT %s" % self.GS1)
-            case [data]:
-                match data:
-                    case MSGS.MSG1.value:
-                        print("%s - Message [%s]" % (self.GS1, str(data)))
-                        # Send a one way message back to main task
-                        self.__gs_inst.server_msg( self.__name, ["Message to %s from %s" % (self.__name, self.GS1)] )
-                        # Send a one way message from this gen server to the other gen server
-                        self.__gs_inst.server_msg( self.GS2, ["Message to %s from %s" % (self.GS2, self.GS1)] )
-                    case MSGS.MSG2.value:
-                        print("%s - Message [%s]" % (self.GS1, str(data)))
-                    case MSGS.MSG3.value:
-                        print("%s - Message [%s]" % (self.GS1, str(data)))
-                    # Interprocess on same machine messages to first gen server only
-                    case "Interprocess to A from CHILD main thread":
-                        print("%s - %s" % (self.GS1, str(data)))
-                    case "Interprocess to C from PARENT main thread":
-                        print("%s - %s" % (self.GS1, str(data)))
-                    # Using pub/sub system
-                    #case "Publish to TOPIC-1":
-                    #    print("%s - Got TOPIC-1" % self.GS1)
-                    case _:
-                        print("%s [unknown message %s]" % (self.GS1, msg))
-            # Does message need a response
-            case [sender, data]:
-                print("%s - [%s, %s] " % (self.GS1, sender, data))
-                self.__gs_inst.server_response( sender, ["Response to %s from %s" % (sender, self.GS1)] )
-            case _:
-                print("%s [unknown message %s]" % (self.GS1, msg)) 
+    def __init__(self, gs_inst, name):
+        self.__gs_inst = gs_inst
+        self.__name = name
+    
+    # Local one way message from one of our gen servers
+    @handles("FROM_SERVER")
+    def from_server(self, data):
+        print("%s - Message from %s" % (self.__name, data[1]))
+    
+    # RPC type message that requires a response
+    @handles(ANY, request=True)
+    def request(self, sender, data):
+        print("%s RPC [%s, %s] " % (self.__name, sender, data))
+        # Send response to sender
+        self.__gs_inst.server_response( sender, "Response to %s from %s" % (sender, self.__name) )
+
+# ======================================================
+# Dispatcher for the gen servers, each gets its own instance
+class ServerDispatcher(dispatch.Dispatcher):
+    
+    def __init__(self, gs_inst, name, main, peer):
+        self.__gs_inst = gs_inst
+        self.__name = name
+        self.__main = main
+        self.__peer = peer
+    
+    # Each dispatcher receives an INIT message at start of day
+    # so it can perform any necessary initialisation
+    @handles(INIT)
+    def init(self):
+        print("INIT %s" % self.__name)
+    
+    @handles("FROM_MAIN")
+    def from_main(self, data):
+        print("%s - Message from %s main thread" % (self.__name, data[1]))
+        # Send a one way message back to main task
+        self.__gs_inst.server_msg( self.__main, [["FROM_SERVER", self.__name]] )
+        # Send a one way message from this gen server to the other gen server
+        self.__gs_inst.server_msg( self.__peer, [["FROM_PEER", self.__name]] )
+    
+    @handles("FROM_PEER")
+    def from_peer(self, data):
+        print("%s - Message from %s" % (self.__name, data[1]))
+    
+    # Interprocess on same machine messages to first gen server only
+    # and intermachine messages from the remote system
+    @handles("INTERPROCESS", "INTERMACHINE")
+    def from_other(self, data):
+        print("%s - %s from %s" % (self.__name, data[0], data[1]))
+    
+    # Using pub/sub system
+    #@handles("TOPIC-1")
+    #def topic_1(self, data):
+    #    print("%s - Got TOPIC-1" % self.__name)
     
-    # ======================================================
-    # Dispatcher for gen server 2
-    def gs2_dispatch(self, msg):
-        class MSGS(Enum):
-            MSG1 = "Message to %s from PARENT main thread" % (self.GS2)
-            MSG2 = "Message to %s from CHILD main thread" % (self.GS2)
-            MSG3 = "Message to %s from %s" % (self.GS2, self.GS1)
-            
-        match msg:
-            case "INIT":
-                print("INIT %s" % self.GS2)
-            case [data]:
-                match data:
-                    case MSGS.MSG1.value:
-                        print("%s - Message [%s]" % (self.GS2, str(data)))
-                        # Send a one way message back to main task
-                        self.__gs_inst.server_msg( self.__name, ["Message to %s from %s" % (self.__name, self.GS2)] )
-                        # Send a one way message from this gen server to the other gen server
-                        self.__gs_inst.server_msg( self.GS1, ["Message to %s from %s" % (self.GS1, self.GS2)] )
-                    case MSGS.MSG2.value:
-                        print("%s - Message [%s]" % (self.GS2, str(data)))
-                    case MSGS.MSG3.value:
-                        print("%s - Message [%s]" % (self.GS2, str(data)))
-                    # Pub/sub system
-                    #case "Publish to TOPIC-1":
-                    #    print("%s - Got TOPIC-1" % self.GS2)
-                    case _:
-                        print("%s [unknown message %s]" % (self.GS2, msg))
-            # Does message need a response
-            case [sender, data]:
-                print("%s - [%s, %s] " % (self.GS2, sender, data))
-                self.__gs_inst.server_response( sender, ["Response to %s from %s" % (sender, self.GS2)] )
-            case _:
-                print("%s [unknown message %s]" % (self.GS2, msg))
+    # Does message need a response
+    @handles(ANY, request=True)
+    def request(self, sender, data):
+        print("%s - [%s, %s] " % (self.__name, sender, data))
+        self.__gs_inst.server_response( sender, ["Response to %s from %s" % (sender, self.__name)] )
 
 # =======================================================================================================
 # Run parent instance
-def run_parent_process(ar_task_ids, ar_imc_ids, d_imc_qs, d_process_qs, mp_dict, mp_event):
+def run_parent_process(ar_task_ids, ar_imc_ids, d_imc_qs, d_process_qs, routes, mp_event):
     # Directly call the main template code
-    AppMain(ar_task_ids, ar_imc_ids, d_imc_qs, d_process_qs, mp_dict, mp_event).run()
+    AppMain(ar_task_ids, ar_imc_ids, d_imc_qs, d_process_qs, routes, mp_event).run()
 
 # Run child instance
-def run_child_process(ar_task_ids, ar_imc_ids, d_imc_qs, d_process_qs, mp_dict, mp_event):
+def run_child_process(ar_task_ids, ar_imc_ids, d_imc_qs, d_process_qs, routes, mp_event):
     # Run a separate instance of the main template code via multiprocessing
-    p = mp.Process(target=AppMain(ar_task_ids, ar_imc_ids, d_imc_qs, d_process_qs, mp_dict, mp_event).run)
+    p = mp.Process(target=AppMain(ar_task_ids, ar_imc_ids, d_imc_qs, d_process_qs, routes, mp_event).run)
     p.start()
 
 # =======================================================================================================
@@ -318,7 +296,7 @@ def main(config_path):
     q_imc = global_cfg['IMC']                   # Q's to talk to IMC server
     q_local_parent = global_cfg['PARENT']       # The children q pairs given to the parent
     q_local_children = global_cfg['CHILDREN']   # The parent q pair given to each child
-    mp_dict = global_cfg['DICT']                # The global dictionary for routing info
+    routes = global_cfg['ROUTES']               # The name of the shared routing table
     mp_event = global_cfg['EVENT']              # The global startup event
     # Split local procs
     # The local procs can contain one or more processes with its task list
@@ -337,11 +315,11 @@ def main(config_path):
     
     # The first process in the list should probably be the main process otherwise look for a specific name.
     # Start the main process via a thread.
-    t1 = threading.Thread(target=run_parent_process, args=(expanded_local_procs[0], remote_procs, q_imc, q_local_parent, mp_dict, mp_event))
+    t1 = threading.Thread(target=run_parent_process, args=(expanded_local_procs[0], remote_procs, q_imc, q_local_parent, routes, mp_event))
     t1.start()
     
     # Start any child processes via another thread.
-    t2 = threading.Thread(target=run_child_process, args=(expanded_local_procs[1], remote_procs, q_imc, q_local_children['CHILD'], mp_dict, mp_event))
+    t2 = threading.Thread(target=run_child_process, args=(expanded_local_procs[1], remote_procs, q_imc, q_local_children['CHILD'], routes, mp_event))
     t2.start()
     sleep(1)
     
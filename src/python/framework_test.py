@@ -29,12 +29,13 @@ import multiprocessing as mp
 import threading
 import queue
 from time import sleep
-from enum import Enum
 
 # Application imports
 from defs import *
 import framework_mgr
 import gen_server as gs
+import dispatch
+from dispatch import handles, ANY
 import pub_sub as ps
 import td_manager
 import routing
@@ -43,14 +44,12 @@ import imc_server
 
 # ====================================================================
 # Test code
-# NOTE: This code uses the match keyword as we are trying to emulate a
-# receive loop and pattern matching is by far the most elegant way.
-# However, this needs Python 3.10 which as of writing is pre-release.
-# You don't need pattern matching, it's just tidier.
+# NOTE: The dispatchers are dispatch.Dispatcher classes so each message tag has its own
+# handler method, found by a table lookup rather than matching every case in turn.
 
 class FrTest:
 
-    def __init__(self, ar_task_ids, ar_imc_ids, qs, mp_dict, mp_event):
+    def __init__(self, ar_task_ids, ar_imc_ids, qs, routes, mp_event):
         
         print("LOCAL ", ar_task_ids)
 
@@ -58,7 +57,7 @@ class FrTest:
         self.__tid = ar_task_ids
         self.__imc = ar_imc_ids
         self.__qs = qs
-        self.__mp_dict = mp_dict
+        self.__routes = routes
         self.__mp_event = mp_event
         
     # Entry point for process
@@ -69,7 +68,7 @@ class FrTest:
 
         # ======================================================
         # Perform process init
-        fm = framework_mgr.ProcessInit(self.__tid, self.__imc, self.__qs, self.__mp_dict)
+        fm = framework_mgr.ProcessInit(self.__tid, self.__imc, self.__qs, self.__routes)
         params = fm.start_of_day()
         td_man = params['TD']
         router = params['ROUTER']
@@ -80,29 +79,29 @@ class FrTest:
         
         # Following is test code as an example of usage
         # Make 2 gen-servers
-        self.__gs_inst.server_new(self.GS1, self.gs1_dispatch)
-        self.__gs_inst.server_new(self.GS2, self.gs2_dispatch)
+        self.__gs_inst.server_new(self.GS1, ServerDispatcher(self.__gs_inst, self.GS1, self.__name, self.GS2))
+        self.__gs_inst.server_new(self.GS2, ServerDispatcher(self.__gs_inst, self.GS2, self.__name, self.GS1))
         
         # Regiater our thread for our process
         q = queue.Queue()
-        self.__gs_inst.server_reg(self.__name, None, self.main_dispatch, q)
+        self.__gs_inst.server_reg(self.__name, None, MainDispatcher(self.__gs_inst, self.__name), q)
         
         # Wait for ready
         self.__mp_event.wait()
         
         # Send message to A and B from main thread
-        self.__gs_inst.server_msg(self.GS1, ["Message 1 to %s" % self.GS1])
-        self.__gs_inst.server_msg(self.GS2, ["Message 1 to %s" % self.GS2])
-        self.__gs_inst.server_msg(self.GS1, ["Message 2 to %s" % self.GS1])
-        self.__gs_inst.server_msg(self.GS2, ["Message 2 to %s" % self.GS2])
+        self.__gs_inst.server_msg(self.GS1, [["MSG", 1, self.__name]])
+        self.__gs_inst.server_msg(self.GS2, [["MSG", 1, self.__name]])
+        self.__gs_inst.server_msg(self.GS1, [["MSG", 2, self.__name]])
+        self.__gs_inst.server_msg(self.GS2, [["MSG", 2, self.__name]])
         
         # Try message to C
         if self.__name == "PARENT":
             # This is A and B servers so try a send to C
-            self.__gs_inst.server_msg("C", ["Interprocess to C from %s" % self.__name])
+            self.__gs_inst.server_msg("C", [["INTERPROCESS", 1, self.__name]])
         else:
             # This is B and C severs so try a send to A
-            self.__gs_inst.server_msg("A", ["Interprocess to A from %s" % self.__name])
+            self.__gs_inst.server_msg("A", [["INTERPROCESS", 1, self.__name]])
         
         # Retrieve messages for us
         msg = self.__gs_inst.server_msg_get(self.__name)
@@ -111,8 +110,8 @@ class FrTest:
             msg = self.__gs_inst.server_msg_get(self.__name)
         
         # Send message to A and B from main thread that require a response
-        self.__gs_inst.server_msg(self.GS1, [self.__name, "Message to %s expects response" % self.GS1])
-        self.__gs_inst.server_msg(self.GS2, [self.__name, "Message to %s expects response" % self.GS2])
+        self.__gs_inst.server_msg(self.GS1, [self.__name, ["REQUEST", 1, self.__name]])
+        self.__gs_inst.server_msg(self.GS2, [self.__name, ["REQUEST", 1, self.__name]])
         
         # Retrieve responses for us
         resp = self.__gs_inst.server_response_get(self.__name)
@@ -125,7 +124,7 @@ class FrTest:
         #ps.ps_subscribe( "GS2", "TOPIC-1")
         
         # Publish TOPIC-1
-        #ps.ps_publish( "TOPIC-1", "Publish to TOPIC-1" )
+        #ps.ps_publish( "TOPIC-1", ["TOPIC-1", 1, self.__name] )
         
         # Get topic list
         #print("Subscribers: ", ps.ps_list("TOPIC-1"))
@@ -136,108 +135,72 @@ class FrTest:
         #fwds.join()
         fm.end_of_day()
         self.__gs_inst.server_term_all()
-        
-    def main_dispatch(self, msg):
-        class MSGS(Enum):
-            MSG1 = "Message 1 to %s" % (self.__name)
-            MSG2 = "Message 2 to %s" % (self.__name)
-        match msg:
-            case [data]:
-                match data:
-                    case MSGS.MSG1.value:
-                        print("%s Message 1 ", (self.__name, data))
-                    case MSGS.MSG2.value:
-                        print("%s Message 2 ", (self.__name, data))
-            # Does message need a response
-            case [sender, data]:
-                print("%s [%s, %s] " % (self.__name, sender, data))
-                self.__gs_inst.server_response( sender, "Response to %s from %s" % (sender, self.__name) )
-            case _:
-                print("%s [unknown message %s]" % (self.__name, msg)) 
+
+
+# Dispatcher for the main thread
+# The data of each message is [tag, n, sender-task]
+class MainDispatcher(dispatch.Dispatcher):
     
-    def gs1_dispatch(self, msg):
-        class MSGS(Enum):
-            MSG1 = "Message 1 to %s" % (self.GS1)
-            MSG2 = "Message 2 to %s" % (self.GS1)
-            MSG3 = "Message to %s from %s[1]" % (self.GS1, self.GS2)
-            MSG4 = "Message to %s from %s[2]" % (self.GS1, self.GS2)
-        
-        match msg:
-            case "INIT":
-                print("INIT %s" % self.GS1)
-            case [data]:
-                match data:
-                    case MSGS.MSG1.value:
-                        print("%s - Message 1 [%s]" % (self.GS1, str(data)))
-                        self.__gs_inst.server_msg( self.__name, ["Message to %s from %s[1]" % (self.__name, self.GS1)] )
-                        self.__gs_inst.server_msg( self.GS2, ["Message to %s from %s[1]" % (self.GS2, self.GS1)] )
-                    case MSGS.MSG2.value:
-                        print("%s - Message 2 [%s]" % (self.GS1, str(data)))
-                        self.__gs_inst.server_msg( self.__name, ["Message to %s from %s[2]" % (self.__name, self.GS1)] )
-                        self.__gs_inst.server_msg( self.GS2, ["Message to %s from %s[2]" % (self.GS2, self.GS1)] )
-                    case MSGS.MSG3.value:
-                        print("%s-%s [1]" % (self.GS2, self.GS1))
-                    case "Interprocess to A from CHILD":
-                        print("Got - Interprocess to A from CHILD")
-                    case "Interprocess to C from PARENT":
-                        print("Got - Interprocess to C from PARENT")
-                    case MSGS.MSG4.value:
-                        print("%s-%s [2]" % (self.GS2, self.GS1))
-                    case "Publish to TOPIC-1":
-                        print("%s - Got TOPIC-1" % self.GS1)
-                    case _:
-                        print("%s [unknown message %s]" % (self.GS1, msg))
-            # Does message need a response
-            case [sender, data]:
-                print("%s [%s, %s] " % (self.GS1, sender, data))
-                self.__gs_inst.server_response( sender, ["Response to %s from %s" % (sender, self.GS1)] )
-            case _:
-                print("%s [unknown message %s]" % (self.GS1, msg)) 
+    def __init__(self, gs_inst, name):
+        self.__gs_inst = gs_inst
+        self.__name = name
+    
+    @handles("MSG")
+    def msg(self, data):
+        print("%s Message %d from %s" % (self.__name, data[1], data[2]))
+    
+    # Does message need a response
+    @handles(ANY, request=True)
+    def request(self, sender, data):
+        print("%s [%s, %s] " % (self.__name, sender, data))
+        self.__gs_inst.server_response( sender, "Response to %s from %s" % (sender, self.__name) )
+
+# Dispatcher for each gen-server
+class ServerDispatcher(dispatch.Dispatcher):
+    
+    def __init__(self, gs_inst, name, main, peer):
+        self.__gs_inst = gs_inst
+        self.__name = name
+        self.__main = main
+        self.__peer = peer
+    
+    @handles(INIT)
+    def init(self):
+        print("INIT %s" % self.__name)
+    
+    @handles("MSG")
+    def msg(self, data):
+        print("%s - Message %d [%s]" % (self.__name, data[1], str(data)))
+        self.__gs_inst.server_msg( self.__main, [["MSG", data[1], self.__name]] )
+        self.__gs_inst.server_msg( self.__peer, [["PEER", data[1], self.__name]] )
+    
+    @handles("PEER")
+    def peer(self, data):
+        print("%s-%s [%d]" % (data[2], self.__name, data[1]))
+    
+    @handles("INTERPROCESS")
+    def interprocess(self, data):
+        print("Got - Interprocess to %s from %s" % (self.__name, data[2]))
+    
+    @handles("TOPIC-1")
+    def topic_1(self, data):
+        print("%s - Got TOPIC-1" % self.__name)
     
-    def gs2_dispatch(self, msg):
-        class MSGS(Enum):
-            MSG1 = "Message 1 to %s" % (self.GS2)
-            MSG2 = "Message 2 to %s" % (self.GS2)
-            MSG3 = "Message to %s from %s[1]" % (self.GS2, self.GS1)
-            MSG4 = "Message to %s from %s[2]" % (self.GS2, self.GS1)
-            
-        match msg:
-            case "INIT":
-                print("INIT %s" % self.GS2)
-            case [data]:
-                match data:
-                    case MSGS.MSG1.value:
-                        print("%s Message 1 [%s]" % (self.GS2, str(data)))
-                        self.__gs_inst.server_msg( self.__name, ["Message to %s from %s[1]" % (self.__name, self.GS2)] )
-                        self.__gs_inst.server_msg( self.GS1, ["Message to %s from %s[1]" % (self.GS1, self.GS2)] )
-                    case MSGS.MSG2.value:
-                        print("%s Message 2 [%s]" % (self.GS2, str(data)))
-                        self.__gs_inst.server_msg( self.__name, ["Message to %s from %s[2]" % (self.__name, self.GS2)] )
-                        self.__gs_inst.server_msg( self.GS1, ["Message to %s from %s[2]" % (self.GS1, self.GS2)] )
-                    case MSGS.MSG3.value:
-                        print("%s-%s [1]" % (self.GS1, self.GS2))
-                    case MSGS.MSG4.value:
-                        print("%s-%s [2]" % (self.GS1, self.GS2))
-                    case "Publish to TOPIC-1":
-                        print("%s - Got TOPIC-1" % self.GS2)
-                    case _:
-                        print("%s [unknown message %s]" % (self.GS2, msg))
-            # Does message need a response
-            case [sender, data]:
-                print("%s [%s, %s] " % (self.GS2, sender, data))
-                self.__gs_inst.server_response( sender, ["Response to %s from %s" % (sender, self.GS2)] )
-            case _:
-                print("%s [unknown message %s]" % (self.GS2, msg))
+    # Does message need a response
+    @handles(ANY, request=True)
+    def request(self, sender, data):
+        print("%s [%s, %s] " % (self.__name, sender, data))
+        self.__gs_inst.server_response( sender, ["Response to %s from %s" % (sender, self.__name)] )
 
 # Run parent instance tests
-def run_parent_process(ar_task_ids, ar_imc_ids, d_process_qs, mp_dict, mp_event):
+def run_parent_process(ar_task_ids, ar_imc_ids, d_process_qs, routes, mp_event):
     # Kick off a test 
-    FrTest(ar_task_ids, ar_imc_ids, d_process_qs, mp_dict, mp_event).run()
+    FrTest(ar_task_ids, ar_imc_ids, d_process_qs, routes, mp_event).run()
 
 # Run child instance tests
-def run_child_process(ar_task_ids, ar_imc_ids, d_process_qs, mp_dict, mp_event):
+def run_child_process(ar_task_ids, ar_imc_ids, d_process_qs, routes, mp_event):
     # Kick off a test
-    p = mp.Process(target=FrTest(ar_task_ids, ar_imc_ids, d_process_qs, mp_dict, mp_event).run)
+    p = mp.Process(target=FrTest(ar_task_ids, ar_imc_ids, d_process_qs, routes, mp_event).run)
     p.start()
 
 def main():
@@ -249,7 +212,7 @@ def main():
     remote_procs = global_cfg[REMOTE]
     q_local_parent = global_cfg['PARENT']
     q_local_children = global_cfg['CHILDREN']
-    mp_dict = global_cfg['DICT']
+    routes = global_cfg['ROUTES']
     mp_event = global_cfg['EVENT']
     # Split local procs
     expanded_local_procs = []
@@ -259,11 +222,11 @@ def main():
     # ========================================================
     # Run processes, starting on their own thread
     # main process
-    t1 = threading.Thread(target=run_parent_process, args=(expanded_local_procs[0], remote_procs, q_local_parent, mp_dict, mp_event))
+    t1 = threading.Thread(target=run_parent_process, args=(expanded_local_procs[0], remote_procs, q_local_parent, routes, mp_event))
     t1.start()
     
     # and a child process
-    t2 = threading.Thread(target=run_child_process, args=(expanded_local_procs[1], remote_procs, q_local_children['CHILD'], mp_dict, mp_event))
+    t2 = threading.Thread(target=run_child_process, args=(expanded_local_procs[1], remote_procs, q_local_children['CHILD'], routes, mp_event))
     t2.start()
     sleep(1)
     
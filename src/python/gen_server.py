@@ -41,7 +41,20 @@
   
             gen_server_new( name, dispatcher )
 
+        Rather than a match statement the dispatcher can be an instance of a dispatch.Dispatcher subclass whose handler
+        methods are found by message tag in a table built when the class is defined, see dispatch.
+
+        A gen-server can be given a durable mailbox. Each message is kept in a journal file until it has been dispatched
+        and anything not dispatched when the process died is replayed when the server is next created with the same name
+        in the same process. The journal is committed in batches so this costs microseconds per message, see journal.
+        "INIT" is always dispatched before the replayed messages. Conflated values are not kept.
+
+            gen_server_new( name, dispatcher, durable=True )
+
         Ask the gen-server with task name 'name' or all servers to terminate. The server is designed to always allow proper termination.
+        A stop message goes to the head of each mailbox so an idle server wakes at once and a busy one stops after the message
+        in hand, anything still queued is not dispatched. All servers are told to stop before any is waited for so stopping
+        them all takes as long as the slowest message in hand, not the number of servers.
   
             gen_server_term( name )
             gen_server_term_all()
@@ -52,6 +65,51 @@
   
             gen_server_msg( name, [*] | [sender, *] )
         
+        A task name served by more than one process is a task group and the message goes to one instance chosen by the
+        group policy (see routing). For the hash policy the optional key chooses the instance. A particular instance is
+        addressed as task@process. A task which is a member of a group must give its own instance as the sender or the
+        response goes to any instance, gen_server_self() returns the name to use.
+        
+            gen_server_msg( name, [*] | [sender, *], key )
+            sender = gen_server_self( name )
+        
+        Send many messages in one call. Each distinct destination is resolved once and the messages are grouped per
+        destination mailbox or inter-process link, each group being queued as one batch which the receiver unpacks.
+        Order is preserved per destination.
+        
+            gen_server_msg_many( [[name, [*] | [sender, *]], ...] )
+        
+        Continuous blocks of samples are better sent on a stream channel which bypasses the message path, see stream.
+        
+        Send a message through a Slot. A slot holds at most one pending value. If the slot is still queued when a new value
+        is offered the value is replaced in place and nothing further is queued, so a slow receiver only ever sees the newest
+        value. The receiving dispatcher sees the value, not the slot. This is used by pub/sub for conflating topics.
+        Clearing the slot drops the pending value so nothing is dispatched when it comes out of the mailbox.
+
+            slot = Slot()
+            if slot.offer( [*] ):
+                gen_server_msg( name, slot )
+            slot.clear()
+
+        Make a request to a remote or local task without waiting for the response so many requests can be in
+        flight at once. The message is as for gen_server_msg() with the sender first. The sender must be a task in
+        this process, a task group member is answered at its own instance. The request id is returned. When the
+        receiver calls gen_server_response() the sender gets [REPLY, id, response] instead of the bare response. If no
+        response comes within the timeout in seconds the sender gets [TIMEOUT, id, None] and a late response is dropped.
+        No more than the 'requests' option of the link are outstanding to the processes at the other end of a REMOTE
+        link, any more are held and sent in turn.
+        The receiver needs no changes, the sender it sees is a ReplyTo, a string which carries the request id.
+        
+            id = gen_server_request( name, [sender, *], timeout )
+        
+        Send a message after a delay in seconds, or every interval seconds, as gen_server_msg() would then. All the timers
+        of a process share one thread, see timer. The timer reference can be used to cancel it, which returns False if
+        it has already fired and does not repeat.
+        
+            ref = gen_server_send_after( name, delay, [*] | [sender, *] )
+            ref = gen_server_send_interval( name, interval, [*] | [sender, *] )
+            gen_server_cancel_timer( ref )
+        
         Retrieve message for tasks that are not gen-servers. Returns the full content. Such tasks could be the main thread or threads that
         want to communicate in other ways but also use the message infrastructure (see registration). As these tasks are not gen-servers no
         message loop is executing so messages are not automatically dispatched. Calling gen_server_msg_get() on a periodic basis will cause
@@ -120,9 +178,22 @@
 # System imports
 import threading
 import queue
-from time import sleep
+import zlib
+import os
+import itertools
+import collections
+from time import sleep, perf_counter_ns
 
 # Application imports
+from defs import *
+import log
+import tracing
+import routing
+import journal
+import timer
+import envelope
+from envelope import Envelope
+import recorder as rec
 
 # ====================================================================
 # PUBLIC
@@ -130,40 +201,76 @@ from time import sleep
 
 class GenServer:
    
-    def __init__(self, td_man, router):
+    def __init__(self, td_man, router, metrics=None, tracer=None, profiler=None, journal_dir=JOURNAL_DIR, recorder=None):
         self.__router = router
         self.__td_man = td_man
+        # Optional metrics registry for this process
+        self.__metrics = metrics
+        # Optional message tracer for this process
+        self.__tracer = tracer
+        # Optional dispatcher profiler for this process
+        self.__profiler = profiler
+        # Round robin position per task group
+        self.__rr = {}
+        # The timers of this process
+        self.__timers = timer.TimerWheel()
+        # Requests waiting for a response
+        self.__requests = Requests(self, router, self.__timers)
+        # Where durable mailboxes keep their journals
+        self.__journal_dir = journal_dir
+        # Optional traffic recorder for this process
+        self.__recorder = recorder
 
-    def server_new(self, name, dispatcher):
+    def server_new(self, name, dispatcher, durable=False):
         
         # Assign a queue
-        q = queue.Queue()
+        if self.__metrics != None:
+            m = self.__metrics.server(name)
+        else:
+            m = None
+        if durable:
+            q = DurableMailbox(journal.Journal(self.__journal_path(name)), m)
+        else:
+            q = Mailbox(m)
         # Create a new thrd-server task
-        thrd_server = ThrdServer(name, self.__td_man, q)
+        thrd_server = ThrdServer(name, self.__td_man, q, m, self.__tracer, self.__profiler, self.__requests)
             
         # Add to the task registry
         self.__td_man.store_task_ref(name, [thrd_server, dispatcher, q])
-        # Start the gen-server loop
-        thrd_server.start()
-        # Initialise task
-        dispatcher("INIT")
+        if durable:
+            # Initialise before the replayed messages are dispatched
+            dispatcher(INIT)
+            thrd_server.start()
+        else:
+            # Start the gen-server loop
+            thrd_server.start()
+            # Initialise task
+            dispatcher(INIT)
         
     def server_term(self, name):
          item = self.__td_man.get_task_ref(name)
          if item != None:
-            t, d, q = item
-            t.terminate()
-            t.join()
+            self.__term([item])
             
     def server_term_all(self):
-        items = self.__td_man.get_all_ref()
-        for item in items:
-            t, d, q = item
-            if t != None:
-                t.terminate()
-                t.join()
-    
-    def server_msg(self, name, message):
+        self.__timers.stop()
+        self.__term(self.__td_man.get_all_ref())
+    
+    def server_msg(self, name, message, key=None):
+        if self.__recorder != None:
+            self.__recorder.record(rec.SEND, name, message)
+        # Sampled messages carry a trace header
+        if self.__tracer != None:
+            trace = self.__tracer.start()
+        else:
+            trace = None
+        env = self.__envelope(name, message, trace)
+        if '@' in name or self.__router.is_group(name):
+            # An instance of a task group
+            item, q, addr, env.dest = self.__resolve(name, key)
+            if q != None:
+                self.__put(q, env, item != None, addr)
+            return
         item = self.__td_man.get_task_ref(name)
         if item == None:
             # Get the associated q for the task
@@ -171,53 +278,134 @@ class GenServer:
             if q != None:
                 # Is this a remote target
                 if self.is_remote(name):
-                    ip, port = self.get_addr(name)
-                    msg = [name, [message, ip, port]]
+                    addr = self.get_addr(name)
                 else:
-                    msg = [name, message]
+                    addr = None
                 # Forward the message to the process q
-                q.put(msg)
+                self.__put(q, env, False, addr)
         else:
             # For this process
-            msg = [name, message]
             _, d, q = item
-            q.put(msg)
+            q.put(env)
+    
+    def server_msg_many(self, messages):
+        # Resolved destinations {name: (q, addr, local, registered-q)}
+        dests = {}
+        # Batches per q {id(q): [q, local, {addr: [[name, message], ...]}]}
+        batches = {}
+        for name, message in messages:
+            if self.__recorder != None:
+                self.__recorder.record(rec.SEND, name, message)
+            if name in dests:
+                q, addr, local, rq = dests[name]
+            elif '@' in name or self.__router.is_group(name):
+                # Task groups choose an instance per message
+                item, q, addr, name = self.__resolve(name)
+                local = item != None
+                rq = None
+                if local and not isinstance(item[0], ThrdServer):
+                    rq, q = q, None
+            else:
+                q, addr, rq = None, None, None
+                item = self.__td_man.get_task_ref(name)
+                local = item != None
+                if item == None:
+                    q = self.get_target(name)
+                    if q != None and self.is_remote(name):
+                        addr = tuple(self.get_addr(name))
+                elif isinstance(item[0], ThrdServer):
+                    q = item[2]
+                else:
+                    # Registered task, messages are retrieved individually
+                    rq = item[2]
+                dests[name] = (q, addr, local, rq)
+            if rq != None:
+                rq.put(Envelope(name, message))
+            if q == None:
+                continue
+            if id(q) not in batches:
+                batches[id(q)] = [q, local, {}]
+            by_addr = batches[id(q)][2]
+            if addr not in by_addr:
+                by_addr[addr] = []
+            by_addr[addr].append([name, message])
+        # One put per mailbox or link
+        for q, local, by_addr in batches.values():
+            for addr, batch in by_addr.items():
+                self.__put(q, Envelope(BATCH, batch), local, addr)
     
     def server_msg_get(self, name):
         item = self.__td_man.get_task_ref(name)
         if item != None:
             _, d, q = item
             try:
-                msg = q.get(block=True, timeout=0.1)
-                return msg
+                env = q.get(block=True, timeout=0.1)
+                if env.trace != None and self.__tracer != None:
+                    # Traced, complete the trace
+                    self.__tracer.complete(env.trace, 'get')
+                restore(env)
+                data = env.payload
+                if type(data) is Slot:
+                    # Conflated value, take the latest
+                    data = data.take()
+                    if data == None:
+                        # Cleared
+                        return None
+                if type(data) is Reply and not self.__requests.complete(data[1]):
+                    # Too late
+                    return None
+                return [env.dest, data]
             except queue.Empty:
                 return None
+    
+    def server_request(self, name, message, timeout=5.0):
+        return self.__requests.start(name, message, timeout)
+            
+    def server_send_after(self, name, delay, message):
+        return self.__timers.add(delay, self.server_msg, (name, message))
+    
+    def server_send_interval(self, name, interval, message):
+        return self.__timers.add(interval, self.server_msg, (name, message), interval)
+    
+    def server_cancel_timer(self, ref):
+        return self.__timers.cancel(ref)
             
     def server_response(self, name, response):
+        if type(name) is ReplyTo:
+            # The response to a request
+            response = Reply([REPLY, name.corr, response])
+            name = str(name)
         item = self.__td_man.get_task_ref(name)
         if item == None:
-            # Which process is the message destination
-            q = self.get_target(name)
-            if q != None:
-                # Forward the message to the process q
-                msg = [name, message]
-                q.put(msg)
+            # Another process, routed as any other message
+            self.server_msg(name, response)
         else:
             # Local dispatch
-            msg = [name, response]
+            if self.__recorder != None:
+                self.__recorder.record(rec.SEND, name, response)
             _, d, q = item
-            q.put(msg)
+            q.put(self.__envelope(name, response))
     
     def server_response_get(self, name):
         item = self.__td_man.get_task_ref(name)
         if item != None:
             _, d, q = item
             try:
-                msg = q.get(block=True, timeout=0.1)
-                return msg
+                env = q.get(block=True, timeout=0.1)
+                restore(env)
+                if type(env.payload) is Reply and not self.__requests.complete(env.payload[1]):
+                    # Too late
+                    return None
+                return [env.dest, env.payload]
             except queue.Empty:
                 return None
     
+    # The name to give as sender so responses come back to this instance
+    def server_self(self, name):
+        if self.__router.is_group(name):
+            return '%s@%s' % (name, self.__router.name())
+        return name
+    
     def server_reg(self, name, t, dispatcher, q):
         # Add to the task registry
         self.__td_man.store_task_ref(name, [t, dispatcher, q])
@@ -231,22 +419,18 @@ class GenServer:
         # The q can be a a queue.Queue or a multiprocessing.Queue
         # We don't care because the other end will know what to do.
         # Form is [process-name, [in_q, out_q]]
-        try:
-            process, (_, q) = self.__router.process_for_task(name)
-            if process != None:
-                if q != None:
-                    # We have a valid route on this machine
-                    return q 
-                else:
-                    # No q to send to
-                    print("GenServer - destination %s found but no associated queue!" % (name))
-                    return None
+        process, qs = self.__router.process_for_task(name)
+        if process != None:
+            if qs != None and qs[1] != None:
+                # We have a valid route on this machine
+                return qs[1]
             else:
-                # Process not known
-                print("GenServer - destination %s not found in router table!" % (name))
+                # No q to send to
+                log.error("GenServer - destination %s found but no associated queue!", name)
                 return None
-        except Exception as e:
-            print ('Failed to get route for task %s returned, process: %s, q: %s' % (name, process, q))
+        else:
+            # Process not known
+            log.error("GenServer - destination %s not found in router table!", name)
             return None
     
     def is_remote(self, name):
@@ -254,43 +438,414 @@ class GenServer:
         
     def get_addr(self, name):
         return self.__router.address_for_task(name)
+    
+    # ====================================================================
+    # PRIVATE
+    
+    # The envelope for a message, requests and responses have their metadata in the envelope
+    def __envelope(self, name, message, trace=None):
+        env = Envelope(name, message, trace=trace)
+        if type(message) is Reply:
+            env.corr = message[1]
+        elif type(message) is list and len(message) > 0 and type(message[0]) is ReplyTo:
+            env.sender = str(message[0])
+            env.corr = message[0].corr
+        return env
+    
+    # Queue an envelope, as it is for this process, encoded for another
+    # process and with the address as well for another machine
+    def __put(self, q, env, local, addr):
+        if local:
+            q.put(env)
+        elif addr == None:
+            q.put(env.encode())
+        else:
+            q.put([env.encode(), addr[0], addr[1]])
+    
+    # Stop all the tasks then wait for them
+    def __term(self, items):
+        items = [item for item in items if item[0] != None]
+        for t, d, q in items:
+            t.terminate()
+        for t, d, q in items:
+            t.join()
+            if isinstance(q, DurableMailbox):
+                q.close()
+    
+    # Journal file for a durable mailbox, qualified by process as groups share task names
+    def __journal_path(self, name):
+        os.makedirs(self.__journal_dir, exist_ok=True)
+        proc = self.__router.name()
+        if proc != None:
+            name = '%s@%s' % (name, proc)
+        return os.path.join(self.__journal_dir, '%s.journal' % (name))
+    
+    # Resolve a task group member or task@process to (item, q, addr, name)
+    # item is the task reference if the instance is in this process, addr is
+    # (ip, port) if it is on another machine and name is the name to send to
+    def __resolve(self, name, key=None):
+        task, _, proc = name.partition('@')
+        if proc == '':
+            proc = self.__pick(task, key)
+        if proc == self.__router.name():
+            item = self.__td_man.get_task_ref(task)
+            if item == None:
+                log.error("GenServer - destination %s not found in this process!", name)
+                return None, None, None, task
+            return item, item[2], None, task
+        desc, qs = self.__router.get_route(proc)
+        if desc == None or qs == None:
+            log.error("GenServer - destination %s not found in router table!", name)
+            return None, None, None, task
+        if self.__router.is_remote_process(proc):
+            # The remote IMC server needs the qualifier to find the instance
+            return None, qs[1], (desc[2], desc[4]), '%s@%s' % (task, proc)
+        if not self.__router.is_linked(proc):
+            # Relayed by other processes which need the qualifier
+            return None, qs[1], None, '%s@%s' % (task, proc)
+        return None, qs[1], None, task
+    
+    # Choose the instance of a task group to send to
+    def __pick(self, task, key):
+        procs = self.__router.instances(task)
+        policy = self.__router.group_policy(task)
+        if policy == routing.HASH and key != None:
+            # crc32 is the same in every process, hash() is not
+            return procs[zlib.crc32(str(key).encode()) % len(procs)]
+        n = self.__rr.get(task, 0)
+        self.__rr[task] = n + 1
+        if policy == routing.LEAST_QUEUE:
+            # Start from the round robin position so ties are shared out
+            order = procs[n % len(procs):] + procs[:n % len(procs)]
+            return min(order, key=lambda p: self.__depth(task, p))
+        return procs[n % len(procs)]
+    
+    # Messages queued towards an instance as seen from this process
+    # For another process this is the link to it, not its mailbox
+    def __depth(self, task, proc):
+        try:
+            if proc == self.__router.name():
+                item = self.__td_man.get_task_ref(task)
+                return item[2].qsize() if item != None else 0
+            _, qs = self.__router.get_route(proc)
+            return qs[1].qsize() if qs != None else 0
+        except NotImplementedError:
+            # multiprocessing queues have no size on some platforms
+            return 0
+
+# The sender of a request, a task name carrying the request id
+class ReplyTo(str):
+
+    def __new__(cls, name, corr):
+        s = super(ReplyTo, cls).__new__(cls, name)
+        s.corr = corr
+        return s
+
+    def __reduce__(self):
+        return (ReplyTo, (str(self), self.corr))
+
+# The response to a request [REPLY, request-id, response]
+class Reply(list):
+    pass
+
+# Requests made with gen_server_request() which are waiting for a response
+class Requests:
+
+    def __init__(self, gs_inst, router, timers):
+        self.__gs_inst = gs_inst
+        self.__router = router
+        # Timeouts are on the timer wheel of the process
+        self.__timers = timers
+        self.__ids = itertools.count(1)
+        self.__base = os.getpid() << 32
+        # {id: [sender, link, timer, sent]}
+        self.__pending = {}
+        # Requests outstanding and held per link {link: n} and {link: deque([id, name, message])}
+        self.__inflight = {}
+        self.__held = {}
+        self.__lock = threading.Lock()
+
+    # Send a request or hold it if the link has too many outstanding
+    def start(self, name, message, timeout):
+        corr = self.__base + next(self.__ids)
+        # A task group member is named by its instance so the reply comes back to this process
+        message = [ReplyTo(self.__gs_inst.server_self(message[0]), corr)] + list(message[1:])
+        link, window = self.__link(name)
+        with self.__lock:
+            send = window == None or self.__inflight.get(link, 0) < window
+            self.__pending[corr] = [str(message[0]), link, self.__timers.add(timeout, self.__expire, (corr,)), send]
+            if send:
+                self.__inflight[link] = self.__inflight.get(link, 0) + 1
+            else:
+                self.__held.setdefault(link, collections.deque()).append([corr, name, message])
+        if send:
+            self.__gs_inst.server_msg(name, message)
+        return corr
+
+    # A response has arrived, False if the request is not waiting
+    def complete(self, corr):
+        with self.__lock:
+            entry = self.__pending.pop(corr, None)
+            if entry == None:
+                return False
+            self.__timers.cancel(entry[2])
+            following = self.__release(entry)
+        if following != None:
+            self.__gs_inst.server_msg(following[1], following[2])
+        return True
+
+    # ====================================================================
+    # PRIVATE
+
+    # The link a request goes over and the most outstanding on it or None for no limit
+    def __link(self, name):
+        task, _, proc = name.partition('@')
+        if proc == '':
+            proc, _ = self.__router.process_for_task(task)
+        desc = self.__router.find_process(REMOTE, proc)
+        if desc == None or len(desc) < 6:
+            return proc, None
+        return proc, desc[5]['requests']
+
+    # Free the place of a finished request and return the next held request to send
+    def __release(self, entry):
+        if not entry[3]:
+            return None
+        link = entry[1]
+        self.__inflight[link] -= 1
+        held = self.__held.get(link)
+        while held != None and len(held) > 0:
+            following = held.popleft()
+            waiting = self.__pending.get(following[0])
+            if waiting != None:
+                waiting[3] = True
+                self.__inflight[link] += 1
+                return following
+        return None
+
+    # Time out a request, called on the timer thread
+    def __expire(self, corr):
+        with self.__lock:
+            entry = self.__pending.pop(corr, None)
+            if entry == None:
+                return
+            following = self.__release(entry)
+        if following != None:
+            self.__gs_inst.server_msg(following[1], following[2])
+        self.__gs_inst.server_msg(entry[0], [TIMEOUT, corr, None])
+
+# A single value mailbox slot
+# The slot itself is queued, not the value, so the value can be replaced
+# in place until the receiver takes it.
+class Slot:
+
+    __slots__ = ('__lock', '__value', '__pending')
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__value = None
+        self.__pending = False
+
+    # Set the value
+    # Returns True if the slot must be queued, False if it was already
+    # queued and the value has just been replaced
+    def offer(self, value):
+        with self.__lock:
+            self.__value = value
+            if self.__pending:
+                return False
+            self.__pending = True
+            return True
+
+    # Take the value and mark the slot as no longer queued
+    def take(self):
+        with self.__lock:
+            value = self.__value
+            self.__value = None
+            self.__pending = False
+            return value
+
+    # Drop the pending value, the slot is taken empty if it is still queued
+    def clear(self):
+        with self.__lock:
+            self.__value = None
         
 # ====================================================================
 # PRIVATE
 
+# The gen-server mailbox of envelopes
+# An urgent envelope goes ahead of everything waiting.
+# When metrics are given the mailbox counts messages in and records the time
+# each message spent queued. This is done under the queue mutex.
+class Mailbox(queue.Queue):
+    
+    def __init__(self, metrics=None):
+        super(Mailbox, self).__init__()
+        self.__m = metrics
+    
+    def _put(self, item):
+        if self.__m != None:
+            item.queued = perf_counter_ns()
+            if item.dest == BATCH:
+                self.__m.put(len(item.payload))
+            else:
+                self.__m.put()
+        if item.priority == envelope.URGENT:
+            self.queue.appendleft(item)
+        else:
+            self.queue.append(item)
+    
+    def _get(self):
+        item = self.queue.popleft()
+        if self.__m != None:
+            self.__m.latency.record(perf_counter_ns() - item.queued)
+        return item
+
+# A gen-server mailbox kept in a journal
+# Each message is appended as it is queued and acknowledged when the server calls
+# task_done() after dispatching it. Messages left in the journal are queued first.
+class DurableMailbox(Mailbox):
+    
+    def __init__(self, journal, metrics=None):
+        super(DurableMailbox, self).__init__(metrics)
+        self.__journal = journal
+        # Sequence numbers of the messages queued and of those taken and not yet done
+        # None for a message which is not in the journal
+        self.__seqs = collections.deque()
+        self.__taken = collections.deque()
+        for seq, data in journal.replay():
+            try:
+                item = envelope.decode(data)
+            except Exception as err:
+                # Written by an older release
+                log.error("DurableMailbox - dropped unreadable message %d, %s", seq, err)
+                journal.ack(seq)
+                continue
+            self.__seqs.append(seq)
+            Mailbox._put(self, item)
+            self.unfinished_tasks += 1
+    
+    def task_done(self):
+        super(DurableMailbox, self).task_done()
+        seq = self.__taken.popleft()
+        if seq != None:
+            self.__journal.ack(seq)
+    
+    def close(self):
+        self.__journal.close()
+    
+    def _put(self, item):
+        if item.priority == envelope.URGENT:
+            # Control messages are not kept
+            self.__seqs.appendleft(None)
+        else:
+            self.__seqs.append(self.__append(item))
+        super(DurableMailbox, self)._put(item)
+    
+    def _get(self):
+        self.__taken.append(self.__seqs.popleft())
+        return super(DurableMailbox, self)._get()
+    
+    def __append(self, item):
+        if type(item.payload) is Slot:
+            # Conflated, the value is not known until it is taken
+            return None
+        try:
+            return self.__journal.append(item.encode())
+        except Exception as err:
+            log.error("DurableMailbox - message for %s not journalled, %s", item.dest, err)
+            return None
+
 # The gen-server thread task
 class ThrdServer(threading.Thread):
     
-    def __init__(self, name, td_man, q):
+    def __init__(self, name, td_man, q, metrics=None, tracer=None, profiler=None, requests=None):
         super(ThrdServer, self).__init__()
         self.__name = name
         self.__td_man = td_man
         self.__q = q
-        self.__term = False
+        self.__m = metrics
+        self.__tracer = tracer
+        self.__profiler = profiler
+        self.__requests = requests
+        # Durable mailboxes need to know when a message is done with
+        self.__durable = isinstance(q, DurableMailbox)
         
     def terminate(self):
-        self.__term = True
+        # Wakes us if idle, else we stop after the message in hand
+        self.__q.put(Envelope(STOP, None, priority=envelope.URGENT))
         
     def run(self):
-        while not self.__term:
-            try:
-                item = self.__q.get(block=True, timeout=1)
-                # Process message
-                self.__process(item)
-            except queue.Empty:
-                continue
+        while True:
+            item = self.__q.get()
+            if item.dest == STOP:
+                self.__done()
+                break
+            # Process message
+            self.__process(item)
+            if self.__durable:
+                self.__q.task_done()
         print("GenServer %s terminating..." % (self.__name))
             
-    def __process(self, msg):
-        # A message is of this form but data is opaque to us
-        # [name, [*] | [sender, [*]]]
-        name, data = msg
+    def __process(self, env):
+        # The payload is opaque to us
+        if env.dest == BATCH:
+            # Unpack a batch
+            for name, data in env.payload:
+                self.__dispatch(name, data, None)
+            return
+        restore(env)
+        self.__dispatch(env.dest, env.payload, env.trace)
+    
+    def __dispatch(self, name, data, trace):
         # Lookup the destination
         item = self.__td_man.get_task_ref(name)
         if item == None:
             # No destination  
-            print("GenServer - destination %s not found!" % (name))
+            log.error("GenServer - destination %s not found!", name)
+            self.__done()
         else:
             # Dispatch
             _, d, q = item
-            d(data)  
+            if type(data) is Slot:
+                # Conflated value, take the latest
+                data = data.take()
+                if data == None:
+                    # Cleared while queued
+                    self.__done()
+                    return
+            if type(data) is Reply and self.__requests != None and not self.__requests.complete(data[1]):
+                # The request has timed out or already had a response
+                self.__done()
+                return
+            if trace != None:
+                tracing.stamp(trace, 'dispatch')
+            if self.__profiler != None:
+                call = self.__profiler.begin(name, data)
+            if self.__m == None:
+                d(data)
+            else:
+                t = perf_counter_ns()
+                d(data)
+                self.__m.run_time.record(perf_counter_ns() - t)
+                self.__m.done()
+            if self.__profiler != None:
+                self.__profiler.end(call)
+            if trace != None and self.__tracer != None:
+                self.__tracer.complete(trace)
+    
+    # Count a message out which was taken but not run, every message queued is counted in
+    def __done(self):
+        if self.__m != None:
+            self.__m.done()
+
+# Put back the request types from the envelope header
+# A request or response in the wire format comes as plain lists and strings
+def restore(env):
+    payload = env.payload
+    if env.corr == 0 or type(payload) is not list:
+        return
+    if len(payload) == 3 and payload[0] == REPLY:
+        env.payload = Reply(payload)
+    elif env.sender != None and len(payload) > 0 and payload[0] == env.sender and type(payload[0]) is not ReplyTo:
+        env.payload = [ReplyTo(env.sender, env.corr)] + payload[1:]
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+# gen_server_test.py
+#
+# Request and response tests
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import unittest
+import threading
+import queue
+import socket
+from time import sleep, monotonic
+
+# Application imports
+from defs import *
+import envelope
+from envelope import Envelope
+import gen_server as gs
+import testbed
+
+# ====================================================================
+# Test code
+# Run with 'python gen_server_test.py'. The servers are real, see testbed. PARENT has
+# the main thread registered as MAIN and the requester A, CHILD has the responder R
+# and both have an instance of the task group W. The test stands in for the remote
+# machine FAR with a socket on its port and answers in the wire format.
+
+# Longest to wait for a message
+WAIT = 2.0
+
+# Free ports for the IMC server and the stand-in
+def free_ports(n):
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(n)]
+    for s in socks:
+        s.bind(('127.0.0.1', 0))
+    ports = [s.getsockname()[1] for s in socks]
+    for s in socks:
+        s.close()
+    return ports
+
+# Records each message after INIT
+class Recorder:
+
+    def __init__(self):
+        self.got = []
+        self.cv = threading.Condition()
+
+    def dispatch(self, msg):
+        if msg == INIT:
+            return
+        with self.cv:
+            self.got.append(msg)
+            self.cv.notify_all()
+
+    # Wait for n messages in all
+    def wait(self, n):
+        end = monotonic() + WAIT
+        with self.cv:
+            while len(self.got) < n and monotonic() < end:
+                self.cv.wait(end - monotonic())
+            return len(self.got) >= n
+
+class Servers(unittest.TestCase):
+
+    def setUp(self):
+        self.port_in, self.port_out = free_ports(2)
+        self.far = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.far.bind(('127.0.0.1', self.port_out))
+        self.far.settimeout(WAIT)
+        self.bed = testbed.Testbed([['PARENT', ['MAIN', 'A', 'W']], ['CHILD', ['R', 'W', 'B']]],
+                                   remote=[['FAR', ['Z'], '127.0.0.1', self.port_in, self.port_out, 'requests=1,wire']])
+        self.gs = self.bed.gs('PARENT')
+        self.child = self.bed.gs('CHILD')
+        self.main = queue.Queue()
+        self.gs.server_reg('MAIN', None, None, self.main)
+        self.a = Recorder()
+        self.gs.server_new('A', self.a.dispatch)
+        self.w = {'PARENT': Recorder(), 'CHILD': Recorder()}
+        self.gs.server_new('W', self.w['PARENT'].dispatch)
+        self.child.server_new('W', self.w['CHILD'].dispatch)
+        self.b = Recorder()
+        self.child.server_new('B', self.b.dispatch)
+        # R answers at once with ['OK', data]
+        self.child.server_new('R', self.respond)
+
+    def tearDown(self):
+        self.bed.close()
+        self.far.close()
+
+    def respond(self, msg):
+        if msg != INIT:
+            self.child.server_response(msg[0], ['OK', msg[1]])
+
+    # The next request to reach the stand-in as (sender, id, data)
+    def far_request(self):
+        data = self.far.recv(65536)
+        self.assertTrue(envelope.is_wire(data))
+        env = envelope.decode(data)
+        return env.sender, env.corr, env.payload[1]
+
+    # Answer a request as a peer using the wire format would
+    def far_reply(self, sender, corr, response):
+        self.far.sendto(Envelope(sender, [REPLY, corr, response], corr=corr).encode(True), ('127.0.0.1', self.port_in))
+
+    def depth(self, proc, name):
+        return self.bed.params(proc)['METRICS'].server(name).depth.value
+
+    def test_reply_in_time(self):
+        corr = self.gs.server_request('R', ['A', 'PING'], timeout=0.2)
+        self.assertTrue(self.a.wait(1))
+        self.assertEqual(self.a.got, [[REPLY, corr, ['OK', 'PING']]])
+        self.assertEqual(type(self.a.got[0]), gs.Reply)
+        # Completed so there is no timeout to follow
+        sleep(0.4)
+        self.assertEqual(len(self.a.got), 1)
+
+    def test_late_reply(self):
+        corr = self.gs.server_request('Z', ['A', 'PING'], timeout=0.05)
+        sender, far_corr, data = self.far_request()
+        self.assertEqual((sender, far_corr, data), ('A', corr, 'PING'))
+        self.assertTrue(self.a.wait(1))
+        self.assertEqual(self.a.got, [[TIMEOUT, corr, None]])
+        self.far_reply(sender, corr, 'OK')
+        sleep(0.3)
+        # Dropped and not left in the mailbox depth
+        self.assertEqual(self.a.got, [[TIMEOUT, corr, None]])
+        self.assertEqual(self.depth('PARENT', 'A'), 0)
+
+    def test_timeout_races_reply(self):
+        # Timeouts about as long as the round trip to the other process
+        n = 200
+        corrs = []
+        for i in range(n):
+            corrs.append(self.gs.server_request('R', ['A', i], timeout=0.0005 + (i % 6) * 0.0005))
+            sleep(0.002)
+        self.assertTrue(self.a.wait(n))
+        sleep(0.2)
+        # Each request ends exactly once, either way
+        ends = {}
+        for tag, corr, response in self.a.got:
+            ends.setdefault(corr, []).append(tag)
+        self.assertEqual(sorted(ends.keys()), corrs)
+        for corr in corrs:
+            self.assertEqual(len(ends[corr]), 1, ends[corr])
+        self.assertEqual(self.depth('PARENT', 'A'), 0)
+
+    def test_group_requester(self):
+        # Answered at the instance which asked, not at any member of the group
+        corrs = [self.gs.server_request('R', ['W', i], timeout=1.0) for i in range(20)]
+        self.assertTrue(self.w['PARENT'].wait(20))
+        sleep(0.1)
+        self.assertEqual(self.w['PARENT'].got, [[REPLY, corr, ['OK', i]] for i, corr in enumerate(corrs)])
+        self.assertEqual(self.w['CHILD'].got, [])
+
+    def test_timeout_releases_held(self):
+        first = self.gs.server_request('Z', ['A', 'ONE'], timeout=0.1)
+        second = self.gs.server_request('Z', ['A', 'TWO'], timeout=WAIT)
+        # The second is held until the first is done with
+        self.assertEqual(self.far_request()[1:], (first, 'ONE'))
+        self.assertTrue(self.a.wait(1))
+        self.assertEqual(self.a.got, [[TIMEOUT, first, None]])
+        self.assertEqual(self.far_request()[1:], (second, 'TWO'))
+        # A late reply to the first does not free another place
+        self.far_reply('A', first, 'late')
+        third = self.gs.server_request('Z', ['A', 'THREE'], timeout=WAIT)
+        self.far.settimeout(0.3)
+        self.assertRaises(socket.timeout, self.far.recv, 65536)
+        self.far.settimeout(WAIT)
+        self.far_reply('A', second, 'OK')
+        self.assertTrue(self.a.wait(2))
+        self.assertEqual(self.a.got[1], [REPLY, second, 'OK'])
+        self.assertEqual(self.far_request()[1:], (third, 'THREE'))
+
+    def test_registered_batch(self):
+        self.gs.server_msg_many([['MAIN', [1]], ['A', [2]], ['MAIN', [3]], ['B', [4]], ['MAIN', [5]], ['B', [6]]])
+        got = []
+        msg = self.gs.server_msg_get('MAIN')
+        while msg != None:
+            got.append(msg)
+            msg = self.gs.server_msg_get('MAIN')
+        self.assertEqual(got, [['MAIN', [1]], ['MAIN', [3]], ['MAIN', [5]]])
+        self.assertTrue(self.b.wait(2))
+        self.assertEqual(self.a.got, [[2]])
+        self.assertEqual(self.b.got, [[4], [6]])
+
+    # A request from the main thread answered by a server in another process
+    def test_registered_request(self):
+        for get in [self.gs.server_msg_get, self.gs.server_response_get]:
+            corr = self.gs.server_request('R', ['MAIN', 'PING'], timeout=0.3)
+            msg = get('MAIN')
+            self.assertEqual(msg, ['MAIN', [REPLY, corr, ['OK', 'PING']]])
+            self.assertEqual(type(msg[1]), gs.Reply)
+            sleep(0.5)
+            self.assertEqual(get('MAIN'), None)
+
+    # A reply from a peer in another language comes in the wire format
+    def test_registered_wire_reply(self):
+        for get in [self.gs.server_msg_get, self.gs.server_response_get]:
+            corr = self.gs.server_request('Z', ['MAIN', 'PING'], timeout=0.3)
+            sender, _, _ = self.far_request()
+            self.far_reply(sender, corr, 'OK')
+            msg = get('MAIN')
+            self.assertEqual(msg, ['MAIN', [REPLY, corr, 'OK']])
+            self.assertEqual(type(msg[1]), gs.Reply)
+            sleep(0.5)
+            self.assertEqual(get('MAIN'), None)
+
+# Entry point
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# harness.py
+#
+# Processes and configuration shared by the benchmark and load harnesses
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    benchmark and loadgen both run the first LOCAL process of a configuration themselves, start the
+    other LOCAL processes as children and, when the REMOTE processes are on localhost, start a stand-in
+    topology for them from a mirror of the configuration so the real IMC path is used.
+
+    An agent is a child or stand-in process. It makes a handler for each of its tasks with
+    make(gs_inst, task), puts [READY, process] on the results queue and then calls
+    on_ctl(msg, process, handlers, params, results) for each message on its control queue until QUIT.
+    With an interval on_ctl is also called with msg None whenever the queue has been empty that long.
+    The params are those of ProcessInit.start_of_day(). make and on_ctl must be module level functions
+    so they can be given to a new process.
+
+    PUBLIC INTERFACE:
+
+    Run a child or the stand-in, as the target of a process.
+
+        run_agent( local, remote, imc_qs, local_qs, routes, results, ctl, make, on_ctl, interval=None )
+        run_standin( cfg_path, results, ctl, make, on_ctl, interval=None )
+
+    Write the configuration of the stand-in to a temporary file, returns its path.
+
+        path = mirror_config( local, remote, prefix )
+
+    The options of a REMOTE process in configuration form and whether a host is this machine.
+
+        ":reliable,window=128" = link_opts( desc )
+        is_loopback( host )
+"""
+
+# System imports
+import os
+import tempfile
+import multiprocessing as mp
+import queue
+
+# Application imports
+from defs import *
+import framework_mgr
+import link
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Result and control tags
+READY = "READY"
+QUIT = "QUIT"
+
+# Child process or stand-in process
+def run_agent(local, remote, imc_qs, local_qs, routes, results, ctl, make, on_ctl, interval=None):
+    fm = framework_mgr.ProcessInit(local, remote, imc_qs, local_qs, routes)
+    params = fm.start_of_day()
+    gs_inst = params['GS']
+    handlers = []
+    for task in local[1][1]:
+        handler = make(gs_inst, task)
+        handlers.append(handler)
+        gs_inst.server_new(task, handler.dispatch)
+    results.put([READY, local[1][0]])
+    while True:
+        try:
+            msg = ctl.get(timeout=interval)
+        except queue.Empty:
+            msg = None
+        if msg == QUIT:
+            break
+        on_ctl(msg, local[1][0], handlers, params, results)
+    fm.end_of_day()
+    gs_inst.server_term_all()
+
+# Stand-in for the remote machines with its own topology
+# Its first process runs here and the others are its children
+def run_standin(cfg_path, results, ctl, make, on_ctl, interval=None):
+    fm = framework_mgr.GlobalInit(cfg_path)
+    r, g = fm.start_of_day()
+    if not r:
+        results.put([READY, None])
+        return
+    children = []
+    for proc in g[LOCAL][1][1:]:
+        c = mp.Queue()
+        p = mp.Process(target=run_agent, args=([LOCAL, proc], g[REMOTE], g['IMC'], g['CHILDREN'][proc[0]], g['ROUTES'], results, c, make, on_ctl, interval))
+        p.start()
+        children.append((p, c))
+    run_agent([LOCAL, g[LOCAL][1][0]], g[REMOTE], g['IMC'], g['PARENT'], g['ROUTES'], results, ctl, make, on_ctl, interval)
+    for p, c in children:
+        c.put(QUIT)
+        p.join()
+    fm.end_of_day()
+
+# Write the configuration the remote machines would have
+# All our remote processes become its local processes and all our local
+# processes become its remote processes with the ports swapped
+def mirror_config(local, remote, prefix):
+    first = remote[1][0]
+    lines = ['[LOCAL]']
+    for desc in remote[1]:
+        lines.append('%s = %s' % (desc[0], ','.join(desc[1])))
+        if desc[3:5] != first[3:5]:
+            print('Stand-in uses the ports of %s for all remote processes' % first[0])
+    lines.append('[REMOTE]')
+    for proc in local[1]:
+        lines.append('%s = %s:%s,%d,%d' % (proc[0], ','.join(proc[1]), first[2], first[4], first[3]) + link_opts(first))
+    fd, path = tempfile.mkstemp(suffix='.cfg', prefix=prefix)
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+# The options of a REMOTE process in configuration form
+def link_opts(desc):
+    text = link.format_opts(desc[5])
+    return ':' + text if text != '' else ''
+
+def is_loopback(host):
+    return host == 'localhost' or host.startswith('127.')
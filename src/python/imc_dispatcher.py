@@ -27,11 +27,15 @@
 # System imports
 import threading
 import queue
-from time import sleep
 
 # Application imports
 from defs import *
+import log
 import td_manager
+import tracing
+import gen_server as gs
+import envelope
+from envelope import Envelope
 
 # ====================================================================
 # PUBLIC
@@ -40,39 +44,69 @@ import td_manager
 # The IMC dispatcher task
 class ImcDispatcher(threading.Thread):
     
-    def __init__(self, td_man, qs):
+    def __init__(self, td_man, qs, metrics=None):
         super(ImcDispatcher, self).__init__()
         self.__td_man = td_man
         self.__qs = qs
         self.__term = False
+        # Count of messages received
+        if metrics != None:
+            self.__count = metrics.counter('imc_disp.msgs_in')
+        else:
+            self.__count = None
         
     def terminate(self):
         self.__term = True
         
     def run(self):
-        while not self.__term:
-            # Monitor all output q's from the IMC Server
-            for (q, _) in self.__qs.values():
-                try:
-                    item = q.get(block=False)
-                    # Process message
-                    self.__process(item)
-                except queue.Empty:
-                    continue
-            sleep(0.05)
+        # Monitor all output q's from the IMC Server, a reader for each
+        readers = []
+        for (q, _) in self.__qs.values():
+            readers.append(threading.Thread(target=self.__read, args=(q,), daemon=True))
+        for r in readers:
+            r.start()
+        for r in readers:
+            r.join()
         print("ImcDispatcher terminating...")
+    
+    def __read(self, q):
+        while not self.__term:
+            try:
+                item = q.get(timeout=1)
+            except queue.Empty:
+                continue
+            if self.__count != None:
+                self.__count.inc()
+            # Process message
+            self.__process(item)
             
-    def __process(self, msg):
-        # A message is of this form but data is opaque to us
-        # [name, [*] | [sender, [*]]]
-        name, data = msg
+    def __process(self, data):
+        # The data is an encoded envelope, see envelope
+        # The envelope is handed to the mailbox of the destination and the
+        # gen-server dispatches it on its own thread
+        env = envelope.decode(data)
+        if env.trace != None:
+            tracing.stamp(env.trace, 'imc.disp')
+        if env.dest == BATCH:
+            # Unpack a batch into one batch per mailbox
+            batches = {}
+            for m in env.payload:
+                item = self.__td_man.get_task_ref(m[0])
+                if item == None:
+                    log.error("ImcDispatcher - destination %s not found!", m[0])
+                elif isinstance(item[0], gs.ThrdServer):
+                    if id(item[2]) not in batches:
+                        batches[id(item[2])] = [item[2], []]
+                    batches[id(item[2])][1].append(m)
+                else:
+                    # Registered task, messages are retrieved individually
+                    item[2].put(Envelope(m[0], m[1]))
+            for q, batch in batches.values():
+                q.put(Envelope(BATCH, batch))
+            return
         # Lookup the destination
-        item = self.__td_man.get_task_ref(name)
+        item = self.__td_man.get_task_ref(env.dest)
         if item == None:
-            # No destination so give to forward server
-            print("ImcDispatcher - destination %s not found!" % (name))
+            log.error("ImcDispatcher - destination %s not found!", env.dest)
         else:
-            # Dispatch
-            _, d, q = item
-            d(data)
-            
+            item[2].put(env)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# imc_proxy.py
+#
+# Lossy UDP proxy for testing the IMC link
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    A UDP proxy which loses, duplicates, delays and so reorders datagrams. It sits between two IMC
+    servers on one machine so the reliable link option can be tested without a bad network. It is also
+    run on a thread by link_test.
+
+    The proxy listens on one port, any free one if it is 0, and sends everything it receives to the
+    target. Each client gets its own socket towards the target and anything the target sends back to
+    that socket is returned to the client, so the acknowledgements of a reliable link also go through
+    the proxy and suffer the same treatment.
+
+    To put the proxy in the link from this machine to a remote process point the out-port of the
+    REMOTE entry at the proxy port and give the real port as the target, e.g.
+        DEVICE-A = E,F:localhost,10000,10050:reliable
+        python imc_proxy.py 10050 localhost:10001 --loss 0.1 --dup 0.02 --delay 0.01
+
+    Usage:
+        python imc_proxy.py <listen-port> <target-host:port> [--loss p] [--dup p]
+                            [--delay s] [--jitter s] [--seed n] [--duration s]
+"""
+
+# System imports
+import sys
+import argparse
+import socket
+import select
+import random
+import heapq
+from time import monotonic
+
+# Application imports
+from defs import *
+
+# Largest datagram
+MAX_DGRAM = 65507
+
+# ====================================================================
+# PUBLIC
+# API
+
+class LossyProxy:
+
+    def __init__(self, port, target, loss=0.0, dup=0.0, delay=0.0, jitter=0.0, seed=None):
+        self.__target = (socket.gethostbyname(target[0]), target[1])
+        self.__loss = loss
+        self.__dup = dup
+        self.__delay = delay
+        self.__jitter = jitter
+        self.__random = random.Random(seed)
+        self.__listen = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__listen.bind(('', port))
+        self.port = self.__listen.getsockname()[1]
+        # Client address to its socket towards the target and back
+        self.__upstream = {}
+        self.__clients = {}
+        # Datagrams waiting to go [(due, n, socket, data, addr), ...]
+        self.__pending = []
+        self.__n = 0
+        self.__term = False
+        # Totals
+        self.stats = {'in': 0, 'out': 0, 'lost': 0, 'duplicated': 0}
+
+    def terminate(self):
+        self.__term = True
+
+    def close(self):
+        for s in [self.__listen] + list(self.__clients):
+            s.close()
+
+    def run(self, duration=None):
+        end = None if duration == None else monotonic() + duration
+        while not self.__term and (end == None or monotonic() < end):
+            timeout = 0.05
+            if len(self.__pending) > 0:
+                timeout = max(0.0, min(timeout, self.__pending[0][0] - monotonic()))
+            r, _, _ = select.select([self.__listen] + list(self.__clients), [], [], timeout)
+            for s in r:
+                data, addr = s.recvfrom(MAX_DGRAM)
+                if s is self.__listen:
+                    self.__queue(self.__socket_for(addr), data, self.__target)
+                else:
+                    self.__queue(self.__listen, data, self.__clients[s])
+            now = monotonic()
+            while len(self.__pending) > 0 and self.__pending[0][0] <= now:
+                _, _, s, data, addr = heapq.heappop(self.__pending)
+                s.sendto(data, addr)
+                self.stats['out'] += 1
+
+    # ====================================================================
+    # PRIVATE
+
+    def __socket_for(self, client):
+        s = self.__upstream.get(client)
+        if s == None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.bind(('', 0))
+            self.__upstream[client] = s
+            self.__clients[s] = client
+        return s
+
+    def __queue(self, s, data, addr):
+        self.stats['in'] += 1
+        if self.__random.random() < self.__loss:
+            self.stats['lost'] += 1
+            return
+        copies = 1
+        if self.__random.random() < self.__dup:
+            self.stats['duplicated'] += 1
+            copies = 2
+        for _ in range(copies):
+            due = monotonic() + self.__delay + self.__random.uniform(0, self.__jitter)
+            self.__n += 1
+            heapq.heappush(self.__pending, (due, self.__n, s, data, addr))
+
+def address(s):
+    host, _, port = s.rpartition(':')
+    return (host, int(port))
+
+# =======================================================================================================
+# Entry point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lossy UDP proxy for the IMC link')
+    parser.add_argument('port', type=int, help='port to listen on')
+    parser.add_argument('target', type=address, help='host:port to send to')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability a datagram is lost')
+    parser.add_argument('--dup', type=float, default=0.0, help='probability a datagram is duplicated')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds added to every datagram')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds more at random, which reorders')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for a repeatable run')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to run for, default forever')
+    args = parser.parse_args()
+    proxy = LossyProxy(args.port, args.target, args.loss, args.dup, args.delay, args.jitter, args.seed)
+    try:
+        proxy.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    print('Proxy %s' % proxy.stats)
@@ -26,13 +26,28 @@
 # System imports
 import socket
 import select
-import pickle
 import multiprocessing as mp
-from time import sleep
+from time import monotonic
 
 # Application imports
 from defs import *
+import log
 import td_manager
+import metrics as mt
+import tracing
+import link
+import wire as wf
+import multicast
+import recorder as rec
+import envelope
+from envelope import Envelope
+
+# Largest datagram we send or receive
+MAX_DGRAM = 65507
+# Longest wait for received data before looking at the send q's
+POLL_TIME = 0.005
+# Messages allowed to wait on the q's to the local processes
+INBOUND_CAPACITY = 1000
 
 # ====================================================================
 # PUBLIC
@@ -41,71 +56,361 @@ import td_manager
 # The imc task
 class ImcServer():
     
-    def __init__(self, ports, queues, ctl_q):
+    def __init__(self, ports, queues, ctl_q, counters=None, tasks={}, links={}, capacity=INBOUND_CAPACITY, multicast_groups={}, record=None, sources={}):
         super(ImcServer, self).__init__()
         
         # ports - are a list of ports on which to listen
-        # queues - is a dictionary {proc_name: (in_q, out_q), ...}
+        # queues - is a dictionary {proc_name: (in_q, out_q), ...} for each local process
+        # tasks - is a dictionary {task_name: proc_name, ...} for each local task
+        # links - is a dictionary {(ip, port): opts, ...} of link options for remote addresses
+        # capacity - is the number of messages allowed to wait for the local processes
+        # multicast_groups - is a dictionary {topic-class: (group, port, iface), ...} of pub/sub multicast groups
+        # record - is the path of a log to record received messages to, see recorder
+        # sources - is a dictionary {(ip, port): listen-port, ...} of the port to send from to each remote address
         #
         # Process:
         #   is to listen on the given ports. If data is received it is sent on the output q
-        #       to the destination process. Message is [dest_proc, data].
+        #       to the process which has the destination task. Message is [task, data].
         #   is to monitor the input q where data will be of the form:
         #       ["192,168.1.200", 10000, [data to be dispatched]]
         #   we send the data message to the given end point.
+        #   Data to and from a reliable link is framed and acknowledged, see link.
+        #   Data for a remote address goes from the socket of its listen port so the far end
+        #   sees one source address for the link. ACKs go from the socket the data came in on.
+        #   Reliable senders are given credit for the room left on the q's to the local
+        #   processes. Plain datagrams which arrive when there is no room are dropped.
+        #   Pub/sub for topic classes with a multicast group is sent to the group, see multicast.
         
         self.__qs = queues
+        self.__tasks = tasks
         self.__ports = ports
         self.__ctl_q = ctl_q
+        self.__capacity = capacity
         self.__term = False
+        # Shared packet and byte counters, see metrics
+        self.__counters = counters
+        # The recorder is made in run() as the log is written from the IMC process
+        self.__record = record
+        self.__recorder = None
+        # Options for reliable links by resolved address
+        self.__links = {}
+        for (ip, port), opts in links.items():
+            if opts.get('reliable'):
+                self.__links[(socket.gethostbyname(ip), port)] = opts
+        # Compression for links which have it {addr: Compressor}
+        self.__compressors = {}
+        for (ip, port), opts in links.items():
+            if opts.get('compress', '') != '':
+                self.__compressors[(socket.gethostbyname(ip), port)] = link.Compressor(opts)
+        # Links which send the wire format rather than pickle
+        self.__wire = set()
+        for (ip, port), opts in links.items():
+            if opts.get('wire'):
+                self.__wire.add((socket.gethostbyname(ip), port))
+        # Link state {addr: Sender} and {addr: Receiver}, the socket each Receiver's data comes in on {addr: socket}
+        self.__senders = {}
+        self.__receivers = {}
+        self.__ack_sockets = {}
+        # Resolved addresses {ip: address}
+        self.__resolved = {}
+        # Multicast groups {topic-class: Group}, the local processes in each {topic-class: set(proc)}
+        # and the joined groups by socket {socket: Group}
+        self.__groups = {cls: multicast.Group(cls, *params) for cls, params in multicast_groups.items()}
+        self.__members = {}
+        self.__joined = {}
         
-        # Open and bind sockets
+        # Open and bind sockets {port: socket}
         self.__rlist = []
+        self.__sockets = {}
         for port in self.__ports:
             self.__s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.__rlist.append(self.__s)
             self.__s.bind(('', port))
+            self.__sockets[port] = self.__s
+        # The socket to send from for each remote address, anything else goes from the last bound
+        self.__source_sockets = {}
+        for (ip, port), source in sources.items():
+            if source in self.__sockets:
+                self.__source_sockets[(socket.gethostbyname(ip), port)] = self.__sockets[source]
         
     def terminate(self):
         self.__term = True
         
     def run(self):
+        if self.__record != None:
+            self.__recorder = rec.Recorder(self.__record)
         while not self.__term:
-            # Wait for remote data with zero timeout
-            r, w, x = select.select(self.__rlist,[], [], 0.0)
-            if len(r) > 0:
-                # Data available
-                for s in r:
-                    data, _ = s.recvfrom(512)
-                    # data is of the form [task, message]
-                    data = pickle.loads(data)
-                    #print('Got data from socket ', data)
-                    # Dispatch on the output q on all channels we have (there should only be one at present)
-                    # Someone needs to be listening on this q to dispatch the message to the correct task
-                    # TBD this should be in framework manager to listen and dispatch on a separate thread.
-                    for q in self.__qs.values():
-                        q[0].put(data)
-                        #print('Dispatched on q ', q[0])
-            else:
-                for q in self.__qs.values():
+            # Wait a short time for remote data
+            r, w, x = select.select(self.__rlist,[], [], POLL_TIME)
+            # Data available
+            for s in r:
+                if s in self.__joined:
+                    self.__mc_receive(self.__joined[s])
+                    continue
+                data, addr = s.recvfrom(MAX_DGRAM)
+                if self.__counters != None:
+                    self.__counters[mt.IMC_PKTS_IN] += 1
+                    self.__counters[mt.IMC_BYTES_IN] += len(data)
+                if link.is_frame(data):
+                    self.__on_frame(s, data, addr)
+                elif self.__free() > 0:
+                    self.__receive(data)
+                else:
+                    # No flow control on a plain link so all we can do is count it
+                    self.__count(mt.IMC_DROPPED, 1)
+            # Send everything waiting
+            for proc, q in self.__qs.items():
+                while True:
                     try:
                         data = q[1].get(block=False)
                     except Exception as err:
+                        break
+                    if data[0] == MCAST:
+                        self.__mc_request(proc, data[1])
                         continue
-                    # Data is of the form [task-name, [message, ip, port]]
-                    #print('Got data from q ', data)
-                    task_name, [message, ip, port] = data
-                    message = pickle.dumps([task_name, message])
+                    # Data is of the form [encoded-envelope, ip, port]
+                    data, ip, port = data
+                    if envelope.traced(data):
+                        env = envelope.decode(data)
+                        tracing.stamp(env.trace, 'imc.send')
+                        data = env.encode()
                     # Send message
-                    self.__s.sendto(message, (ip, port))
-                    #print('Sent data to ', ip, port)
+                    self.__send(data, (ip, port))
+            # Retransmit on reliable links and tell their senders when there is room again
+            if len(self.__senders) > 0:
+                self.__poll_links()
+            if len(self.__receivers) > 0:
+                credit = self.__credit()
+                for addr, receiver in self.__receivers.items():
+                    ack = receiver.update(credit)
+                    if ack != None:
+                        self.__sendto(ack, addr, self.__ack_sockets[addr])
             try:
                 data = self.__ctl_q.get(block=False)
                 if data =="QUIT":
                     break
             except Exception as err:
-                continue
-            sleep(0.05)
+                pass
+        self.close()
+        if self.__recorder != None:
+            self.__recorder.close()
         print("ImcServer terminating...")
+    
+    # Release the sockets
+    # Also called by the process which made the server once it is running in its own process
+    def close(self):
+        for s in self.__sockets.values():
+            s.close()
+        for group in self.__groups.values():
+            group.close()
 
-            
+    # Multicast requests from a local process [op, topic-class, item]
+    # op is 'join' or 'leave' a group or 'pub' to send item [topic, data, key] to it
+    def __mc_request(self, proc, request):
+        op, cls, item = request
+        group = self.__groups.get(cls)
+        if group == None:
+            log.error("ImcServer - no multicast group for %s!", cls)
+        elif op == 'join':
+            self.__members.setdefault(cls, set()).add(proc)
+            if group.socket() == None:
+                group.join()
+                self.__joined[group.socket()] = group
+                self.__rlist.append(group.socket())
+        elif op == 'leave':
+            self.__members.get(cls, set()).discard(proc)
+            if len(self.__members.get(cls, [])) == 0 and group.socket() != None:
+                self.__rlist.remove(group.socket())
+                del self.__joined[group.socket()]
+                group.leave()
+        elif op == 'pub':
+            # The datagram is the envelope the members are given
+            data = Envelope(MCAST, item).encode()
+            group.send(data)
+            self.__count(mt.IMC_MC_OUT, 1)
+            # Our own datagrams are ignored so give it to other local processes here
+            for member in self.__members.get(cls, []):
+                if member != proc:
+                    self.__qs[member][0].put(data)
+    
+    def __mc_receive(self, group):
+        gaps = group.gaps
+        payload = group.receive()
+        self.__count(mt.IMC_MC_GAPS, group.gaps - gaps)
+        if payload != None:
+            self.__count(mt.IMC_MC_IN, 1)
+            for member in self.__members.get(group.name(), []):
+                self.__qs[member][0].put(payload)
+    
+    # A plain datagram, an encoded envelope which may be compressed
+    def __receive(self, data):
+        data = link.unpack(data)
+        if envelope.traced(data):
+            env = envelope.decode(data)
+            tracing.stamp(env.trace, 'imc.recv')
+            data = env.encode()
+        # Dispatch on the q of the process that has the task
+        # The IMC dispatcher in that process passes it on to the task
+        self.__dispatch(data)
+    
+    # A reliable link frame, data for a Receiver or an ACK for a Sender
+    # The ACK goes back from the socket s the data came in on
+    def __on_frame(self, s, data, addr):
+        if not link.is_ack(data):
+            receiver = self.__receivers.get(addr)
+            if receiver == None:
+                receiver = link.Receiver()
+                self.__receivers[addr] = receiver
+            self.__ack_sockets[addr] = s
+            dups = receiver.duplicates
+            payloads, ack = receiver.on_data(data, self.__credit())
+            if ack != None:
+                self.__sendto(ack, addr, s)
+            self.__count(mt.IMC_DUPS, receiver.duplicates - dups)
+            for payload in payloads:
+                self.__receive(payload)
+        else:
+            sender = self.__senders.get(addr)
+            if sender != None:
+                retrans, stalls = sender.retransmits, sender.stalls
+                for frame in sender.on_ack(data, monotonic()):
+                    self.__sendto(frame, addr)
+                self.__count(mt.IMC_RETRANS, sender.retransmits - retrans)
+                self.__count(mt.IMC_STALLS, sender.stalls - stalls)
+    
+    def __poll_links(self):
+        now = monotonic()
+        for addr, sender in self.__senders.items():
+            retrans, expired = sender.retransmits, sender.expired
+            for frame in sender.poll(now):
+                self.__sendto(frame, addr)
+            self.__count(mt.IMC_RETRANS, sender.retransmits - retrans)
+            self.__count(mt.IMC_EXPIRED, sender.expired - expired)
+        if self.__counters != None:
+            self.__counters[mt.IMC_BACKLOG] = sum([sender.backlog() for sender in self.__senders.values()])
+    
+    # Room left on the q's to the local processes
+    def __free(self):
+        try:
+            return self.__capacity - sum([q[0].qsize() for q in self.__qs.values()])
+        except NotImplementedError:
+            # No q sizes on this platform so no flow control
+            return self.__capacity
+    
+    # The credit for each reliable sender, the room is shared between them
+    def __credit(self):
+        return max(self.__free(), 0) // max(len(self.__receivers), 1)
+    
+    def __count(self, idx, n):
+        if n > 0 and self.__counters != None:
+            self.__counters[idx] += n
+    
+    # Pass an encoded envelope to the process with the task, routed on the header
+    def __dispatch(self, data):
+        dest = envelope.peek(data)
+        if dest == BATCH:
+            # Split the batch by destination process
+            batches = {}
+            for name, payload in envelope.decode(data).payload:
+                if self.__recorder != None:
+                    self.__recorder.record(rec.IMC, name, payload)
+                proc, task = self.__route(name)
+                if proc != None:
+                    batches.setdefault(proc, []).append([task, payload])
+                else:
+                    log.error("ImcServer - destination %s not found!", name)
+            for proc, batch in batches.items():
+                self.__qs[proc][0].put(Envelope(BATCH, batch).encode())
+        else:
+            if self.__recorder != None:
+                env = envelope.decode(data)
+                self.__recorder.record(rec.IMC, env.dest, env.payload)
+            proc, task = self.__route(dest)
+            if proc != None:
+                if task != dest:
+                    data = envelope.retarget(data, task)
+                self.__qs[proc][0].put(data)
+            else:
+                log.error("ImcServer - destination %s not found!", dest)
+
+    # Find the local process and task name for a destination
+    # A name of the form task@process is for that instance of a task group,
+    # the qualifier is removed before the message is passed on
+    def __route(self, name):
+        if '@' in name:
+            task, _, proc = name.partition('@')
+            if proc in self.__qs:
+                return proc, task
+        return self.__tasks.get(name), name
+
+    # Send an encoded envelope
+    def __send(self, raw, addr):
+        addr = self.__resolve(addr)
+        if addr in self.__wire and not envelope.is_wire(raw):
+            raw = self.__to_wire(raw)
+        compressor = self.__compressors.get(addr)
+        if compressor != None:
+            data = self.__compress(compressor, raw)
+        else:
+            data = raw
+        sender = self.__sender_for(addr)
+        limit = MAX_DGRAM if sender == None else MAX_DGRAM - link.FRAME.size
+        batch = None
+        if len(data) > limit and envelope.peek(raw) == BATCH:
+            batch = envelope.decode(raw).payload
+        if batch != None and len(batch) > 1:
+            # Batch too large for one datagram so split it
+            half = len(batch)//2
+            self.__send(Envelope(BATCH, batch[:half]).encode(), addr)
+            self.__send(Envelope(BATCH, batch[half:]).encode(), addr)
+        elif sender == None:
+            self.__sendto(data, addr)
+        else:
+            stalls = sender.stalls
+            for frame in sender.send(data, monotonic()):
+                self.__sendto(frame, addr)
+            self.__count(mt.IMC_STALLS, sender.stalls - stalls)
+    
+    # Re-encode a pickled envelope in the wire format
+    # Anything the wire format can not hold goes pickled for a Python peer to read
+    def __to_wire(self, raw):
+        env = envelope.decode(raw)
+        try:
+            return env.encode(True)
+        except wf.WireError as err:
+            log.error("ImcServer - message for %s sent pickled, %s", env.dest, err)
+            return raw
+    
+    def __compress(self, compressor, data):
+        raw, wire, skipped = compressor.raw, compressor.wire, compressor.skipped
+        data = compressor.pack(data)
+        self.__count(mt.IMC_COMP_RAW, compressor.raw - raw)
+        self.__count(mt.IMC_COMP_WIRE, compressor.wire - wire)
+        self.__count(mt.IMC_COMP_SKIPPED, compressor.skipped - skipped)
+        return data
+    
+    # Send from the given socket, else the one for the address
+    def __sendto(self, data, addr, s=None):
+        if s == None:
+            s = self.__source_sockets.get(addr, self.__s)
+        s.sendto(data, addr)
+        if self.__counters != None:
+            self.__counters[mt.IMC_PKTS_OUT] += 1
+            self.__counters[mt.IMC_BYTES_OUT] += len(data)
+    
+    # The Sender for a reliable link or None
+    def __sender_for(self, addr):
+        sender = self.__senders.get(addr)
+        if sender == None and addr in self.__links:
+            opts = self.__links[addr]
+            sender = link.Sender(opts['window'], opts['rto_min'], opts['rto_max'], opts['retries'])
+            self.__senders[addr] = sender
+        return sender
+    
+    # Numeric form of an address so it matches the source of received data
+    def __resolve(self, addr):
+        ip = self.__resolved.get(addr[0])
+        if ip == None:
+            ip = socket.gethostbyname(addr[0])
+            self.__resolved[addr[0]] = ip
+        return (ip, addr[1])
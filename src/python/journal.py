@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#
+# journal.py
+#
+# Append-only message journal for durable gen-server mailboxes
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    A gen-server mailbox is in memory so everything queued when the process dies is lost. A journal
+    keeps the messages of a durable mailbox in a file until they have been dispatched so they can be
+    replayed when the process starts again.
+
+    The journal is an append-only file mapped into memory. Appending a message is a copy into the map
+    with no system call. Commit, the msync of the map, is done on a separate thread for everything
+    appended since the last commit when there are 'batch' messages or 'window' seconds after the first
+    of them, whichever is sooner. So a message costs a few microseconds and a crash of the machine loses
+    at most the last window. A crash of the process loses nothing as the pages are in the page cache.
+
+    The file is
+        header:  magic(2) version(2) head(8) seq(8)
+        records: length(4) crc(4) seq(8) payload
+    Head is the offset of the first message not yet acknowledged and seq is its sequence number.
+    Messages are acknowledged in order once dispatched which moves the head on. When everything is
+    acknowledged the journal starts again at the beginning of the file so a server which keeps up
+    uses the same few pages over and over. When the file is full the unacknowledged messages are moved
+    down if there is room below them, else the file is grown.
+
+    Replay reads records from the head while the sequence numbers follow on and the crc is good so a
+    record torn by a crash and anything left over from before the journal started again are ignored.
+    Delivery is at least once, a message dispatched just before a crash may be replayed.
+
+    PUBLIC INTERFACE:
+
+    Open or create the journal at path.
+
+        journal = Journal( path, batch=COMMIT_BATCH, window=COMMIT_WINDOW, size=INITIAL_SIZE )
+
+    The messages not acknowledged when the journal was opened as [[seq, message], ...].
+
+        journal.replay()
+
+    Append a message, which must pickle, and get its sequence number.
+
+        seq = journal.append( message )
+
+    Acknowledge all messages up to and including seq.
+
+        journal.ack( seq )
+
+    Wait until everything appended so far is committed.
+
+        journal.sync()
+
+    Commit and close.
+
+        journal.close()
+
+    Counts are kept in appended, acked, commits and replayed.
+"""
+
+# System imports
+import os
+import mmap
+import struct
+import pickle
+import zlib
+import threading
+import collections
+
+# Application imports
+from defs import *
+import log
+
+# ====================================================================
+# PUBLIC
+# API
+
+# File header and record header
+HEADER = struct.Struct('!2sHQQ')
+MAGIC = b'FJ'
+VERSION = 1
+RECORD = struct.Struct('!IIQ')
+# Commit after this many messages or this many seconds
+COMMIT_BATCH = 64
+COMMIT_WINDOW = 0.001
+# Initial file size
+INITIAL_SIZE = 1 << 20
+
+class Journal:
+
+    def __init__(self, path, batch=COMMIT_BATCH, window=COMMIT_WINDOW, size=INITIAL_SIZE):
+        self.__path = path
+        self.__batch = batch
+        self.__window = window
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = max(size, os.fstat(self.__fd).st_size)
+        os.ftruncate(self.__fd, size)
+        self.__mm = mmap.mmap(self.__fd, size)
+        magic, version, head, seq = HEADER.unpack_from(self.__mm, 0)
+        if magic == b'\x00\x00':
+            # A new journal
+            head, seq = HEADER.size, 0
+        elif magic != MAGIC or version != VERSION:
+            self.__mm.close()
+            os.close(self.__fd)
+            raise ValueError('%s is not a journal' % (path))
+        self.__head = head
+        self.__seq = seq
+        # Unacknowledged messages [(seq, end-offset), ...]
+        self.__live = collections.deque()
+        self.__records = self.__scan()
+        if len(self.__live) == 0:
+            self.__rewind()
+        # Totals
+        self.appended = 0
+        self.acked = 0
+        self.commits = 0
+        self.replayed = len(self.__records)
+        # Changes since the last commit and appends committed so far
+        self.__dirty = 0
+        self.__committed = 0
+        self.__closed = False
+        self.__cv = threading.Condition()
+        # Held while the map is in use by the commit thread or being replaced
+        self.__map_lock = threading.Lock()
+        self.__committer = threading.Thread(target=self.__commit_loop, daemon=True)
+        self.__committer.start()
+
+    def replay(self):
+        records, self.__records = self.__records, []
+        return records
+
+    def append(self, message):
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        need = RECORD.size + len(payload)
+        with self.__cv:
+            if self.__tail + need + RECORD.size > len(self.__mm):
+                self.__make_room(need)
+            seq = self.__next
+            end = self.__tail + need
+            RECORD.pack_into(self.__mm, self.__tail, len(payload), zlib.crc32(payload), seq)
+            self.__mm[self.__tail + RECORD.size:end] = payload
+            self.__live.append((seq, end))
+            self.__tail = end
+            self.__next += 1
+            self.appended += 1
+            self.__changed()
+        return seq
+
+    def ack(self, seq):
+        with self.__cv:
+            end = None
+            while len(self.__live) > 0 and self.__live[0][0] <= seq:
+                end = self.__live.popleft()[1]
+                self.acked += 1
+            if end == None:
+                return
+            if len(self.__live) == 0:
+                # Everything is done with
+                self.__rewind()
+            else:
+                self.__head = end
+                self.__seq = self.__live[0][0]
+                HEADER.pack_into(self.__mm, 0, MAGIC, VERSION, self.__head, self.__seq)
+            self.__changed()
+
+    def sync(self):
+        with self.__cv:
+            target = self.appended
+            while self.__committed < target and not self.__closed:
+                self.__cv.wait()
+
+    def close(self):
+        with self.__cv:
+            self.__closed = True
+            self.__cv.notify_all()
+        self.__committer.join()
+        with self.__map_lock:
+            self.__mm.flush()
+            self.__mm.close()
+        os.close(self.__fd)
+
+    # ====================================================================
+    # PRIVATE
+
+    # Find the unacknowledged records from the head
+    def __scan(self):
+        records = []
+        off, seq = self.__head, self.__seq
+        size = len(self.__mm)
+        while off + RECORD.size <= size:
+            length, crc, s = RECORD.unpack_from(self.__mm, off)
+            end = off + RECORD.size + length
+            if length == 0 or s != seq or end > size:
+                break
+            payload = self.__mm[off + RECORD.size:end]
+            if zlib.crc32(payload) != crc:
+                break
+            try:
+                message = pickle.loads(payload)
+            except Exception as err:
+                log.error("Journal - record %d in %s unreadable, %s", s, self.__path, err)
+                break
+            records.append([s, message])
+            self.__live.append((s, end))
+            off = end
+            seq += 1
+        self.__tail = off
+        self.__next = seq
+        return records
+
+    # Start again at the beginning of the file
+    def __rewind(self):
+        self.__head = self.__tail = HEADER.size
+        self.__seq = self.__next
+        RECORD.pack_into(self.__mm, HEADER.size, 0, 0, 0)
+        HEADER.pack_into(self.__mm, 0, MAGIC, VERSION, self.__head, self.__seq)
+
+    # Called with the condition held
+    def __changed(self):
+        self.__dirty += 1
+        if self.__dirty == 1 or self.__dirty >= self.__batch:
+            self.__cv.notify_all()
+
+    # Called with the condition held when a record of 'need' bytes does not fit
+    def __make_room(self, need):
+        start = HEADER.size
+        live = self.__tail - self.__head
+        with self.__map_lock:
+            if start + live <= self.__head and start + live + need + RECORD.size <= len(self.__mm):
+                # Move the unacknowledged records down. The old copy is left intact until the
+                # header points at the new one so a crash part way through loses nothing.
+                self.__mm.move(start, self.__head, live)
+                self.__mm.flush()
+                shift = self.__head - start
+                self.__live = collections.deque([(s, e - shift) for s, e in self.__live])
+                self.__head = start
+                self.__tail = start + live
+                HEADER.pack_into(self.__mm, 0, MAGIC, VERSION, self.__head, self.__seq)
+                self.__mm.flush()
+            else:
+                size = len(self.__mm)
+                while self.__tail + need + RECORD.size > size:
+                    size *= 2
+                self.__mm.close()
+                os.ftruncate(self.__fd, size)
+                self.__mm = mmap.mmap(self.__fd, size)
+
+    # Group commit
+    def __commit_loop(self):
+        while True:
+            with self.__cv:
+                while self.__dirty == 0 and not self.__closed:
+                    self.__cv.wait()
+                if self.__dirty == 0:
+                    return
+                if self.__dirty < self.__batch and not self.__closed:
+                    # Give the rest of the batch a chance to arrive
+                    self.__cv.wait(self.__window)
+                upto = self.appended
+                self.__dirty = 0
+            with self.__map_lock:
+                self.__mm.flush()
+            with self.__cv:
+                self.__committed = upto
+                self.commits += 1
+                self.__cv.notify_all()
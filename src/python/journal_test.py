@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# journal_test.py
+#
+# Journal and durable mailbox tests
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import unittest
+import os
+import shutil
+import tempfile
+
+# Application imports
+from defs import *
+import journal
+import envelope
+from envelope import Envelope
+import gen_server as gs
+
+# ====================================================================
+# Test code
+# Run with 'python journal_test.py'. Closing and opening again stands in for a
+# restart, a crash part way through a write is made by damaging the file.
+
+# Small so the file fills and records are moved down or the file grown
+SIZE = 4096
+
+class Base(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='journal_test')
+        self.path = os.path.join(self.dir, 'task.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return journal.Journal(self.path, size=SIZE)
+
+    # The offset of each record [[seq, offset, length], ...] from the header
+    def records(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        _, _, off, seq = journal.HEADER.unpack_from(data, 0)
+        found = []
+        while off + journal.RECORD.size <= len(data):
+            length, _, s = journal.RECORD.unpack_from(data, off)
+            if length == 0 or s != seq:
+                break
+            found.append([s, off, length])
+            off += journal.RECORD.size + length
+            seq += 1
+        return found
+
+    # Overwrite bytes of the file
+    def damage(self, offset, data):
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+class Replay(Base):
+
+    def test_empty(self):
+        j = self.open()
+        self.assertEqual(j.replay(), [])
+        j.close()
+
+    def test_partial_ack(self):
+        j = self.open()
+        seqs = [j.append(['MSG', i]) for i in range(10)]
+        j.ack(seqs[3])
+        j.close()
+        j = self.open()
+        self.assertEqual(j.replay(), [[seqs[i], ['MSG', i]] for i in range(4, 10)])
+        # Acknowledging part of the replay and appending follow on
+        j.ack(seqs[6])
+        seq = j.append(['MSG', 10])
+        self.assertEqual(seq, seqs[-1] + 1)
+        j.close()
+        j = self.open()
+        self.assertEqual(j.replay(), [[seqs[i], ['MSG', i]] for i in range(7, 10)] + [[seq, ['MSG', 10]]])
+        j.close()
+
+    def test_all_acked(self):
+        j = self.open()
+        for i in range(5):
+            seq = j.append(['OLD', i])
+        j.ack(seq)
+        # Starts again at the beginning over the old records
+        fresh = [j.append(['NEW', i]) for i in range(2)]
+        j.close()
+        j = self.open()
+        self.assertEqual(j.replay(), [[fresh[0], ['NEW', 0]], [fresh[1], ['NEW', 1]]])
+        j.close()
+
+    def test_torn_tail(self):
+        j = self.open()
+        seqs = [j.append(['MSG', i]) for i in range(5)]
+        j.close()
+        # The last record only part written, its payload never arrived
+        _, off, length = self.records()[-1]
+        self.damage(off + journal.RECORD.size, b'\x00' * length)
+        j = self.open()
+        self.assertEqual(j.replay(), [[seqs[i], ['MSG', i]] for i in range(4)])
+        # The torn record is written over
+        seq = j.append(['MSG', 'after'])
+        self.assertEqual(seq, seqs[4])
+        j.close()
+        j = self.open()
+        self.assertEqual(j.replay(), [[seqs[i], ['MSG', i]] for i in range(4)] + [[seq, ['MSG', 'after']]])
+        j.close()
+
+    def test_torn_header(self):
+        j = self.open()
+        seqs = [j.append(['MSG', i]) for i in range(3)]
+        j.close()
+        # The length of the last record written but not the rest of its header
+        _, off, _ = self.records()[-1]
+        self.damage(off + 4, b'\x00' * (journal.RECORD.size - 4))
+        j = self.open()
+        self.assertEqual(j.replay(), [[seqs[i], ['MSG', i]] for i in range(2)])
+        j.close()
+
+    def test_torn_after_partial_ack(self):
+        j = self.open()
+        seqs = [j.append(['MSG', i]) for i in range(6)]
+        j.ack(seqs[1])
+        j.close()
+        _, off, length = self.records()[-1]
+        self.damage(off + journal.RECORD.size + length - 1, b'\xff')
+        j = self.open()
+        self.assertEqual(j.replay(), [[seqs[i], ['MSG', i]] for i in range(2, 5)])
+        j.close()
+
+    def test_full(self):
+        # Enough to move records down and to grow the file
+        j = self.open()
+        seqs = []
+        for i in range(200):
+            seqs.append(j.append(['MSG', i, 'x' * 50]))
+            if i % 10 == 9 and i < 100:
+                j.ack(seqs[i - 5])
+        j.close()
+        j = self.open()
+        self.assertEqual([r[0] for r in j.replay()], seqs[95:])
+        j.close()
+
+class Mailbox(Base):
+
+    def mailbox(self):
+        return gs.DurableMailbox(self.open())
+
+    def test_replay_after_partial_done(self):
+        q = self.mailbox()
+        for i in range(6):
+            q.put(Envelope('task', ['MSG', i]))
+        # Two dispatched, the third taken and the process stops while dispatching it
+        for i in range(2):
+            q.get()
+            q.task_done()
+        self.assertEqual(q.get().payload, ['MSG', 2])
+        q.close()
+        q = self.mailbox()
+        self.assertEqual(q.qsize(), 4)
+        for i in range(2, 6):
+            env = q.get()
+            self.assertEqual(env.dest, 'task')
+            self.assertEqual(env.payload, ['MSG', i])
+            q.task_done()
+        q.close()
+        q = self.mailbox()
+        self.assertEqual(q.qsize(), 0)
+        q.close()
+
+    def test_urgent_not_kept(self):
+        q = self.mailbox()
+        for i in range(3):
+            q.put(Envelope('task', ['MSG', i]))
+        q.put(Envelope(STOP, None, priority=envelope.URGENT))
+        # The urgent one first and done with acknowledges nothing
+        self.assertEqual(q.get().dest, STOP)
+        q.task_done()
+        self.assertEqual(q.get().payload, ['MSG', 0])
+        q.task_done()
+        q.close()
+        q = self.mailbox()
+        self.assertEqual([q.get().payload for i in range(q.qsize())], [['MSG', 1], ['MSG', 2]])
+        q.close()
+
+    def test_torn_tail(self):
+        q = self.mailbox()
+        for i in range(4):
+            q.put(Envelope('task', ['MSG', i]))
+        q.get()
+        q.task_done()
+        q.close()
+        _, off, length = self.records()[-1]
+        self.damage(off + journal.RECORD.size + length // 2, b'\x00' * (length - length // 2))
+        q = self.mailbox()
+        self.assertEqual([q.get().payload for i in range(q.qsize())], [['MSG', 1], ['MSG', 2]])
+        q.close()
+
+# Entry point
+if __name__ == '__main__':
+    unittest.main()
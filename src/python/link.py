@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+#
+# link.py
+#
+# Reliable ordered delivery over the IMC datagram link
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    By default the IMC server sends each message as a single datagram and anything lost, duplicated or
+    reordered on the way goes unnoticed. A remote link can be made reliable in which case each datagram
+    is framed with a sequence number and acknowledged by the receiver.
+
+    The state is per link and per direction so a problem on one link never holds up another. A Sender
+    is kept for each destination address and a Receiver for each source address. Acknowledgements go back
+    to the address the data came from.
+
+    A frame is
+        magic(2) kind(1) session(4) seq(4) sack(4) credit(2) payload
+    For DATA the seq is the sequence number of the payload. For ACK the seq is the next sequence number
+    expected, so everything before it has been received, and bit n of sack is set if seq+1+n has also
+    been received. The credit is how many frames from seq on the receiver has room for. In DATA and FWD
+    frames the sack field is the floor instead, the oldest sequence number the Sender still has in flight.
+
+    The session is chosen at random by each Sender and does not change while it lives. Until its first
+    frame is acknowledged the Sender marks each frame SYN. A Receiver which already has a session only
+    starts again for a SYN frame of a session it has not seen before, so when the other end restarts the
+    Receiver follows but a late frame from a session it has finished with is ignored.
+
+    The Sender keeps at most 'window' frames unacknowledged and never sends beyond the credit given by
+    the receiver. Anything more is held until the window opens. When the receiver has given no credit the
+    Sender sends one held frame each retransmission timeout as a probe so a lost window update can not
+    stall the link for ever. The receiving end sends a window update when it has room again.
+    A frame is sent again if it is not acknowledged within the retransmission timeout, which follows the
+    measured round trip time, or sooner when later frames are acknowledged and it is not. After 'retries'
+    attempts the frame is dropped and counted as expired. The floor then moves past it and the Sender sends
+    FWD frames carrying the new floor until the Receiver acknowledges it, so the Receiver is not left
+    waiting. Sequence numbers are never reused within a session.
+
+    The Receiver passes payloads on in order, holds early ones until the gap is filled and drops
+    duplicates. When the floor moves past a gap the frames held beyond it are passed on, so order is kept
+    except around an expired frame. When the other end restarts the frames held from the old session are
+    passed on first.
+
+    Any link can also compress. A message is compressed with zlib or lzma if it is over the threshold
+    size and sent with a short header
+        magic(2) algorithm(1) compressed-message
+    so the receiver knows to decompress it whether or not it has compression configured. The Compressor
+    keeps a running average of the compressed to raw size. When that is above min_ratio compression is
+    not worth the time for this traffic so the next SKIP messages are sent as they are before trying again.
+
+    The requests option is the most requests from gen_server_request() which may be waiting for a
+    response from processes at the other end of the link, see gen_server.
+
+    The wire option sends the messages on the link in the language neutral wire format rather than
+    pickled so the other end need not be Python, see wire. Messages are read in either format whatever
+    the option.
+
+    PUBLIC INTERFACE:
+
+    Options for a link as given in the REMOTE section of the configuration.
+
+        opts = parse_opts( "reliable,window=64,rto_min=0.02,rto_max=2,retries=20" )
+        "reliable,window=128" = format_opts( opts )
+
+    Compression for a link, opts as above with compress, level, threshold and min_ratio. Counts are
+    kept in raw, wire and skipped.
+
+        compressor = Compressor( opts )
+        data = compressor.pack( data )
+        data = unpack( data )
+
+    True if a datagram is a link frame rather than a plain message, and if the frame is for a Sender.
+
+        is_frame( data )
+        is_ack( data )
+
+    The sending end. Each method returns the frames to put on the wire now.
+
+        sender = Sender( window=64, rto_min=0.02, rto_max=2.0, retries=20 )
+        [frame, ...] = sender.send( payload, now )
+        [frame, ...] = sender.on_ack( frame, now )
+        [frame, ...] = sender.poll( now )
+
+    The number of times the Sender has been held up by the receiver giving no credit is sender.stalls.
+
+    The receiving end returns the payloads now in order and the ACK frame to send back with the
+    credit to give. A window update ACK is returned by update() when the credit has grown from
+    nearly nothing, else None.
+
+        receiver = Receiver()
+        [payload, ...], ack = receiver.on_data( frame, credit )
+        ack | None = receiver.update( credit )
+"""
+
+# System imports
+import struct
+import random
+import collections
+import zlib
+import lzma
+
+# Application imports
+from defs import *
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Frame header
+FRAME = struct.Struct('!2sBIIIH')
+MAGIC = b'FL'
+DATA = 1
+ACK = 2
+FWD = 3
+# Set in the kind of the frames of a session not yet acknowledged
+SYN = 0x80
+
+# Sequence numbers are 32 bit on the wire
+SEQ_MOD = 1 << 32
+# Bits in the selective ACK
+SACK_BITS = 32
+# How far ahead of the next expected frame the Receiver will hold
+RECV_WINDOW = 4096
+# Largest credit that fits the frame
+MAX_CREDIT = 0xffff
+# Sessions a Receiver remembers having finished with
+RETIRED = 16
+
+# Compression header
+ZHEADER = struct.Struct('!2sB')
+ZMAGIC = b'FZ'
+ZLIB = 1
+LZMA = 2
+ALGORITHMS = {'zlib': ZLIB, 'lzma': LZMA}
+# Messages sent uncompressed when compression is not worth it
+SKIP = 32
+
+# Defaults for link options
+DEFAULTS = {'reliable': False, 'window': 64, 'rto_min': 0.02, 'rto_max': 2.0, 'retries': 20,
+            'compress': '', 'level': 6, 'threshold': 256, 'min_ratio': 0.9, 'requests': 256,
+            'wire': False}
+
+# Parse link options of the form "reliable,window=64,..." into a dict
+def parse_opts(text):
+    opts = dict(DEFAULTS)
+    for opt in text.split(','):
+        opt = opt.strip()
+        if opt == '':
+            continue
+        key, _, value = opt.partition('=')
+        key = key.strip()
+        if key not in DEFAULTS:
+            raise ValueError('Unknown link option %s' % key)
+        if value == '':
+            opts[key] = True
+        else:
+            opts[key] = type(DEFAULTS[key])(value.strip())
+    if opts['compress'] not in ['', *ALGORITHMS]:
+        raise ValueError('Unknown compression %s' % opts['compress'])
+    return opts
+
+# The configuration form of link options, those at their default are left out
+def format_opts(opts):
+    items = []
+    for key, value in opts.items():
+        if value != DEFAULTS.get(key):
+            items.append(key if value is True else '%s=%s' % (key, value))
+    return ','.join(items)
+
+def is_frame(data):
+    return data[:2] == MAGIC
+
+def is_ack(data):
+    return data[2] & ~SYN == ACK
+
+# Compression for one link
+class Compressor:
+
+    def __init__(self, opts):
+        self.__algorithm = ALGORITHMS[opts['compress']]
+        self.__level = opts['level']
+        self.__threshold = opts['threshold']
+        self.__min_ratio = opts['min_ratio']
+        # Running average of compressed/raw size
+        self.__ratio = None
+        # Messages left to send without trying to compress
+        self.__skip = 0
+        # Totals
+        self.raw = 0
+        self.wire = 0
+        self.skipped = 0
+
+    def pack(self, data):
+        if len(data) < self.__threshold:
+            return data
+        if self.__skip > 0:
+            self.__skip -= 1
+            self.skipped += 1
+            return data
+        if self.__algorithm == ZLIB:
+            packed = zlib.compress(data, self.__level)
+        else:
+            packed = lzma.compress(data, preset=self.__level)
+        ratio = (len(packed) + ZHEADER.size) / len(data)
+        self.__ratio = ratio if self.__ratio == None else 0.8 * self.__ratio + 0.2 * ratio
+        if self.__ratio > self.__min_ratio:
+            # Not worth it, leave it a while then look again
+            self.__skip = SKIP
+            self.__ratio = None
+        if ratio >= 1.0:
+            self.skipped += 1
+            return data
+        self.raw += len(data)
+        self.wire += len(packed) + ZHEADER.size
+        return ZHEADER.pack(ZMAGIC, self.__algorithm) + packed
+
+# Undo Compressor.pack, anything else is returned as it is
+def unpack(data):
+    if data[:2] != ZMAGIC:
+        return data
+    _, algorithm = ZHEADER.unpack_from(data)
+    if algorithm == ZLIB:
+        return zlib.decompress(data[ZHEADER.size:])
+    return lzma.decompress(data[ZHEADER.size:])
+
+# The sending end of a link
+class Sender:
+
+    def __init__(self, window=64, rto_min=0.02, rto_max=2.0, retries=20):
+        self.__window = window
+        self.__rto_min = rto_min
+        self.__rto_max = rto_max
+        self.__retries = retries
+        self.__session = random.getrandbits(32)
+        # Set when the receiver has acknowledged the session
+        self.__synced = False
+        # Next sequence number to use, the next the receiver expects
+        # and the oldest still in flight
+        self.__next = 0
+        self.__base = 0
+        self.__floor = 0
+        # Frames in flight {seq: [payload, sent-at, tries]}
+        self.__unacked = {}
+        # Payloads waiting for the window to open
+        self.__backlog = collections.deque()
+        # Frames before this sequence number may be sent, set by the receiver's credit
+        self.__limit = MAX_CREDIT
+        # When the last probe and the last FWD were sent
+        self.__probed = 0.0
+        self.__forwarded = 0.0
+        self.__stalled = False
+        # Round trip estimate, RFC 6298
+        self.__srtt = None
+        self.__rttvar = 0.0
+        self.__rto = 0.25
+        # Totals
+        self.retransmits = 0
+        self.expired = 0
+        self.stalls = 0
+
+    # Frames not yet acknowledged or not yet sent
+    def pending(self):
+        return len(self.__unacked) + len(self.__backlog)
+
+    # Frames held until the window opens
+    def backlog(self):
+        return len(self.__backlog)
+
+    def send(self, payload, now):
+        if len(self.__backlog) > 0 or not self.__open():
+            self.__backlog.append(payload)
+            self.__check_stall()
+            return []
+        return [self.__frame(payload, now)]
+
+    def on_ack(self, frame, now):
+        _, kind, session, cum, sack, credit = FRAME.unpack_from(frame)
+        if kind != ACK or session != self.__session:
+            return []
+        self.__synced = True
+        cum = unwrap(cum, self.__base)
+        self.__limit = cum + credit
+        # Everything before cum has been received
+        for seq in range(self.__base, min(cum, self.__next)):
+            self.__acked(seq, now)
+        self.__base = max(self.__base, min(cum, self.__next))
+        # Then the selectively acknowledged frames
+        highest = None
+        for n in range(SACK_BITS):
+            if sack & (1 << n):
+                highest = cum + 1 + n
+                self.__acked(highest, now)
+        frames = []
+        if highest != None:
+            # Frames below a later acknowledged one have probably been lost
+            # so resend them now unless they were sent less than a round trip ago
+            rtt = self.__srtt if self.__srtt != None else self.__rto
+            for seq in range(cum, highest):
+                entry = self.__unacked.get(seq)
+                if entry != None and entry[2] < self.__retries and now - entry[1] > rtt:
+                    frames.append(self.__resend(seq, entry, now))
+        # Open the window
+        while len(self.__backlog) > 0 and self.__open():
+            frames.append(self.__frame(self.__backlog.popleft(), now))
+        self.__check_stall()
+        return frames
+
+    # Resend any frame not acknowledged within the timeout
+    def poll(self, now):
+        due = [seq for seq in sorted(self.__unacked) if now - self.__unacked[seq][1] >= self.__timeout(self.__unacked[seq])]
+        expired = [seq for seq in due if self.__unacked[seq][2] >= self.__retries]
+        for seq in expired:
+            del self.__unacked[seq]
+        self.expired += len(expired)
+        frames = [self.__resend(seq, self.__unacked[seq], now) for seq in due if seq in self.__unacked]
+        if self.__base < self.__oldest() and (len(expired) > 0 or now - self.__forwarded >= self.__rto):
+            # The receiver is waiting for a frame given up so tell it to move on
+            self.__forwarded = now
+            frames.append(self.__header(FWD, self.__next))
+        if len(self.__backlog) > 0 and len(self.__unacked) == 0 and now - self.__probed >= self.__rto:
+            # No credit and nothing in flight to bring an ACK so probe
+            self.__probed = now
+            frames.append(self.__frame(self.__backlog.popleft(), now))
+        return frames
+
+    # ====================================================================
+    # PRIVATE
+
+    def __frame(self, payload, now):
+        seq = self.__next
+        self.__next += 1
+        self.__unacked[seq] = [payload, now, 1]
+        return self.__header(DATA, seq) + payload
+
+    def __header(self, kind, seq):
+        if not self.__synced:
+            kind |= SYN
+        return FRAME.pack(MAGIC, kind, self.__session, seq % SEQ_MOD, self.__oldest() % SEQ_MOD, 0)
+
+    # The oldest sequence number still in flight, else the next to use
+    def __oldest(self):
+        while self.__floor < self.__next and self.__floor not in self.__unacked:
+            self.__floor += 1
+        return self.__floor
+
+    # Is there room in the window and credit from the receiver
+    def __open(self):
+        return len(self.__unacked) < self.__window and self.__next < self.__limit
+
+    # Count each time the receiver's credit starts holding frames back
+    def __check_stall(self):
+        stalled = len(self.__backlog) > 0 and self.__next >= self.__limit
+        if stalled and not self.__stalled:
+            self.stalls += 1
+        self.__stalled = stalled
+
+    # Backed off timeout for a frame
+    def __timeout(self, entry):
+        return min(self.__rto * (1 << min(entry[2] - 1, 6)), self.__rto_max)
+
+    def __resend(self, seq, entry, now):
+        entry[1] = now
+        entry[2] += 1
+        self.retransmits += 1
+        return self.__header(DATA, seq) + entry[0]
+
+    def __acked(self, seq, now):
+        entry = self.__unacked.pop(seq, None)
+        if entry != None and entry[2] == 1:
+            # Only frames sent once give a true round trip (Karn)
+            self.__sample(now - entry[1])
+
+    def __sample(self, rtt):
+        if self.__srtt == None:
+            self.__srtt = rtt
+            self.__rttvar = rtt / 2
+        else:
+            self.__rttvar = 0.75 * self.__rttvar + 0.25 * abs(self.__srtt - rtt)
+            self.__srtt = 0.875 * self.__srtt + 0.125 * rtt
+        self.__rto = min(max(self.__srtt + 4 * self.__rttvar, self.__rto_min), self.__rto_max)
+
+# The receiving end of a link
+class Receiver:
+
+    def __init__(self):
+        self.__session = None
+        # Sessions finished with, their late frames are ignored
+        self.__retired = collections.deque(maxlen=RETIRED)
+        self.__expected = 0
+        # Frames received ahead of a gap {seq: payload}
+        self.__held = {}
+        # The credit last given
+        self.__credit = 0
+        # Totals
+        self.duplicates = 0
+
+    def on_data(self, frame, credit=RECV_WINDOW):
+        _, kind, session, seq, floor, _ = FRAME.unpack_from(frame)
+        syn = kind & SYN
+        kind &= ~SYN
+        if kind != DATA and kind != FWD:
+            return [], None
+        payloads = []
+        if session != self.__session:
+            if session in self.__retired or (self.__session != None and not syn):
+                # A late frame from before the other end started again
+                self.duplicates += 1
+                return [], None
+            if self.__session != None:
+                # The other end has started again, pass on what is held from before
+                payloads = [self.__held[n] for n in sorted(self.__held)]
+                self.__retired.append(self.__session)
+            self.__session = session
+            self.__expected = floor
+            self.__held = {}
+        floor = unwrap(floor, self.__expected)
+        if floor > self.__expected:
+            # The sender has given up the frames missing below the floor
+            for n in sorted([n for n in self.__held if n < floor]):
+                payloads.append(self.__held.pop(n))
+            self.__expected = floor
+        if kind == DATA:
+            seq = unwrap(seq, self.__expected)
+            if seq < self.__expected or seq in self.__held:
+                self.duplicates += 1
+            elif seq < self.__expected + RECV_WINDOW:
+                self.__held[seq] = frame[FRAME.size:]
+        while self.__expected in self.__held:
+            payloads.append(self.__held.pop(self.__expected))
+            self.__expected += 1
+        return payloads, self.__ack(credit)
+
+    # A window update if the credit has grown from nearly nothing
+    def update(self, credit):
+        if self.__session == None or self.__credit > SACK_BITS or credit <= self.__credit:
+            return None
+        return self.__ack(credit)
+
+    # ====================================================================
+    # PRIVATE
+
+    def __ack(self, credit):
+        sack = 0
+        for n in range(SACK_BITS):
+            if self.__expected + 1 + n in self.__held:
+                sack |= 1 << n
+        self.__credit = min(credit, RECV_WINDOW, MAX_CREDIT)
+        return FRAME.pack(MAGIC, ACK, self.__session, self.__expected % SEQ_MOD, sack, self.__credit)
+
+# Recover a full sequence number from its 32 bit form using a nearby reference
+def unwrap(seq, ref):
+    delta = (seq - ref) % SEQ_MOD
+    if delta >= SEQ_MOD // 2:
+        delta -= SEQ_MOD
+    return ref + delta
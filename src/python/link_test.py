@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# link_test.py
+#
+# Reliable link tests
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import unittest
+import socket
+import select
+import threading
+from time import monotonic
+
+# Application imports
+from defs import *
+import link
+from imc_proxy import LossyProxy
+
+# ====================================================================
+# Test code
+# Run with 'python link_test.py'. The Frames tests drive a Sender and
+# Receiver directly, the Proxy tests send through a LossyProxy on localhost.
+
+# Longest a proxy run may take
+DEADLINE = 30.0
+
+def payloads(prefix, n):
+    return [b'%s%d' % (prefix, i) for i in range(n)]
+
+class Frames(unittest.TestCase):
+
+    def test_in_order(self):
+        sender, receiver = link.Sender(), link.Receiver()
+        frames = [sender.send(p, 0.0)[0] for p in payloads(b'm', 5)]
+        out = []
+        for frame in reversed(frames):
+            got, ack = receiver.on_data(frame)
+            out += got
+            sender.on_ack(ack, 0.01)
+        self.assertEqual(out, payloads(b'm', 5))
+        self.assertEqual(sender.pending(), 0)
+
+    def test_late_frame_from_retired_session(self):
+        receiver = link.Receiver()
+        old = link.Sender()
+        old_frames = [old.send(p, 0.0)[0] for p in payloads(b'o', 11)]
+        out = []
+        for frame in old_frames[:10]:
+            out += receiver.on_data(frame)[0]
+        # The other end restarts and its new frames are acknowledged
+        new = link.Sender()
+        new_frames = [new.send(p, 1.0)[0] for p in payloads(b'n', 8)]
+        for frame in new_frames[:3] + new_frames[4:6]:
+            got, ack = receiver.on_data(frame)
+            out += got
+            new.on_ack(ack, 1.01)
+        # A late frame of the old session is ignored and does not reset the receiver
+        self.assertEqual(receiver.on_data(old_frames[10]), ([], None))
+        for frame in [new_frames[3]] + new_frames[6:]:
+            out += receiver.on_data(frame)[0]
+        self.assertEqual(out, payloads(b'o', 10) + payloads(b'n', 8))
+
+    def test_late_syn_frame_from_retired_session(self):
+        receiver = link.Receiver()
+        old, new = link.Sender(), link.Sender()
+        first = old.send(b'o0', 0.0)[0]
+        receiver.on_data(first)
+        receiver.on_data(new.send(b'n0', 0.0)[0])
+        # Still SYN as the old session was never acknowledged but it has been retired
+        self.assertEqual(receiver.on_data(first), ([], None))
+        self.assertEqual(receiver.on_data(new.send(b'n1', 0.0)[0])[0], [b'n1'])
+
+    def test_expired_frame_is_skipped(self):
+        sender, receiver = link.Sender(rto_min=0.01, retries=2), link.Receiver()
+        frames = [sender.send(p, 0.0)[0] for p in payloads(b'm', 4)]
+        out = []
+        # Frame 1 is always lost
+        for frame in frames[:1] + frames[2:]:
+            got, ack = receiver.on_data(frame)
+            out += got
+            sender.on_ack(ack, 0.001)
+        self.assertEqual(out, [b'm0'])
+        now = 0.0
+        while sender.pending() > 0:
+            now += 0.1
+            for frame in sender.poll(now):
+                if link.FRAME.unpack_from(frame)[3] == 1 and frame[2] & ~link.SYN == link.DATA:
+                    continue
+                got, ack = receiver.on_data(frame)
+                out += got
+                sender.on_ack(ack, now)
+            self.assertLess(now, 10.0)
+        self.assertEqual(sender.expired, 1)
+        self.assertEqual(out, [b'm0', b'm2', b'm3'])
+        # Nothing is left waiting and the link carries on
+        got, _ = receiver.on_data(sender.send(b'm4', now)[0])
+        self.assertEqual(got, [b'm4'])
+
+    def test_duplicates(self):
+        sender, receiver = link.Sender(), link.Receiver()
+        frame = sender.send(b'm0', 0.0)[0]
+        self.assertEqual(receiver.on_data(frame)[0], [b'm0'])
+        self.assertEqual(receiver.on_data(frame)[0], [])
+        self.assertEqual(receiver.duplicates, 1)
+
+class Proxy(unittest.TestCase):
+
+    def setUp(self):
+        # The sending end, the receiving end and a proxy between
+        self.a = self.socket()
+        self.b = self.socket()
+        self.proxy = None
+
+    def tearDown(self):
+        if self.proxy != None:
+            self.proxy.terminate()
+            self.thread.join()
+            self.proxy.close()
+        self.a.close()
+        self.b.close()
+
+    def socket(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('127.0.0.1', 0))
+        return s
+
+    def start_proxy(self, **kwargs):
+        self.proxy = LossyProxy(0, ('127.0.0.1', self.b.getsockname()[1]), **kwargs)
+        self.thread = threading.Thread(target=self.proxy.run, daemon=True)
+        self.thread.start()
+
+    # Run the link until done() or the deadline
+    def pump(self, sender, receiver, out, done):
+        to = ('127.0.0.1', self.proxy.port)
+        end = monotonic() + DEADLINE
+        while not done():
+            self.assertLess(monotonic(), end, 'link stalled')
+            r, _, _ = select.select([self.a, self.b], [], [], 0.002)
+            now = monotonic()
+            if self.b in r:
+                data, addr = self.b.recvfrom(65535)
+                got, ack = receiver.on_data(data)
+                out += got
+                if ack != None:
+                    self.b.sendto(ack, addr)
+            if self.a in r:
+                data, _ = self.a.recvfrom(65535)
+                for frame in sender.on_ack(data, now):
+                    self.a.sendto(frame, to)
+            for frame in sender.poll(now):
+                self.a.sendto(frame, to)
+
+    def send(self, sender, items):
+        to = ('127.0.0.1', self.proxy.port)
+        for item in items:
+            for frame in sender.send(item, monotonic()):
+                self.a.sendto(frame, to)
+
+    def test_exactly_once_in_order(self):
+        self.start_proxy(loss=0.3, dup=0.05, jitter=0.01, seed=1)
+        sender, receiver = link.Sender(rto_min=0.01, rto_max=0.5), link.Receiver()
+        items = payloads(b'm', 1000)
+        out = []
+        self.send(sender, items)
+        self.pump(sender, receiver, out, lambda: sender.pending() == 0 and len(out) >= len(items))
+        self.assertEqual(out, items)
+        self.assertEqual(sender.expired, 0)
+        self.assertGreater(sender.retransmits, 0)
+
+    def test_no_duplicates_when_frames_expire(self):
+        self.start_proxy(loss=0.3, dup=0.05, jitter=0.01, seed=2)
+        sender, receiver = link.Sender(rto_min=0.01, rto_max=0.5, retries=3), link.Receiver()
+        items = payloads(b'm', 1000)
+        out = []
+        self.send(sender, items)
+        self.pump(sender, receiver, out, lambda: sender.pending() == 0)
+        # Give the last FWD time to arrive
+        self.pump(sender, receiver, out, lambda: len(out) + sender.expired >= len(items))
+        self.assertGreater(sender.expired, 0)
+        self.assertEqual(len(out), len(set(out)))
+        self.assertEqual(out, [item for item in items if item in set(out)])
+        self.assertGreaterEqual(len(out), len(items) - sender.expired)
+
+    def test_restart(self):
+        self.start_proxy(loss=0.2, dup=0.05, jitter=0.05, seed=3)
+        receiver = link.Receiver()
+        out = []
+        # The first session is abandoned with frames still on the way
+        old = link.Sender(rto_min=0.01, rto_max=0.5)
+        self.send(old, payloads(b'o', 300))
+        self.pump(old, receiver, out, lambda: len(out) >= 100)
+        new = link.Sender(rto_min=0.01, rto_max=0.5)
+        items = payloads(b'n', 300)
+        self.send(new, items)
+        self.pump(new, receiver, out, lambda: new.pending() == 0 and len([p for p in out if p[:1] == b'n']) >= len(items))
+        first = out.index(b'n0')
+        self.assertEqual(out[first:], items)
+        # What was held from the old session when it was abandoned is passed on first, in order
+        old_seqs = [int(p[1:]) for p in out[:first]]
+        self.assertEqual(old_seqs, sorted(set(old_seqs)))
+        self.assertGreaterEqual(len(old_seqs), 100)
+
+# Entry point
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+#
+# loadgen.py
+#
+# Load generator and soak test harness
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Reproduces production load on one machine and records how the framework behaves over time.
+
+    The topology is read from a normal framework configuration file. The first LOCAL process runs
+    here and every other LOCAL process is started as a child. If the REMOTE processes are on localhost
+    a stand-in topology is started for them using a mirror of the configuration, so the real IMC path
+    is exercised. The first task of the first process is the generator. Every other task is a responder.
+
+    The generator sends a weighted mix of messages at a target rate, optionally ramped up over time to
+    find the saturation point. Message kinds are:
+        oneway  - small one way message to a task
+        large   - large payload one way message to a task
+        rr      - request to a task which responds to the generator
+        ps      - publish to a topic subscribed to by the responders in this process
+    Destinations are taken round robin from all the responders in the topology.
+
+    At every interval each process reports the messages it received, the latency of each kind, its
+    resident memory and the peak depth of its mailboxes, forwarder and IMC dispatcher counts. One line
+    is printed and one JSON record is appended to the output file. Requests not answered within the
+    timeout are counted as lost. One way loss is what was sent less what was received once in-flight
+    messages have had the timeout to arrive.
+
+    Usage:
+        python loadgen.py <config> [--duration s] [--rate n] [--ramp n] [--mix oneway=4,large=1,rr=4,ps=1]
+                                   [--large-size n] [--interval s] [--timeout s] [--out file] [--seed n]
+"""
+
+# System imports
+import os, sys
+import argparse
+import json
+import random
+import threading
+import multiprocessing as mp
+import queue
+from time import sleep, monotonic_ns, time
+
+# Application imports
+from defs import *
+import framework_mgr
+import metrics as mt
+import harness
+
+# Message tags
+LOAD_MSG = "LOAD-MSG"
+LOAD_REQ = "LOAD-REQ"
+LOAD_RESP = "LOAD-RESP"
+# Stats and control
+STATS = "STATS"
+# Pub/sub topic
+TOPIC = "LOAD"
+KINDS = ('oneway', 'large', 'rr', 'ps')
+
+# ====================================================================
+# Gen-server roles
+
+# Every task except the generator
+class Responder:
+
+    def __init__(self, gs_inst):
+        self.__gs_inst = gs_inst
+        self.__lock = threading.Lock()
+        # Cumulative counts and latency since the last report per kind
+        self.__counts = {k: 0 for k in KINDS}
+        self.__hists = {k: mt.Histogram() for k in KINDS}
+
+    def dispatch(self, msg):
+        if type(msg) is list and len(msg) == 1 and type(msg[0]) is list:
+            # Published, unwrap
+            msg = msg[0]
+        match msg:
+            case [LOAD_MSG, kind, t, _]:
+                self.__record(kind, monotonic_ns() - t)
+            case [sender, [LOAD_REQ, seq, t, _]]:
+                self.__record('rr', monotonic_ns() - t)
+                self.__gs_inst.server_msg(sender, [LOAD_RESP, seq, t])
+            case _:
+                pass
+
+    def stats(self):
+        with self.__lock:
+            hists = self.__hists
+            self.__hists = {k: mt.Histogram() for k in KINDS}
+            return dict(self.__counts), hists
+
+    def __record(self, kind, latency):
+        with self.__lock:
+            self.__counts[kind] += 1
+            self.__hists[kind].record(latency)
+
+# The generator task receives the responses
+class Collector:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # {seq: time sent}
+        self.__outstanding = {}
+        self.__answered = 0
+        self.__lost = 0
+        self.__hist = mt.Histogram()
+
+    def sent(self, seq, t):
+        with self.__lock:
+            self.__outstanding[seq] = t
+
+    def dispatch(self, msg):
+        match msg:
+            case [LOAD_RESP, seq, t]:
+                with self.__lock:
+                    if self.__outstanding.pop(seq, None) != None:
+                        self.__answered += 1
+                        self.__hist.record(monotonic_ns() - t)
+            case _:
+                pass
+
+    # Requests older than the timeout are lost
+    def expire(self, timeout):
+        limit = monotonic_ns() - int(timeout * 1e9)
+        with self.__lock:
+            old = [seq for seq, t in self.__outstanding.items() if t < limit]
+            for seq in old:
+                del self.__outstanding[seq]
+            self.__lost += len(old)
+
+    def stats(self):
+        with self.__lock:
+            hist = self.__hist
+            self.__hist = mt.Histogram()
+            return {'answered': self.__answered, 'lost': self.__lost, 'outstanding': len(self.__outstanding)}, hist
+
+# Sends the mix at the target rate on its own thread
+class Generator(threading.Thread):
+
+    def __init__(self, gs_inst, ps_inst, name, collector, targets, mix, rate, large_size, seed):
+        super(Generator, self).__init__()
+        self.__gs_inst = gs_inst
+        self.__ps_inst = ps_inst
+        self.__name = name
+        self.__collector = collector
+        self.__targets = targets
+        self.__rate = rate
+        self.__large = bytes(large_size)
+        self.__small = bytes(16)
+        self.__rnd = random.Random(seed)
+        self.__kinds = list(mix.keys())
+        self.__weights = list(mix.values())
+        self.__sent = {k: 0 for k in KINDS}
+        self.__term = False
+
+    def terminate(self):
+        self.__term = True
+
+    def add_rate(self, n):
+        self.__rate += n
+
+    def rate(self):
+        return self.__rate
+
+    def sent(self):
+        return dict(self.__sent)
+
+    def run(self):
+        seq = 0
+        target = 0
+        next_t = monotonic_ns()
+        while not self.__term:
+            kind = self.__rnd.choices(self.__kinds, self.__weights)[0]
+            dest = self.__targets[target % len(self.__targets)]
+            target += 1
+            t = monotonic_ns()
+            if kind == 'oneway':
+                self.__gs_inst.server_msg(dest, [LOAD_MSG, kind, t, self.__small])
+            elif kind == 'large':
+                self.__gs_inst.server_msg(dest, [LOAD_MSG, kind, t, self.__large])
+            elif kind == 'rr':
+                seq += 1
+                self.__collector.sent(seq, t)
+                self.__gs_inst.server_msg(dest, [self.__name, [LOAD_REQ, seq, t, self.__small]])
+            elif kind == 'ps':
+                self.__ps_inst.ps_publish(TOPIC, [LOAD_MSG, kind, t, self.__small])
+            self.__sent[kind] += 1
+            # Pace to the target rate
+            next_t += int(1e9 / self.__rate)
+            wait = next_t - monotonic_ns()
+            if wait > 0:
+                sleep(wait / 1e9)
+            elif wait < -1e9:
+                # More than a second behind, we are the bottleneck
+                next_t = monotonic_ns()
+
+# ====================================================================
+# Processes
+
+# Resident memory in kB
+def rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Stats for one process
+def process_stats(name, responders, metrics):
+    counts = {k: 0 for k in KINDS}
+    hists = {k: mt.Histogram() for k in KINDS}
+    for r in responders:
+        c, h = r.stats()
+        for k in KINDS:
+            counts[k] += c[k]
+            hists[k].merge(h[k])
+    snap = metrics.snapshot()
+    return [STATS, name, rss_kb(), counts, hists,
+            max([s['depth_peak'] for s in snap['servers'].values()] + [0]),
+            snap['counters']]
+
+# Every task of a child or stand-in process is a responder
+def make_responder(gs_inst, task):
+    return Responder(gs_inst)
+
+# Stats each interval
+def send_stats(msg, proc, responders, params, stats):
+    stats.put(process_stats(proc, responders, params['METRICS']))
+
+# ====================================================================
+# Reporting
+
+class Report:
+
+    def __init__(self, path, procs):
+        self.__path = path
+        self.__procs = procs
+        self.__start = time()
+        # Latest cumulative counts and stats per process
+        self.__latest = {}
+        self.__hists = {k: mt.Histogram() for k in KINDS}
+
+    def add(self, s):
+        _, name, rss, counts, hists, depth, counters = s
+        self.__latest[name] = {'rss_kb': rss, 'counts': counts, 'depth_peak': depth, 'counters': counters}
+        for k in KINDS:
+            self.__hists[k].merge(hists[k])
+
+    def write(self, gen, collector, n_subs, imc):
+        sent = gen.sent()
+        received = {k: sum(p['counts'][k] for p in self.__latest.values()) for k in KINDS}
+        rr, rr_hist = collector.stats()
+        expected = dict(sent)
+        expected['ps'] = sent['ps'] * n_subs
+        record = {'time': time(),
+                  'elapsed': time() - self.__start,
+                  'rate': gen.rate(),
+                  'sent': sent,
+                  'expected': expected,
+                  'received': received,
+                  'in_flight': {k: expected[k] - received[k] for k in KINDS},
+                  'rr': rr,
+                  'rr_latency_ns': rr_hist.snapshot(),
+                  'latency_ns': {k: self.__hists[k].snapshot() for k in KINDS},
+                  'processes': self.__latest,
+                  'imc': imc}
+        self.__hists = {k: mt.Histogram() for k in KINDS}
+        with open(self.__path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        print('%7.0fs rate %6d sent %8d recv %8d in-flight %7d rr lost %5d rr p99 %8.2fms rss %s' % (
+            record['elapsed'], gen.rate(), sum(sent.values()), sum(received.values()),
+            sum(record['in_flight'].values()), rr['lost'], record['rr_latency_ns']['p99'] / 1e6,
+            ','.join('%s=%dM' % (n, p['rss_kb'] // 1024) for n, p in sorted(self.__latest.items()))))
+        return record
+
+# =======================================================================================================
+# Main path code
+def main(args):
+
+    fm = framework_mgr.GlobalInit(args.config)
+    r, g = fm.start_of_day()
+    if not r:
+        return
+    local = g[LOCAL]
+    remote = g[REMOTE]
+    stats = mp.Queue()
+    agents = []
+    procs = []
+
+    # Child processes
+    for proc in local[1][1:]:
+        ctl = mp.Queue()
+        p = mp.Process(target=harness.run_agent, args=([LOCAL, proc], remote, g['IMC'], g['CHILDREN'][proc[0]], g['ROUTES'], stats, ctl,
+                                                       make_responder, send_stats, args.interval))
+        p.start()
+        agents.append((p, ctl))
+        procs.append(proc[0])
+    # Remote stand-in
+    standin_cfg = None
+    if remote != None and len(remote[1]) > 0:
+        if all(harness.is_loopback(desc[2]) for desc in remote[1]):
+            ctl = mp.Queue()
+            standin_cfg = harness.mirror_config(local, remote, 'framework_standin_')
+            p = mp.Process(target=harness.run_standin, args=(standin_cfg, stats, ctl, make_responder, send_stats, args.interval))
+            p.start()
+            agents.append((p, ctl))
+            procs.extend([desc[0] for desc in remote[1]])
+        else:
+            print('REMOTE processes are not on localhost so are not part of the load')
+
+    # This process
+    pfm = framework_mgr.ProcessInit([LOCAL, local[1][0]], remote, g['IMC'], g['PARENT'], g['ROUTES'])
+    params = pfm.start_of_day()
+    gs_inst = params['GS']
+    ps_inst = params['PS']
+    tasks = local[1][0][1]
+    name = tasks[0]
+    collector = Collector()
+    gs_inst.server_new(name, collector.dispatch)
+    responders = []
+    for task in tasks[1:]:
+        r = Responder(gs_inst)
+        responders.append(r)
+        gs_inst.server_new(task, r.dispatch)
+        ps_inst.ps_subscribe(task, TOPIC)
+
+    # Wait for the other processes
+    ready = 0
+    expected = len(local[1]) - 1 + (len(remote[1]) if standin_cfg != None else 0)
+    while ready < expected:
+        try:
+            s = stats.get(timeout=10)
+        except queue.Empty:
+            print('Timeout waiting for processes to start!')
+            break
+        if s[0] == harness.READY:
+            ready += 1
+    sleep(0.5)
+
+    # Destinations are all the responders
+    targets = list(tasks[1:])
+    for proc in local[1][1:]:
+        targets.extend(proc[1])
+    if standin_cfg != None:
+        for desc in remote[1]:
+            targets.extend(desc[1])
+    mix = dict(args.mix)
+    if len(responders) == 0:
+        mix.pop('ps', None)
+    if len(targets) == 0 or len(mix) == 0:
+        print('Nothing to send to!')
+        targets = []
+
+    report = Report(args.out, procs)
+    if len(targets) > 0:
+        gen = Generator(gs_inst, ps_inst, name, collector, targets, mix, args.rate, args.large_size, args.seed)
+        gen.start()
+        end = time() + args.duration
+        while time() < end:
+            sleep(args.interval)
+            collector.expire(args.timeout)
+            while True:
+                try:
+                    s = stats.get(block=False)
+                except queue.Empty:
+                    break
+                if s[0] == STATS:
+                    report.add(s)
+            report.add(process_stats(local[1][0][0], responders, params['METRICS']))
+            report.write(gen, collector, len(responders), fm.imc_metrics())
+            gen.add_rate(args.ramp)
+        gen.terminate()
+        gen.join()
+        # Give in-flight messages time to arrive and the processes time
+        # to report then take the final figures
+        sleep(max(args.timeout, args.interval))
+        collector.expire(args.timeout)
+        while True:
+            try:
+                s = stats.get(block=False)
+            except queue.Empty:
+                break
+            if s[0] == STATS:
+                report.add(s)
+        report.add(process_stats(local[1][0][0], responders, params['METRICS']))
+        final = report.write(gen, collector, len(responders), fm.imc_metrics())
+        print('Lost: %s' % {k: v for k, v in final['in_flight'].items()})
+
+    # Close down
+    for p, ctl in agents:
+        ctl.put(harness.QUIT)
+    for p, ctl in agents:
+        p.join()
+    pfm.end_of_day()
+    gs_inst.server_term_all()
+    fm.end_of_day()
+    if standin_cfg != None:
+        os.remove(standin_cfg)
+
+def parse_mix(s):
+    mix = {}
+    for item in s.split(','):
+        k, v = item.split('=')
+        if k not in KINDS:
+            raise argparse.ArgumentTypeError('unknown message kind %s' % k)
+        if float(v) > 0:
+            mix[k] = float(v)
+    return mix
+
+# =======================================================================================================
+# Entry point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Messaging framework load generator')
+    parser.add_argument('config', help='full path to configuration file')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds to run for')
+    parser.add_argument('--rate', type=float, default=100.0, help='messages per second')
+    parser.add_argument('--ramp', type=float, default=0.0, help='messages per second added every interval')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('oneway=4,large=1,rr=4,ps=1'), help='relative weights of each message kind')
+    parser.add_argument('--large-size', type=int, default=16384, help='large payload size in bytes')
+    parser.add_argument('--interval', type=float, default=10.0, help='seconds between reports')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a message is counted as lost')
+    parser.add_argument('--out', default='soak_results.jsonl', help='JSON lines results file')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the message mix')
+    args = parser.parse_args()
+    if not os.path.isfile(args.config):
+        print("Configuration file at %s does not exist!" % args.config)
+    else:
+        main(args)
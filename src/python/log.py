@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#
+# log.py
+#
+# Non-blocking framework logger
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    A print() on a message path writes to stdout there and then so a storm of misrouted messages is
+    throttled by the terminal. The logger only puts a record on a ring and a thread writes the records
+    out every FLUSH_INTERVAL seconds.
+
+    A record is (time, level, format, args). Formatting is done by the thread so the caller pays for the
+    level test and a tuple append to a deque, which is atomic and needs no lock. When the ring holds
+    RING_SIZE records further records are dropped, counted and reported when the ring is next written out.
+    The format string identifies the call site and no more than RATE records a second are written for each
+    one, the rest are counted and a line saying how many were suppressed is written when the second is over.
+
+    Each process has its own logger and thread, started with the first record. Records still on the ring
+    are written at exit. A process which ends with os._exit(), as multiprocessing children do, must call
+    flush() first, the framework manager does so at end of day.
+
+    PUBLIC INTERFACE:
+
+    Log at a level. The message is format % args.
+
+        log.debug( format, *args )
+        log.info( format, *args )
+        log.warning( format, *args )
+        log.error( format, *args )
+
+    Set the lowest level written, the records written per call site per second and the stream written to.
+
+        log.set_level( level )
+        log.set_rate( n )
+        log.set_output( stream )
+
+    Write out everything logged so far.
+
+        log.flush()
+
+    Counts of records {'logged', 'written', 'dropped', 'suppressed'}.
+
+        log.stats()
+"""
+
+# System imports
+import os
+import sys
+import threading
+import collections
+import atexit
+from time import time, sleep, strftime, localtime
+
+# Application imports
+from defs import *
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+# Records held before dropping
+RING_SIZE = 8192
+# Records written per call site per second
+RATE = 10
+# Seconds between writes
+FLUSH_INTERVAL = 0.05
+
+class Logger:
+
+    def __init__(self, level=INFO, size=RING_SIZE, rate=RATE, stream=None):
+        self.__level = level
+        self.__size = size
+        self.__rate = rate
+        self.__stream = stream
+        self.__ring = collections.deque()
+        # Per call site [second, count, suppressed] for rate limiting
+        self.__sites = {}
+        # Serialises writing between the thread and flush()
+        self.__write_lock = threading.Lock()
+        self.__thread = None
+        # Dropped records already reported
+        self.__reported = 0
+        # Totals
+        self.logged = 0
+        self.written = 0
+        self.dropped = 0
+        self.suppressed = 0
+
+    def debug(self, fmt, *args):
+        if self.__level <= DEBUG:
+            self.__put((time(), DEBUG, fmt, args))
+
+    def info(self, fmt, *args):
+        if self.__level <= INFO:
+            self.__put((time(), INFO, fmt, args))
+
+    def warning(self, fmt, *args):
+        if self.__level <= WARNING:
+            self.__put((time(), WARNING, fmt, args))
+
+    def error(self, fmt, *args):
+        if self.__level <= ERROR:
+            self.__put((time(), ERROR, fmt, args))
+
+    def set_level(self, level):
+        self.__level = level
+
+    def set_rate(self, n):
+        self.__rate = n
+
+    def set_output(self, stream):
+        self.__stream = stream
+
+    def flush(self):
+        self.__write(True)
+
+    def stats(self):
+        return {'logged': self.logged, 'written': self.written, 'dropped': self.dropped, 'suppressed': self.suppressed}
+
+    # Called in the child after a fork, the parent's thread does not exist here
+    def reset(self):
+        self.__ring = collections.deque()
+        self.__sites = {}
+        self.__write_lock = threading.Lock()
+        self.__thread = None
+
+    # ====================================================================
+    # PRIVATE
+
+    def __put(self, record):
+        if len(self.__ring) < self.__size:
+            self.__ring.append(record)
+            self.logged += 1
+        else:
+            self.dropped += 1
+        if self.__thread == None:
+            self.__start()
+
+    def __start(self):
+        with self.__write_lock:
+            if self.__thread == None:
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+
+    def __run(self):
+        while True:
+            sleep(FLUSH_INTERVAL)
+            self.__write(False)
+
+    # Write out the ring, at the end 'final' also writes the suppressed counts of the current second
+    def __write(self, final):
+        with self.__write_lock:
+            ring = self.__ring
+            sites = self.__sites
+            lines = []
+            while True:
+                try:
+                    t, level, fmt, args = ring.popleft()
+                except IndexError:
+                    break
+                second = int(t)
+                site = sites.get(fmt)
+                if site == None or site[0] != second:
+                    if site != None:
+                        self.__suppressed(lines, fmt, site)
+                    site = [second, 0, 0]
+                    sites[fmt] = site
+                site[1] += 1
+                if site[1] > self.__rate:
+                    site[2] += 1
+                    self.suppressed += 1
+                    continue
+                lines.append(self.__line(t, level, fmt, args))
+            # Report the call sites whose second is over
+            now = int(time())
+            for fmt in [fmt for fmt, site in sites.items() if final or site[0] < now]:
+                self.__suppressed(lines, fmt, sites.pop(fmt))
+            dropped = self.dropped
+            if dropped > self.__reported:
+                lines.append(self.__line(time(), WARNING, 'Log - %d records dropped, the ring was full', (dropped - self.__reported,)))
+                self.__reported = dropped
+            if len(lines) > 0:
+                stream = self.__stream if self.__stream != None else sys.stdout
+                try:
+                    stream.write(''.join(lines))
+                    stream.flush()
+                except Exception:
+                    # Nowhere left to report it
+                    pass
+                self.written += len(lines)
+
+    def __suppressed(self, lines, fmt, site):
+        if site[2] > 0:
+            lines.append(self.__line(site[0] + 1, WARNING, 'Log - %d more like [%s] suppressed', (site[2], fmt)))
+
+    def __line(self, t, level, fmt, args):
+        try:
+            msg = fmt % args if len(args) > 0 else fmt
+        except Exception as err:
+            msg = '%s %r [%s]' % (fmt, args, err)
+        return '%s.%03d %-7s %s\n' % (strftime('%H:%M:%S', localtime(t)), int(t * 1000) % 1000, NAMES.get(level, level), msg)
+
+# The logger of this process
+logger = Logger()
+debug = logger.debug
+info = logger.info
+warning = logger.warning
+error = logger.error
+set_level = logger.set_level
+set_rate = logger.set_rate
+set_output = logger.set_output
+flush = logger.flush
+stats = logger.stats
+atexit.register(logger.flush)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=logger.reset)
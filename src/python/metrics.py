@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+#
+# metrics.py
+#
+# Low overhead metrics for the messaging framework
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Each process has one MetricsRegistry which is created by the framework manager and
+    returned from ProcessInit.start_of_day() as 'METRICS'. The gen-servers, forwarder and
+    IMC dispatcher of the process record into it.
+
+    The hot path does no locking of its own. Gen-server metrics are updated inside the mailbox
+    queue which already holds its mutex, or on the gen-server's own thread. Counters shared
+    between threads are plain increments so may very occasionally lose a count under contention.
+
+    PUBLIC INTERFACE:
+
+    Get or create a named counter, gauge or histogram.
+
+        c = registry.counter( name )
+        g = registry.gauge( name )
+        h = registry.histogram( name )
+
+    Get or create the metrics for a gen-server. These hold the count of messages in to and out of
+    the mailbox, the current and peak mailbox depth, the enqueue to dispatch latency and the
+    dispatcher run time. Times are in nanoseconds.
+
+        m = registry.server( name )
+
+    Take a snapshot of everything as a dictionary.
+
+        {'servers': {name: {...}}, 'counters': {...}, 'gauges': {...}, 'histograms': {...},
+         'rates': {...}, 'interval': seconds} = registry.snapshot()
+
+    Rates are per second over the interval since the previous snapshot, or since the registry was
+    created for the first. They come from the change in each count and the monotonic time between the
+    two snapshots so nothing extra is done on the hot path. Each server has 'in_rate' and 'out_rate'
+    and 'rates' has an entry for each counter. Snapshots for rates should be taken by one caller.
+
+    Histograms are HDR style, log-linear with 16 sub-buckets per power of two. This gives a
+    worst case error of about 6% over a range of nanoseconds to hours at a fixed cost per record.
+
+        h.record( value )
+        {'count', 'mean', 'min', 'max', 'p50', 'p90', 'p99', 'p999'} = h.snapshot()
+        h.merge( other )
+
+    The IMC server runs in its own process so its counters are held in shared memory created by
+    GlobalInit and read with GlobalInit.imc_metrics().
+"""
+
+# System imports
+import threading
+import multiprocessing as mp
+from time import monotonic
+
+# Application imports
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Sub-bucket resolution, 2**(SUB_BITS-1) sub-buckets per power of two
+SUB_BITS = 5
+# Enough buckets for any 64 bit value
+N_BUCKETS = (64 - SUB_BITS + 2) << (SUB_BITS - 1)
+
+# IMC counter indexes into the shared array
+IMC_PKTS_IN = 0
+IMC_BYTES_IN = 1
+IMC_PKTS_OUT = 2
+IMC_BYTES_OUT = 3
+IMC_ERRORS = 4
+IMC_RETRANS = 5
+IMC_DUPS = 6
+IMC_EXPIRED = 7
+IMC_STALLS = 8
+IMC_DROPPED = 9
+IMC_BACKLOG = 10
+IMC_COMP_RAW = 11
+IMC_COMP_WIRE = 12
+IMC_COMP_SKIPPED = 13
+IMC_MC_OUT = 14
+IMC_MC_IN = 15
+IMC_MC_GAPS = 16
+IMC_COUNTERS = ('pkts_in', 'bytes_in', 'pkts_out', 'bytes_out', 'errors', 'retransmits', 'duplicates', 'expired',
+                'stalls', 'dropped', 'backlog', 'compress_raw', 'compress_wire', 'compress_skipped',
+                'mcast_out', 'mcast_in', 'mcast_gaps')
+
+class Counter:
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+class Gauge:
+
+    __slots__ = ('value', 'peak')
+
+    def __init__(self):
+        self.value = 0
+        self.peak = 0
+
+    def set(self, value):
+        self.value = value
+        if value > self.peak:
+            self.peak = value
+
+class Histogram:
+
+    __slots__ = ('__counts', '__count', '__total', '__min', '__max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.__counts = [0] * N_BUCKETS
+        self.__count = 0
+        self.__total = 0
+        self.__min = None
+        self.__max = 0
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        b = value.bit_length()
+        if b <= SUB_BITS:
+            self.__counts[value] += 1
+        else:
+            shift = b - SUB_BITS
+            self.__counts[(shift << (SUB_BITS - 1)) + (value >> shift)] += 1
+        self.__count += 1
+        self.__total += value
+        if value > self.__max:
+            self.__max = value
+        if self.__min == None or value < self.__min:
+            self.__min = value
+
+    # Add the counts from another histogram
+    def merge(self, other):
+        if other.__count == 0:
+            return
+        for idx, n in enumerate(other.__counts):
+            if n:
+                self.__counts[idx] += n
+        self.__count += other.__count
+        self.__total += other.__total
+        if other.__max > self.__max:
+            self.__max = other.__max
+        if self.__min == None or other.__min < self.__min:
+            self.__min = other.__min
+
+    # Value at percentile p (0-100)
+    def percentile(self, p):
+        if self.__count == 0:
+            return 0
+        target = self.__count * p / 100.0
+        acc = 0
+        for idx, n in enumerate(self.__counts):
+            if n:
+                acc += n
+                if acc >= target:
+                    return min(bucket_value(idx), self.__max)
+        return self.__max
+
+    def snapshot(self):
+        if self.__count == 0:
+            return {'count': 0, 'mean': 0, 'min': 0, 'max': 0, 'p50': 0, 'p90': 0, 'p99': 0, 'p999': 0}
+        return {'count': self.__count,
+                'mean': self.__total // self.__count,
+                'min': self.__min,
+                'max': self.__max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9)}
+
+# Lowest value held by a histogram bucket
+def bucket_value(idx):
+    if idx < (1 << SUB_BITS):
+        return idx
+    shift = (idx >> (SUB_BITS - 1)) - 1
+    return (idx - (shift << (SUB_BITS - 1))) << shift
+
+# Metrics for one gen-server
+class ServerMetrics:
+
+    __slots__ = ('msgs_in', 'msgs_out', 'depth', 'latency', 'run_time')
+
+    def __init__(self):
+        self.msgs_in = 0
+        self.msgs_out = 0
+        self.depth = Gauge()
+        self.latency = Histogram()
+        self.run_time = Histogram()
+
+    # Called from within the mailbox on put
+    def put(self, n=1):
+        self.msgs_in += n
+        self.depth.set(self.msgs_in - self.msgs_out)
+
+    # Called on the gen-server thread once dispatched
+    def done(self, n=1):
+        self.msgs_out += n
+        self.depth.value = self.msgs_in - self.msgs_out
+
+    def snapshot(self):
+        return {'msgs_in': self.msgs_in,
+                'msgs_out': self.msgs_out,
+                'depth': self.depth.value,
+                'depth_peak': self.depth.peak,
+                'latency': self.latency.snapshot(),
+                'run_time': self.run_time.snapshot()}
+
+class MetricsRegistry:
+
+    def __init__(self, clock=monotonic):
+        self.__servers = {}
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+        # Only taken when creating or taking a snapshot
+        self.__lock = threading.Lock()
+        # Counts at the previous snapshot for the rates {name: (msgs_in, msgs_out)} and {name: value}
+        self.__clock = clock
+        self.__last_time = clock()
+        self.__last_servers = {}
+        self.__last_counters = {}
+
+    def server(self, name):
+        return self.__get(self.__servers, name, ServerMetrics)
+
+    def counter(self, name):
+        return self.__get(self.__counters, name, Counter)
+
+    def gauge(self, name):
+        return self.__get(self.__gauges, name, Gauge)
+
+    def histogram(self, name):
+        return self.__get(self.__histograms, name, Histogram)
+
+    def snapshot(self):
+        with self.__lock:
+            now = self.__clock()
+            interval = now - self.__last_time
+            servers = {k: v.snapshot() for k, v in self.__servers.items()}
+            counters = {k: v.value for k, v in self.__counters.items()}
+            last_servers = {}
+            for k, v in servers.items():
+                msgs_in, msgs_out = self.__last_servers.get(k, (0, 0))
+                v['in_rate'] = self.__rate(v['msgs_in'] - msgs_in, interval)
+                v['out_rate'] = self.__rate(v['msgs_out'] - msgs_out, interval)
+                last_servers[k] = (v['msgs_in'], v['msgs_out'])
+            rates = {k: self.__rate(v - self.__last_counters.get(k, 0), interval) for k, v in counters.items()}
+            self.__last_time = now
+            self.__last_servers = last_servers
+            self.__last_counters = counters
+            return {'servers': servers,
+                    'counters': dict(counters),
+                    'gauges': {k: {'value': v.value, 'peak': v.peak} for k, v in self.__gauges.items()},
+                    'histograms': {k: v.snapshot() for k, v in self.__histograms.items()},
+                    'rates': rates,
+                    'interval': interval}
+
+    # ====================================================================
+    # PRIVATE
+
+    # Per second, nothing if no time has passed
+    def __rate(self, delta, interval):
+        if interval <= 0:
+            return 0.0
+        return delta / interval
+
+    def __get(self, d, name, cls):
+        m = d.get(name)
+        if m == None:
+            with self.__lock:
+                m = d.get(name)
+                if m == None:
+                    m = cls()
+                    d[name] = m
+        return m
+
+# Shared counters for the IMC server process
+def imc_counters():
+    return mp.Array('Q', len(IMC_COUNTERS), lock=False)
+
+def imc_snapshot(counters):
+    return {name: counters[idx] for idx, name in enumerate(IMC_COUNTERS)}
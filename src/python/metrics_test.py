@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# metrics_test.py
+#
+# Metrics tests
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import unittest
+
+# Application imports
+from defs import *
+import metrics as mt
+
+# ====================================================================
+# Test code
+# Run with 'python metrics_test.py'. A Clock set by the test gives exact
+# intervals between snapshots.
+
+# A clock which only moves when told to
+class Clock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+class Rates(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.registry = mt.MetricsRegistry(self.clock)
+
+    def test_server_rates(self):
+        m = self.registry.server('A')
+        m.put(30)
+        m.done(10)
+        self.clock.now += 2.0
+        snap = self.registry.snapshot()
+        self.assertEqual(snap['interval'], 2.0)
+        self.assertEqual((snap['servers']['A']['in_rate'], snap['servers']['A']['out_rate']), (15.0, 5.0))
+        # Only what happened since the last snapshot counts
+        m.put(5)
+        m.done(25)
+        self.clock.now += 0.5
+        s = self.registry.snapshot()['servers']['A']
+        self.assertEqual((s['msgs_in'], s['msgs_out']), (35, 35))
+        self.assertEqual((s['in_rate'], s['out_rate']), (10.0, 50.0))
+
+    def test_counter_rates(self):
+        c = self.registry.counter('fwd.msgs_in')
+        c.inc(40)
+        self.clock.now += 4.0
+        snap = self.registry.snapshot()
+        self.assertEqual(snap['counters'], {'fwd.msgs_in': 40})
+        self.assertEqual(snap['rates'], {'fwd.msgs_in': 10.0})
+        # A counter created since the last snapshot counts from 0
+        self.registry.counter('imc_disp.msgs_in').inc(3)
+        self.clock.now += 1.0
+        self.assertEqual(self.registry.snapshot()['rates'], {'fwd.msgs_in': 0.0, 'imc_disp.msgs_in': 3.0})
+
+    def test_no_interval(self):
+        self.registry.server('A').put(1)
+        self.registry.counter('c').inc()
+        snap = self.registry.snapshot()
+        self.assertEqual(snap['interval'], 0.0)
+        self.assertEqual(snap['servers']['A']['in_rate'], 0.0)
+        self.assertEqual(snap['rates']['c'], 0.0)
+
+# Entry point
+if __name__ == '__main__':
+    unittest.main()
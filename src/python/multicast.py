@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# multicast.py
+#
+# Multicast transport for pub/sub over the IMC
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    A topic published to subscribers on many machines would take one datagram per machine. Instead a
+    topic class can be given a multicast group in the MULTICAST section of the configuration
+        [MULTICAST]
+        telemetry = 239.0.0.10,12100
+        # optionally the address of the interface to use
+        spectrum = 239.0.0.11,12101,127.0.0.1
+    A topic is in a class if it is the class name or starts with the class name and a '.', so
+    'telemetry' and 'telemetry.rx1' are both in the telemetry class.
+
+    Each publish to a topic in the class is sent once to the group by the IMC server whatever the number
+    of remote subscribers. The IMC server joins the group when the first task on this machine subscribes
+    to a topic of the class and leaves when the last one unsubscribes.
+
+    A datagram is
+        magic(2) sender(4) seq(4) payload
+    The sender is chosen at random by each IMC server and the seq counts up for each group. The receiver
+    keeps the last seq of each sender so lost datagrams are counted as gaps and duplicates or late ones
+    are dropped. There is no retransmission, multicast is for topics where the next value will do.
+
+    Everything runs over loopback multicast on a single machine when the interface is 127.0.0.1.
+
+    PUBLIC INTERFACE:
+
+    The class of a topic or None.
+
+        cls = topic_class( topic, classes )
+
+    One multicast group.
+
+        group = Group( name, address, port, iface=None )
+        group.join()
+        group.leave()
+        group.send( payload )
+        payload | None = group.receive()
+        group.socket()
+        group.close()
+
+    Counts are kept in sent, received, gaps and duplicates.
+"""
+
+# System imports
+import socket
+import struct
+import random
+
+# Application imports
+from defs import *
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Datagram header
+HEADER = struct.Struct('!2sII')
+MAGIC = b'FM'
+SEQ_MOD = 1 << 32
+MAX_DGRAM = 65507
+# Receive buffer, a burst of publishes must not overflow it before the IMC server gets round to it
+RCVBUF = 1 << 20
+
+# The class a topic belongs to
+def topic_class(topic, classes):
+    if topic in classes:
+        return topic
+    cls = topic.split('.')[0]
+    if cls in classes:
+        return cls
+    return None
+
+class Group:
+
+    def __init__(self, name, address, port, iface=None):
+        self.__name = name
+        self.__address = address
+        self.__port = port
+        self.__iface = iface if iface != None else '0.0.0.0'
+        # Our identity as a sender and the next sequence number
+        self.__id = random.getrandbits(32)
+        self.__seq = 0
+        # Last sequence number seen from each sender {sender: seq}
+        self.__last = {}
+        # Socket for sending
+        self.__out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.__out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.__out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.__out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.__iface))
+        # Socket for receiving, only while joined
+        self.__in = None
+        # Totals
+        self.sent = 0
+        self.received = 0
+        self.gaps = 0
+        self.duplicates = 0
+
+    def name(self):
+        return self.__name
+
+    def socket(self):
+        return self.__in
+
+    def join(self):
+        if self.__in != None:
+            return
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # Other processes on this machine may be in the group too
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+        s.bind(('', self.__port))
+        mreq = socket.inet_aton(self.__address) + socket.inet_aton(self.__iface)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.__in = s
+
+    def leave(self):
+        if self.__in == None:
+            return
+        mreq = socket.inet_aton(self.__address) + socket.inet_aton(self.__iface)
+        try:
+            self.__in.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, mreq)
+        finally:
+            self.__in.close()
+            self.__in = None
+            self.__last = {}
+
+    # Leave and release the sending socket
+    def close(self):
+        self.leave()
+        self.__out.close()
+
+    def send(self, payload):
+        self.__out.sendto(HEADER.pack(MAGIC, self.__id, self.__seq) + payload, (self.__address, self.__port))
+        self.__seq = (self.__seq + 1) % SEQ_MOD
+        self.sent += 1
+
+    # The next payload from another sender, None if it is ours, a duplicate or late
+    def receive(self):
+        data, _ = self.__in.recvfrom(MAX_DGRAM)
+        if len(data) < HEADER.size:
+            return None
+        magic, sender, seq = HEADER.unpack_from(data)
+        if magic != MAGIC or sender == self.__id:
+            return None
+        last = self.__last.get(sender)
+        if last != None:
+            ahead = (seq - last) % SEQ_MOD
+            if ahead == 0 or ahead >= SEQ_MOD // 2:
+                self.duplicates += 1
+                return None
+            self.gaps += ahead - 1
+        self.__last[sender] = seq
+        self.received += 1
+        return data[HEADER.size:]
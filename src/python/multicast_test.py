@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# multicast_test.py
+#
+# Multicast group tests over loopback
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import unittest
+import socket
+
+# Application imports
+from defs import *
+import multicast
+
+# ====================================================================
+# Test code
+# Run with 'python multicast_test.py'. The groups use the 127.0.0.1 interface so
+# everything stays on this machine. A plain socket stands in for a sender whose
+# sequence numbers skip or repeat.
+
+GROUP = '239.0.0.77'
+IFACE = '127.0.0.1'
+
+# Longest to wait for a datagram
+WAIT = 2.0
+
+# A free port for the group
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class Group(unittest.TestCase):
+
+    def setUp(self):
+        self.port = free_port()
+        self.a = multicast.Group('telemetry', GROUP, self.port, IFACE)
+        self.b = multicast.Group('telemetry', GROUP, self.port, IFACE)
+        self.a.join()
+        self.b.join()
+        for g in [self.a, self.b]:
+            g.socket().settimeout(WAIT)
+        # Sends datagrams made up by the test to the group
+        self.raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.raw.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(IFACE))
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        self.raw.close()
+
+    def send_raw(self, sender, seq, payload):
+        self.raw.sendto(multicast.HEADER.pack(multicast.MAGIC, sender, seq) + payload, (GROUP, self.port))
+
+    def test_topic_class(self):
+        classes = ['telemetry', 'spectrum']
+        self.assertEqual(multicast.topic_class('telemetry', classes), 'telemetry')
+        self.assertEqual(multicast.topic_class('telemetry.rx1', classes), 'telemetry')
+        self.assertEqual(multicast.topic_class('telemetryx', classes), None)
+        self.assertEqual(multicast.topic_class('other.rx1', classes), None)
+
+    def test_send_receive(self):
+        for i in range(10):
+            self.a.send(b'value %d' % i)
+        for i in range(10):
+            self.assertEqual(self.b.receive(), b'value %d' % i)
+            # Our own datagrams come back on loopback and are passed over
+            self.assertEqual(self.a.receive(), None)
+        self.assertEqual((self.a.sent, self.b.received, self.b.gaps, self.b.duplicates), (10, 10, 0, 0))
+
+    def test_gaps_and_duplicates(self):
+        sender = 0x12345678
+        for seq in [0, 1, 3, 3, 2, 10]:
+            self.send_raw(sender, seq, b'%d' % seq)
+        got = [self.b.receive() for i in range(6)]
+        # 2 missed and 4 to 9 missed, the repeat of 3 and the late 2 dropped
+        self.assertEqual(got, [b'0', b'1', b'3', None, None, b'10'])
+        self.assertEqual((self.b.received, self.b.gaps, self.b.duplicates), (4, 7, 2))
+
+    def test_seq_wraps(self):
+        sender = 0x0badf00d
+        for seq in [multicast.SEQ_MOD - 2, multicast.SEQ_MOD - 1, 0, 2]:
+            self.send_raw(sender, seq, b'x')
+        got = [self.b.receive() for i in range(4)]
+        self.assertEqual(got, [b'x'] * 4)
+        self.assertEqual((self.b.received, self.b.gaps, self.b.duplicates), (4, 1, 0))
+
+    def test_not_ours(self):
+        self.raw.sendto(b'no', (GROUP, self.port))
+        self.raw.sendto(b'XX' + bytes(multicast.HEADER.size), (GROUP, self.port))
+        self.assertEqual(self.b.receive(), None)
+        self.assertEqual(self.b.receive(), None)
+        self.assertEqual(self.b.received, 0)
+
+    def test_leave(self):
+        self.b.leave()
+        self.assertEqual(self.b.socket(), None)
+        self.a.send(b'while away')
+        self.assertEqual(self.a.receive(), None)
+        # Joined again it starts afresh with each sender
+        self.b.join()
+        self.b.socket().settimeout(WAIT)
+        self.a.send(b'back')
+        self.assertEqual(self.b.receive(), b'back')
+        self.assertEqual(self.b.gaps, 0)
+
+# Entry point
+if __name__ == '__main__':
+    unittest.main()
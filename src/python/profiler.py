@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# profiler.py
+#
+# Slow handler detection for gen-server dispatchers
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    A single slow dispatcher stalls its gen-server. The profiler times every dispatcher call and
+    aggregates the times per server and message type. The message type is the message itself if it
+    is a string (e.g. "INIT") else its first element if that is a string or number else the type name.
+    A request [sender, data] made with gen_server_request() and a message wrapped as [data] are typed
+    by their data, so ["PING", 1] and [["PING", 1]] are both "PING".
+
+    A watchdog thread looks at the calls in progress. Any call which has run for longer than the
+    threshold is flagged and a sample of the stack of the gen-server thread is taken while it is still
+    in the slow code. Identical stacks are counted rather than stored again so the report shows where
+    the time goes.
+
+    The framework manager creates the profiler when ProcessInit is given a slow threshold and returns
+    it as 'PROFILER'.
+
+    PUBLIC INTERFACE:
+
+    Create a profiler flagging calls over 'threshold' seconds. The optional callback is called on the
+    watchdog thread with (server, tag, elapsed-ns, stack-text) for each slow call.
+
+        profiler = DispatchProfiler( threshold, on_slow=None )
+
+    Per server and message type counts, slow call counts and times in nanoseconds with the most
+    common stacks of slow calls.
+
+        {server: {tag: {'count', 'slow', 'mean', 'max', 'p99', 'stacks': [[n, stack-text], ...]}}} = profiler.report()
+
+    The most recent slow calls as [[server, tag, elapsed-ns], ...]
+
+        profiler.recent()
+
+    Stop the watchdog.
+
+        profiler.stop()
+"""
+
+# System imports
+import sys
+import threading
+import traceback
+import collections
+from time import perf_counter_ns
+
+# Application imports
+import metrics as mt
+from gen_server import ReplyTo
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Bound the number of message types tracked per server
+MAX_TAGS = 256
+# Stacks kept per message type
+MAX_STACKS = 5
+# Recent slow calls kept
+MAX_RECENT = 100
+
+class DispatchProfiler:
+
+    def __init__(self, threshold, on_slow=None):
+        self.__threshold = int(threshold * 1e9)
+        self.__on_slow = on_slow
+        # Calls in progress {thread-ident: [server, tag, start, sampled]}
+        self.__inflight = {}
+        # Aggregates {server: {tag: Stats}}
+        self.__stats = {}
+        self.__recent = collections.deque(maxlen=MAX_RECENT)
+        self.__lock = threading.Lock()
+        self.__term = threading.Event()
+        self.__watchdog = threading.Thread(target=self.__watch, daemon=True)
+        self.__watchdog.start()
+
+    # Called on the gen-server thread before the dispatcher
+    def begin(self, server, msg):
+        call = [server, msg_tag(msg), perf_counter_ns(), False]
+        self.__inflight[threading.get_ident()] = call
+        return call
+
+    # Called on the gen-server thread after the dispatcher
+    def end(self, call):
+        elapsed = perf_counter_ns() - call[2]
+        self.__inflight.pop(threading.get_ident(), None)
+        tags = self.__stats.get(call[0])
+        if tags == None:
+            with self.__lock:
+                tags = self.__stats.setdefault(call[0], {})
+        stats = tags.get(call[1])
+        if stats == None:
+            with self.__lock:
+                stats = self.__stats_for(tags, call[1])
+        stats.record(elapsed, elapsed > self.__threshold)
+        if elapsed > self.__threshold and not call[3]:
+            # Finished between watchdog looks so no stack was taken
+            self.__recent.append([call[0], call[1], elapsed])
+
+    def report(self):
+        with self.__lock:
+            return {server: {tag: s.snapshot() for tag, s in tags.items()} for server, tags in self.__stats.items()}
+
+    def recent(self):
+        return list(self.__recent)
+
+    def stop(self):
+        self.__term.set()
+        self.__watchdog.join()
+
+    # ====================================================================
+    # PRIVATE
+
+    # Look for calls over the threshold at half the threshold interval
+    def __watch(self):
+        while not self.__term.wait(max(self.__threshold / 2e9, 0.001)):
+            now = perf_counter_ns()
+            for ident, call in list(self.__inflight.items()):
+                if call[3] or now - call[2] < self.__threshold:
+                    continue
+                frame = sys._current_frames().get(ident)
+                if frame == None:
+                    continue
+                call[3] = True
+                stack = ''.join(traceback.format_stack(frame))
+                elapsed = now - call[2]
+                with self.__lock:
+                    tags = self.__stats.setdefault(call[0], {})
+                    self.__stats_for(tags, call[1]).add_stack(stack)
+                self.__recent.append([call[0], call[1], elapsed])
+                if self.__on_slow != None:
+                    self.__on_slow(call[0], call[1], elapsed, stack)
+
+    # The times for a tag of a server, types past MAX_TAGS share one entry, called holding the lock
+    def __stats_for(self, tags, tag):
+        if tag not in tags and len(tags) >= MAX_TAGS:
+            tag = '<other>'
+        return tags.setdefault(tag, Stats())
+
+# Times for one server and message type
+class Stats:
+
+    __slots__ = ('count', 'slow', 'hist', 'stacks')
+
+    def __init__(self):
+        self.count = 0
+        self.slow = 0
+        self.hist = mt.Histogram()
+        # {stack-text: n}
+        self.stacks = {}
+
+    def record(self, elapsed, slow):
+        self.count += 1
+        self.hist.record(elapsed)
+        if slow:
+            self.slow += 1
+
+    def add_stack(self, stack):
+        if stack in self.stacks:
+            self.stacks[stack] += 1
+        elif len(self.stacks) < MAX_STACKS:
+            self.stacks[stack] = 1
+
+    def snapshot(self):
+        h = self.hist.snapshot()
+        return {'count': self.count,
+                'slow': self.slow,
+                'mean': h['mean'],
+                'max': h['max'],
+                'p99': h['p99'],
+                'stacks': sorted([[n, s] for s, n in self.stacks.items()], reverse=True)}
+
+# The message type used to aggregate calls
+def msg_tag(msg):
+    # Type a request or a wrapped message by its data
+    while type(msg) in (list, tuple) and (len(msg) == 1 or (len(msg) == 2 and type(msg[0]) is ReplyTo)):
+        msg = msg[-1]
+    if type(msg) is str:
+        return msg[:40]
+    if type(msg) in (list, tuple) and len(msg) > 0:
+        first = msg[0]
+        if type(first) is str:
+            return first[:40]
+        if type(first) in (int, float, bool):
+            return first
+        return type(first).__name__
+    return type(msg).__name__
@@ -38,11 +38,14 @@
     The public interface can be called from any task (thread).
     Subscribers subscribe to a topic and provide a task name.
     Publishers publish to a topic with data to send via a gen_server_msg().
+    There is one PubSub instance per process, created by the framework manager, and it
+    dispatches to the tasks of that process.
   
     PUBLIC INTERFACE:
     
     Subscribe to a topic where 'name' is the task name of the target task and 'topic' is the topic
     to subscribe to. Topic names and task names are strings. If a topic does not exist it will be created.
+    If the topic is conflating the subscriber is immediately sent the last value of each key.
 
         ps_subscribe( name, topic )
         
@@ -54,12 +57,41 @@
     If a topic does not exist a message will be logged but it won't fail.
     Subscribers should therefore subscribe before publishing starts. Note that this
     is asynchronous as publish will return once messages have been sent to all subscribers.
+    The key is only used by conflating topics, see below.
 
-        ps_publish( topic, * )
+        ps_publish( topic, *, key=None )
+        
+    Publish many items to a topic in one call. Each subscriber receives the items as a single
+    batch which its gen-server unpacks in order. For a conflating topic only the last item matters.
+    
+        ps_publish_many( topic, [*, *, ...], key=None )
         
     Get a subscriber list for topic 'topic'.
     
         subscribers = ps_list( topic )
+    
+    Conflating topics
+    =================
+    High rate state topics such as meter readings only need the newest value. If a topic
+    is declared conflating each subscriber holds at most one pending value per key. A value
+    published while the previous one is still queued replaces it in place, so a slow subscriber
+    never builds a backlog. The last value of each key is cached so new subscribers get the
+    current state as soon as they subscribe. Declare the topic before publishing.
+    
+        ps_conflate( topic )
+        
+    Get the cached last value for a key of a conflating topic or None.
+    
+        * = ps_last_value( topic, key=None )
+    
+    Remote subscribers
+    ==================
+    A topic class given a multicast group in the configuration is also published to subscribers on
+    other machines, see multicast. Each publish goes once to the group through the IMC server and the
+    IMC server on each machine with subscribers to the class passes it to the PubSub of each process
+    with subscribers, which delivers it as a local publish. A process joins the group when it first has
+    a subscriber to the class and leaves when it has none. Received items arrive through a gen-server
+    task named MCAST which is started on the first subscription.
         
 """
 
@@ -70,64 +102,166 @@ from time import sleep
 import copy
 
 # Application imports
+from defs import *
 import gen_server
+import multicast
 
-# ====================================================================
-# PRIVATE
-# Pub/Sub dictionary
-# This will be accessed from multiple threads
-#
-# Holds refs in the form topic: task-name
-__ps_dict = {}
-
-# Pub/Sub dict lock
-ps_lock = threading.Lock()
-
-def __ps_lock():
-    ps_lock.acquire()
-    
-def __ps_release():
-    ps_lock.release()
- 
- 
 # ====================================================================
 # PUBLIC
+# API
 
-def ps_subscribe( name, topic ):
-    
-    __ps_lock()
-    if topic in __ps_dict:
-        __ps_dict[topic].append(name)
-    else:
-        __ps_dict[topic] = [name]
-    __ps_release()
-    
-def ps_unsubscribe( name, topic ):
-    
-    __ps_lock()
-    if topic in __ps_dict:
-        if name in __ps_dict[topic]:
-            __ps_dict[topic].remove(name)
-    __ps_release()
+class PubSub:
+    
+    def __init__(self, gs_inst, td_man, router=None, imc_q=None):
+        self.__gs_inst = gs_inst
+        self.__td_man = td_man
+        # Topic classes published by multicast through our IMC q
+        self.__imc_q = imc_q
+        if router != None and imc_q != None:
+            self.__classes = router.multicast_classes()
+        else:
+            self.__classes = []
+        # The classes this process has joined
+        self.__joined = set()
         
-
-def ps_publish( topic, data ):
-    
-    __ps_lock()
-    if topic in __ps_dict:
-        subs = __ps_dict[topic]
-        for sub in subs:
-            task_ref = gen_server.gen_server_get_task_ref( sub )
-            if task_ref != None:
-                gen_server.gen_server_msg( sub, [data] )
-    __ps_release()
-                
- 
-def ps_list( topic ):
-    __ps_lock()
-    if topic in __ps_dict:
-        r = copy.deepcopy(__ps_dict[topic])
-    else:
-        r = []
-    __ps_release()
-    return r
+        # Pub/Sub dictionary
+        # This will be accessed from multiple threads
+        # Holds refs in the form topic: [task-name, task-name, ...]
+        self.__ps_dict = {}
+        # Conflating topics with their last value cache
+        # {topic: {key: [data]}, ...}
+        self.__lvc = {}
+        # Pending value slots for conflating topics
+        # {(task-name, topic, key): Slot, ...}
+        self.__slots = {}
+        
+        # Pub/Sub dict lock
+        self.__lock = threading.Lock()
+    
+    def ps_conflate(self, topic):
+        with self.__lock:
+            if topic not in self.__lvc:
+                self.__lvc[topic] = {}
+    
+    def ps_subscribe(self, name, topic):
+        with self.__lock:
+            if topic in self.__ps_dict:
+                if name not in self.__ps_dict[topic]:
+                    self.__ps_dict[topic].append(name)
+            else:
+                self.__ps_dict[topic] = [name]
+            if topic in self.__lvc and self.__td_man.get_task_ref( name ) != None:
+                # Bring the new subscriber up to date
+                for key, value in self.__lvc[topic].items():
+                    self.__conflate(name, topic, key, value)
+            cls = multicast.topic_class(topic, self.__classes)
+            join = cls != None and cls not in self.__joined
+            if join:
+                self.__joined.add(cls)
+        if join:
+            # Remote publishers reach us through the multicast group
+            if self.__td_man.get_task_ref( MCAST ) == None:
+                self.__gs_inst.server_new( MCAST, self.__on_multicast )
+            self.__imc_q.put([MCAST, ['join', cls, None]])
+        
+    def ps_unsubscribe(self, name, topic):
+        with self.__lock:
+            if topic in self.__ps_dict:
+                if name in self.__ps_dict[topic]:
+                    self.__ps_dict[topic].remove(name)
+            if topic in self.__lvc:
+                # Drop any pending values for this subscriber, including those already queued
+                for k in [k for k in self.__slots if k[0] == name and k[1] == topic]:
+                    self.__slots.pop(k).clear()
+            cls = multicast.topic_class(topic, self.__classes)
+            leave = cls in self.__joined and not any([len(subs) > 0 for t, subs in self.__ps_dict.items() if multicast.topic_class(t, self.__classes) == cls])
+            if leave:
+                self.__joined.discard(cls)
+        if leave:
+            self.__imc_q.put([MCAST, ['leave', cls, None]])
+    
+    def ps_publish(self, topic, data, key=None):
+        self.__publish(topic, data, key)
+        cls = multicast.topic_class(topic, self.__classes)
+        if cls != None:
+            self.__imc_q.put([MCAST, ['pub', cls, [topic, data, key]]])
+    
+    def ps_publish_many(self, topic, items, key=None):
+        items = list(items)
+        if len(items) == 0:
+            return
+        self.__publish_many(topic, items, key)
+        cls = multicast.topic_class(topic, self.__classes)
+        if cls != None:
+            if topic in self.__lvc:
+                # Only the newest value is of interest
+                items = items[-1:]
+            for data in items:
+                self.__imc_q.put([MCAST, ['pub', cls, [topic, data, key]]])
+    
+    def ps_list(self, topic):
+        with self.__lock:
+            if topic in self.__ps_dict:
+                r = copy.deepcopy(self.__ps_dict[topic])
+            else:
+                r = []
+        return r
+    
+    def ps_last_value(self, topic, key=None):
+        with self.__lock:
+            if topic in self.__lvc and key in self.__lvc[topic]:
+                return self.__lvc[topic][key][0]
+        return None
+    
+    # ====================================================================
+    # PRIVATE
+    
+    # Publish to the subscribers in this process
+    def __publish(self, topic, data, key):
+        with self.__lock:
+            if topic in self.__lvc:
+                self.__lvc[topic][key] = [data]
+            if topic in self.__ps_dict:
+                subs = self.__ps_dict[topic]
+                for sub in subs:
+                    task_ref = self.__td_man.get_task_ref( sub )
+                    if task_ref != None:
+                        if topic in self.__lvc:
+                            self.__conflate(sub, topic, key, [data])
+                        else:
+                            self.__gs_inst.server_msg( sub, [data] )
+    
+    def __publish_many(self, topic, items, key):
+        with self.__lock:
+            if topic in self.__lvc:
+                # Only the newest value is of interest
+                self.__lvc[topic][key] = [items[-1]]
+            if topic in self.__ps_dict:
+                messages = []
+                for sub in self.__ps_dict[topic]:
+                    task_ref = self.__td_man.get_task_ref( sub )
+                    if task_ref != None:
+                        if topic in self.__lvc:
+                            self.__conflate(sub, topic, key, [items[-1]])
+                        else:
+                            messages.extend([[sub, [data]] for data in items])
+                if len(messages) > 0:
+                    self.__gs_inst.server_msg_many( messages )
+    
+    # A publish from another process or machine [topic, data, key]
+    def __on_multicast(self, msg):
+        if msg == INIT:
+            return
+        topic, data, key = msg
+        self.__publish(topic, data, key)
+    
+    # Replace or queue the pending value for a subscriber
+    # Called with the lock held
+    def __conflate(self, name, topic, key, value):
+        slot = self.__slots.get((name, topic, key))
+        if slot == None:
+            slot = gen_server.Slot()
+            self.__slots[(name, topic, key)] = slot
+        if slot.offer(value):
+            # Not already queued
+            self.__gs_inst.server_msg( name, slot )
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# pub_sub_test.py
+#
+# Publish and subscribe tests
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import unittest
+import threading
+import socket
+from time import sleep, monotonic
+
+# Application imports
+from defs import *
+import envelope
+from envelope import Envelope
+import multicast
+import testbed
+
+# ====================================================================
+# Test code
+# Run with 'python pub_sub_test.py'. The PubSub and gen-servers are real, see testbed.
+# The subscriber can be held on a message so publishes queue up behind it.
+
+# Longest to wait for the subscriber to be released
+WAIT = 2.0
+
+# Records the data of each message, HOLD waits for the test to release it
+class Subscriber:
+
+    def __init__(self):
+        self.got = []
+        self.held = threading.Event()
+        self.release = threading.Event()
+
+    def dispatch(self, msg):
+        if msg == INIT:
+            return
+        if msg == ['HOLD']:
+            self.held.set()
+            self.release.wait(WAIT)
+            return
+        self.got.append(msg[0])
+
+class PubSub(unittest.TestCase):
+
+    def setUp(self):
+        self.bed = testbed.Testbed([['PARENT', ['sub']]])
+        params = self.bed.params('PARENT')
+        self.gs = params['GS']
+        self.ps = params['PS']
+        self.m = params['METRICS'].server('sub')
+        self.sub = Subscriber()
+        self.gs.server_new('sub', self.sub.dispatch)
+        self.q = params['TD'].get_task_ref('sub')[2]
+
+    def tearDown(self):
+        self.sub.release.set()
+        self.bed.close()
+
+    # Keep the subscriber busy so publishes stay queued
+    def hold(self):
+        self.gs.server_msg('sub', ['HOLD'])
+        self.assertTrue(self.sub.held.wait(WAIT))
+
+    # Let the subscriber go and wait for it to empty its mailbox
+    def settle(self):
+        self.sub.release.set()
+        sleep(0.05)
+        while self.q.qsize() > 0:
+            sleep(0.01)
+        sleep(0.05)
+
+    def test_publish(self):
+        self.ps.ps_subscribe('sub', 'news')
+        self.assertEqual(self.ps.ps_list('news'), ['sub'])
+        self.ps.ps_publish('news', 1)
+        self.ps.ps_publish_many('news', [2, 3, 4])
+        self.ps.ps_publish('other', 5)
+        self.settle()
+        self.assertEqual(self.sub.got, [1, 2, 3, 4])
+        self.ps.ps_unsubscribe('sub', 'news')
+        self.ps.ps_publish('news', 6)
+        self.settle()
+        self.assertEqual(self.sub.got, [1, 2, 3, 4])
+
+    def test_conflation_overwrite(self):
+        self.ps.ps_conflate('meter')
+        self.ps.ps_subscribe('sub', 'meter')
+        self.hold()
+        for i in range(100):
+            self.ps.ps_publish('meter', ['S', i], key='S')
+        for i in range(3):
+            self.ps.ps_publish('meter', ['PWR', i], key='PWR')
+        self.ps.ps_publish_many('meter', [['SWR', 1], ['SWR', 2]], key='SWR')
+        # One slot queued per key, replaced in place since
+        self.assertEqual(self.q.qsize(), 3)
+        self.settle()
+        self.assertEqual(self.sub.got, [['S', 99], ['PWR', 2], ['SWR', 2]])
+        self.assertEqual(self.ps.ps_last_value('meter', key='S'), ['S', 99])
+        self.assertEqual(self.m.depth.value, 0)
+
+    def test_last_value_on_subscribe(self):
+        self.ps.ps_conflate('meter')
+        self.ps.ps_publish('meter', 7, key='S')
+        self.ps.ps_publish('meter', 8, key='S')
+        self.ps.ps_subscribe('sub', 'meter')
+        self.settle()
+        self.assertEqual(self.sub.got, [8])
+
+    def test_unsubscribe_while_queued(self):
+        self.ps.ps_conflate('meter')
+        self.ps.ps_subscribe('sub', 'meter')
+        self.hold()
+        self.ps.ps_publish('meter', 1, key='S')
+        self.ps.ps_unsubscribe('sub', 'meter')
+        self.settle()
+        self.assertEqual(self.sub.got, [])
+        self.assertEqual(self.m.depth.value, 0)
+
+    def test_resubscribe_while_queued(self):
+        self.ps.ps_conflate('meter')
+        self.ps.ps_subscribe('sub', 'meter')
+        self.hold()
+        self.ps.ps_publish('meter', 1, key='S')
+        self.ps.ps_unsubscribe('sub', 'meter')
+        self.ps.ps_subscribe('sub', 'meter')
+        self.ps.ps_publish('meter', 2, key='S')
+        self.settle()
+        # One pending value for the key, the newest
+        self.assertEqual(self.sub.got, [2])
+        self.assertEqual(self.m.depth.value, 0)
+
+# Topics of the telemetry class go out to a multicast group on loopback, the test
+# joins the group to stand in for the other machines
+class Multicast(unittest.TestCase):
+
+    def setUp(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('', 0))
+        port = s.getsockname()[1]
+        s.close()
+        self.bed = testbed.Testbed([['PARENT', ['pub']], ['CHILD', ['sub']]],
+                                   multicast={'telemetry': '239.0.0.78,%d,127.0.0.1' % port})
+        self.far = multicast.Group('telemetry', '239.0.0.78', port, '127.0.0.1')
+        self.far.join()
+        self.far.socket().settimeout(WAIT)
+        self.sub = Subscriber()
+        self.bed.gs('CHILD').server_new('sub', self.sub.dispatch)
+        self.bed.params('CHILD')['PS'].ps_subscribe('sub', 'telemetry.rx1')
+        # The IMC server joins the group as it gets the request
+        sleep(0.3)
+
+    def tearDown(self):
+        self.far.close()
+        self.bed.close()
+
+    def wait(self, n):
+        end = monotonic() + WAIT
+        while len(self.sub.got) < n and monotonic() < end:
+            sleep(0.01)
+
+    def test_fan_out(self):
+        ps = self.bed.params('PARENT')['PS']
+        ps.ps_publish('telemetry.rx1', 1)
+        ps.ps_publish('telemetry.rx2', 2)
+        ps.ps_publish('news', 3)
+        # Given to the subscriber in the other local process and sent once to the group
+        self.wait(1)
+        self.assertEqual(self.sub.got, [1])
+        env = envelope.decode(self.far.receive())
+        self.assertEqual((env.dest, env.payload), (MCAST, ['telemetry.rx1', 1, None]))
+        self.assertEqual(envelope.decode(self.far.receive()).payload, ['telemetry.rx2', 2, None])
+        # From another machine
+        self.far.send(Envelope(MCAST, ['telemetry.rx1', 4, None]).encode())
+        self.wait(2)
+        self.assertEqual(self.sub.got, [1, 4])
+
+# Entry point
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# recorder.py
+#
+# Message traffic recorder and replayer
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Synthetic load seldom behaves like the real thing. The recorder captures live traffic to a binary
+    log so a performance problem can be reproduced offline and dispatcher changes can be measured
+    against the message mix that caused it.
+
+    Messages are recorded where they enter the framework:
+        SEND    a task calls gen_server_msg(), gen_server_msg_many() or gen_server_response()
+        FWD     the forwarder receives a message from another process on this machine
+        IMC     the IMC server receives a message from another machine
+    Each process writes its own log and the IMC server writes another. A message from one process to
+    another is in the SEND records of the sender and the FWD records of the receiver so replay the SEND
+    records of every log or all the records of just one.
+
+    The log is
+        header:  magic(2) version(2)
+        records: time-ns(8) point(1) name-length(2) message-length(4) name message
+    The time is wall clock time so logs from several processes can be merged. The message is pickled.
+    Conflated values and anything that will not pickle are counted in 'skipped' and not recorded.
+
+    The framework manager records when ProcessInit or GlobalInit are given a directory. The process
+    log is <process>.rec and the IMC server log is imc.rec.
+
+    PUBLIC INTERFACE:
+
+    Record to a log, creating or truncating it.
+
+        recorder = Recorder( path )
+        recorder.record( point, name, message )
+        recorder.close()
+
+    Read a log. Each record is [time-ns, point, name, message].
+
+        replayer = Replayer( path )
+        for record in replayer.records( points=None ):
+        {'records', 'seconds', 'points': {point: n}, 'names': {name: n}} = replayer.summary()
+
+    Send the records to a topology through a GenServer instance. Speed 1 is the rate they were recorded
+    at, N is N times faster and 0 is as fast as possible. Returns the number sent.
+
+        n = replayer.replay( gs_inst, speed=1.0, points=None )
+
+    From the command line
+        python recorder.py <log>
+    prints the summary of a log.
+"""
+
+# System imports
+import argparse
+import struct
+import pickle
+import threading
+from time import time_ns, perf_counter, sleep
+
+# Application imports
+from defs import *
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Where a message was recorded
+SEND = 1
+FWD = 2
+IMC = 3
+POINTS = {'SEND': SEND, 'FWD': FWD, 'IMC': IMC}
+
+# Log header and record header
+HEADER = struct.Struct('!2sH')
+MAGIC = b'FR'
+VERSION = 1
+RECORD = struct.Struct('!QBHI')
+
+class Recorder:
+
+    def __init__(self, path):
+        self.__f = open(path, 'wb')
+        self.__f.write(HEADER.pack(MAGIC, VERSION))
+        self.__lock = threading.Lock()
+        # Totals
+        self.recorded = 0
+        self.skipped = 0
+
+    def record(self, point, name, message):
+        try:
+            data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Slots and other unpicklable content
+            self.skipped += 1
+            return
+        name = name.encode('utf-8')
+        with self.__lock:
+            if self.__f.closed:
+                return
+            self.__f.write(RECORD.pack(time_ns(), point, len(name), len(data)))
+            self.__f.write(name)
+            self.__f.write(data)
+            self.recorded += 1
+
+    def close(self):
+        with self.__lock:
+            self.__f.close()
+
+class Replayer:
+
+    def __init__(self, path):
+        self.__path = path
+
+    def records(self, points=None):
+        with open(self.__path, 'rb') as f:
+            magic, version = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a traffic log' % (self.__path))
+            while True:
+                hdr = f.read(RECORD.size)
+                if len(hdr) < RECORD.size:
+                    # End of log or a record cut short
+                    return
+                t, point, name_len, data_len = RECORD.unpack(hdr)
+                name = f.read(name_len)
+                data = f.read(data_len)
+                if len(data) < data_len:
+                    return
+                if points == None or point in points:
+                    yield [t, point, name.decode('utf-8'), pickle.loads(data)]
+
+    def summary(self):
+        n = 0
+        first = last = None
+        by_point = {}
+        by_name = {}
+        for t, point, name, message in self.records():
+            n += 1
+            if first == None:
+                first = t
+            last = t
+            by_point[point] = by_point.get(point, 0) + 1
+            by_name[name] = by_name.get(name, 0) + 1
+        seconds = (last - first) / 1e9 if n > 0 else 0.0
+        return {'records': n, 'seconds': seconds, 'points': by_point, 'names': by_name}
+
+    def replay(self, gs_inst, speed=1.0, points=None):
+        n = 0
+        start = None
+        for t, point, name, message in self.records(points):
+            if start == None:
+                start = (t, perf_counter())
+            elif speed > 0:
+                # Keep to the recorded spacing scaled by the speed
+                wait = start[1] + (t - start[0]) / 1e9 / speed - perf_counter()
+                if wait > 0:
+                    sleep(wait)
+            gs_inst.server_msg(name, message)
+            n += 1
+        return n
+
+# =======================================================================================================
+# Entry point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarise a message traffic log')
+    parser.add_argument('log', help='log file written by the recorder')
+    args = parser.parse_args()
+    summary = Replayer(args.log).summary()
+    names = {v: k for k, v in POINTS.items()}
+    print('%d records over %.3f seconds' % (summary['records'], summary['seconds']))
+    for point, n in sorted(summary['points'].items()):
+        print('  %-5s %d' % (names.get(point, point), n))
+    for name, n in sorted(summary['names'].items(), key=lambda x: -x[1]):
+        print('  %-20s %d' % (name, n))
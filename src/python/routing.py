@@ -24,154 +24,247 @@
 #
 
 # System imports
-from multiprocessing import Manager, Lock
-from time import sleep
-import pprint
+from multiprocessing import shared_memory
+import struct
+import pickle
+import copy
 
 # Application imports
 from defs import *
 
 """
-    Shared multiprocessing.Manager to store shared routing state. This is a dictionary of the form:
-        {process-name: [task-name, task-name, ...], process-name [...], ...}
-    It provides a lookup to find usually the Process within which a Task is implemented. Both names
-    are strings set when routes are added. It would be nice to be able to store an associated Queue
-    with the Process as this is the means to dispatch a message to another Process where it can be
-    forwarded to the appropriate Task. Unfortunately a Queue is not pickleable and can only be passed
-    directly to child processes so a dictionary of process name(s) to Queue is passed to all Processes.
-    This means that the hierarchy must be known in advance on program initialisation.
-    
-    The router passed in is an instance of multiprocessing.Manager. This is passed as an argument to each
-    process and then each Process can create an instance of Routing to provide the convienience access methods.
+    The topology is fixed at start of day so the routes are compiled once by GlobalInit into a read-only
+    table in shared memory. The table holds the configuration in the form:
+        {LOCAL: [[process-name, [task-name, ...]], ...], REMOTE: [[process-name, [task-name, ...], IP, port-in, port-out, link-options], ...],
+         GROUPS: {task-name: policy, ...}, LINKS: [(process-name, process-name), ...], MULTICAST: [topic-class, ...]}
+    Each process maps the table once at startup and builds its own index of task to process, so a route
+    lookup is a local dictionary lookup with no locking and no round trip to another process.
+    
+    It would be nice to be able to store an associated Queue with the Process as this is the means to
+    dispatch a message to another Process where it can be forwarded to the appropriate Task. Unfortunately
+    a Queue is not pickleable and can only be passed directly to child processes so a dictionary of process
+    name(s) to Queue is passed to all Processes. This means that the hierarchy must be known in advance on
+    program initialisation.
+    
+    The name of the shared memory block is passed as an argument to each process and then each Process
+    creates an instance of Routing to provide the convienience access methods.
+    
+    A task name which appears in more than one process is a task group. Each process runs its own instance of
+    the task and a message to the plain task name goes to one of the instances chosen by the group policy:
+        round_robin     - each instance in turn (the default)
+        least_queue     - the instance with the least queued on the way to it as seen from the sender
+        hash            - the instance chosen by a hash of the message key so the same key always goes to
+                          the same instance (round robin if there is no key)
+    A particular instance is addressed as task@process, which is how an instance gives its reply address.
+    
+    LOCAL processes have a pair of queues for each link. Unless links are declared every process is linked
+    to every other. A message for a process with no link to this one goes to the next process on the shortest
+    path to it and the forwarder there passes it on.
 """
 
-# System imports
-import copy
+# Table header, magic and length of the pickled topology
+HEADER = struct.Struct('!4sI')
+MAGIC = b'FWRT'
 
-# Application imports
-from defs import *
+# Task group policies
+ROUND_ROBIN = 'round_robin'
+LEAST_QUEUE = 'least_queue'
+HASH = 'hash'
+POLICIES = (ROUND_ROBIN, LEAST_QUEUE, HASH)
+
+# The shared route table, created once by GlobalInit
+class RouteTable:
+    
+    def __init__(self, local, remote, groups=None, links=None, multicast=None):
+        # local and remote are the parsed configuration sections
+        #   ['LOCAL', [[proc_name, [task_name, ...]], ...]]
+        #   ['REMOTE', [[proc_name, [task_name, ...], ip, in-port, out-port], ...]]
+        # groups is the optional policy per task group {task_name: policy, ...}
+        # links are the linked LOCAL processes [(proc_name, proc_name), ...]
+        # multicast are the pub/sub topic classes with a multicast group [topic-class, ...]
+        routes = {LOCAL: [], REMOTE: [], GROUPS: {}, LINKS: [], MULTICAST: []}
+        if local != None:
+            routes[LOCAL] = copy.deepcopy(local[1])
+        if remote != None:
+            routes[REMOTE] = copy.deepcopy(remote[1])
+        if groups != None:
+            routes[GROUPS] = dict(groups)
+        if links != None:
+            routes[LINKS] = list(links)
+        if multicast != None:
+            routes[MULTICAST] = list(multicast)
+        data = pickle.dumps(routes)
+        self.__shm = shared_memory.SharedMemory(create=True, size=HEADER.size + len(data))
+        HEADER.pack_into(self.__shm.buf, 0, MAGIC, len(data))
+        self.__shm.buf[HEADER.size:HEADER.size + len(data)] = data
+    
+    # The handle to give to each process
+    def name(self):
+        return self.__shm.name
+    
+    # Release the table at end of day
+    def close(self):
+        self.__shm.close()
+        self.__shm.unlink()
+
+# Map the shared table and return the routes
+def load_routes(name):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        magic, length = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError('Shared memory %s is not a route table' % name)
+        return pickle.loads(bytes(shm.buf[HEADER.size:HEADER.size + length]))
+    finally:
+        shm.close()
 
 class Routing:
     
-    def __init__(self, router, local_qs, imc_qs):
+    def __init__(self, routes, local_qs, imc_qs, name=None):
         
-        # Router is the single instance of the shared router dictionary
+        # Routes is the name of the shared route table
+        # Name is the name of this process
         # Queues are defined as follows:
         # {process-name: (q1,q2), process_name: (...), ..., "IMC": (q3,)}
         # Such that the process is the target and the queues are q1 = input, q2 = output
         # For remote targets there is only one q which is the local q to send to the imc_server
-        self.__routes = router
-        self.__lk = Lock()
+        self.__routes = load_routes(routes)
         self.__local_qs = local_qs
         self.__imc_qs = imc_qs
+        self.__name = name
+        self.__index()
     
-    # Add a new route    
+    # The name of this process
+    def name(self):
+        return self.__name
+    
+    # Add a new route
+    # The table is read-only so this only affects this process
     def add_route(self, target, desc):
-        #print('add_route ', target, desc)
-        
         # target can be LOCAL or REMOTE
         # The descriptor can contain
         #   [proc_name, [[task_name, task_name, ...]]
         #   for processes residing on this machine
         # or for processes residing on another machine
         #   [proc_name (aka device), [[task_name, task_name, ...], IP-Addr (or DNS name), in-port, out-port]]
-        self.__lk.acquire()
-        # Dict is a proxy, can't just append to elements
-        if target in self.__routes:
-            current = copy.deepcopy(self.__routes[target])
-            if desc not in current:
-                current.append(desc)
-                self.__routes[target] = current
-        else:
-            self.__routes[target] = [desc]
-        self.__lk.release()
+        if desc not in self.__routes[target]:
+            self.__routes[target].append(desc)
+            self.__index()
     
     #  Get desc and Q for process   
     def get_route(self, process):
-        r = None
-        self.__lk.acquire()
-        d = find_process(LOCAL, process)
-        if d != None:
-            r = d
-        else:
-            d = find_process(REMOTE, process)
-            if d != None:
-                r = d
-        self.__lk.release()
-        if process in self.__local_qs:
-            return r, self.__local_qs[process]
-        elif process in self.__imc_qs:
-                return r, self.__imc_qs[process]
-        else:
-            return r, None
+        r = self.__procs.get(process)
+        if r != None:
+            r = r[1]
+        return r, self.__q_for(process)
     
     # Return all routes and associated Q's
     def get_routes(self):
-        r = None
-        self.__lk.acquire()
-        r = self.__routes
-        self.__lk.release()
-        return r, self.__local_qs, self.__imc_qs
+        return self.__routes, self.__local_qs, self.__imc_qs
     
     # Return process and Q for given task
     # The process could be this process, another on this machine or a remote machine
     def process_for_task(self, task):
-        r = None
-        self.__lk.acquire()
-        # Can't directly iterate a proxy
-        # This is a simple work round as the dict is small
-        routes = copy.deepcopy(self.__routes)
-        found = False
-        for process in routes[LOCAL]:
-            if task in process[1]:
-                r = process[0]
-                found = True
-                break
-        if not found:
-            for process in routes[REMOTE]:
-                if task in process[1]:
-                    r = process[0]
-                    break
-        self.__lk.release()
-        if r in self.__local_qs:
-            return r, self.__local_qs[r]
-        elif r in self.__imc_qs:
-            return r, self.__imc_qs[r]
-        else:
-            return r, None
+        r = self.__tasks.get(task)
+        if r != None:
+            r = r[1][0]
+        return r, self.__q_for(r)
  
     # Is this task remote
     def is_remote(self, task):
-        self.__lk.acquire()
-        r = False
-        routes = copy.deepcopy(self.__routes)
-        for process in routes[REMOTE]:
-            if task in process[1]:
-                r = True
-        self.__lk.release()
-        return r
+        r = self.__tasks.get(task)
+        return r != None and r[0] == REMOTE
         
     # Return network address for given task
     def address_for_task(self, task):
-        r = []
-        self.__lk.acquire()
-        routes = copy.deepcopy(self.__routes)
-        # Can't directly iterate a proxy
-        # This is a simple work round as the dict is small
-        routes = copy.deepcopy(self.__routes)
-        for process in routes[REMOTE]:
+        r = self.__tasks.get(task)
+        if r != None and r[0] == REMOTE:
             # Process of the form [process-name, [tasks], IP, port-in, port-out]
-            if task in process[1]:
-                r = [process[2], process[3]]
-        self.__lk.release()
-        return r
+            # We listen on port-in and the remote listens on port-out
+            return [r[1][2], r[1][4]]
+        return []
         
+    # Is this task served by more than one process
+    def is_group(self, task):
+        return task in self.__groups
+    
+    # The processes serving a task group in configuration order
+    def instances(self, task):
+        return self.__groups.get(task, [])
+    
+    # The policy for a task group
+    def group_policy(self, task):
+        return self.__routes[GROUPS].get(task, ROUND_ROBIN)
+    
+    # The pub/sub topic classes with a multicast group
+    def multicast_classes(self):
+        return self.__routes[MULTICAST]
+    
+    # Is there a direct link to this process
+    def is_linked(self, process):
+        return process in self.__local_qs
+    
+    # Is this process on another machine
+    def is_remote_process(self, process):
+        r = self.__procs.get(process)
+        return r != None and r[0] == REMOTE
+    
     # Return the descriptor for process or None
     def find_process(self, target, process):
-        
-        l = self.__routes[target]
-        for d in l:
-            if d[0] == process:
-                return d
+        r = self.__procs.get(process)
+        if r != None and r[0] == target:
+            return r[1]
         return None
     
+    # ====================================================================
+    # PRIVATE
+    
+    # Build the lookups {task: (target, desc)} and {process: (target, desc)}
+    # A task found in LOCAL takes precedence over REMOTE
+    # and the task groups {task: [process, ...]}
+    def __index(self):
+        self.__tasks = {}
+        self.__procs = {}
+        instances = {}
+        for target in (REMOTE, LOCAL):
+            for desc in self.__routes[target]:
+                self.__procs[desc[0]] = (target, desc)
+                for task in desc[1]:
+                    self.__tasks[task] = (target, desc)
+        for target in (LOCAL, REMOTE):
+            for desc in self.__routes[target]:
+                for task in desc[1]:
+                    instances.setdefault(task, []).append(desc[0])
+        self.__groups = {task: procs for task, procs in instances.items() if len(procs) > 1}
+        self.__hops = self.__next_hops()
+    
+    # Find the first hop on the shortest path to each LOCAL process {process: neighbour}
+    def __next_hops(self):
+        peers = {}
+        for a, b in self.__routes[LINKS]:
+            peers.setdefault(a, []).append(b)
+            peers.setdefault(b, []).append(a)
+        hops = {}
+        frontier = [(p, p) for p in peers.get(self.__name, [])]
+        seen = {self.__name}
+        while len(frontier) > 0:
+            following = []
+            for process, first in frontier:
+                if process in seen:
+                    continue
+                seen.add(process)
+                hops[process] = first
+                following.extend([(p, first) for p in peers.get(process, [])])
+            frontier = following
+        return hops
+    
+    def __q_for(self, process):
+        if process in self.__local_qs:
+            return self.__local_qs[process]
+        elif process in self.__imc_qs:
+            return self.__imc_qs[process]
+        elif self.__hops.get(process) in self.__local_qs:
+            # No direct link so go via the next process on the path
+            return self.__local_qs[self.__hops[process]]
+        else:
+            return None
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+#
+# stream.py
+#
+# Stream channels for fixed size sample frames
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    A continuous flow of sample blocks, such as IQ from a radio, does not need what the message path
+    gives each message, an envelope, a pickle and a queue put. A stream channel is a ring of fixed size
+    frames with one producer and any number of consumers. The frames are in shared memory so consumers in
+    other LOCAL processes read them in place, or in ordinary memory for a stream within one process.
+
+    The block is
+        header:  magic(2) version(2) frame-bytes(4) frames(4) elements(4) dtype(16)
+        count:   frames written, native 8 byte integer at offset 64
+        frames:  from offset 128, each rounded up to 64 bytes
+    The producer writes frame n into slot n % frames then moves the count on. A consumer keeps its own
+    position so consumers never hold up the producer or each other. A new consumer starts at the next frame
+    written. A consumer a whole ring behind has been overtaken, it moves on to half a ring behind and the
+    frames passed over are counted in lost. Nothing is buffered for a slow consumer beyond the ring.
+
+    Frames are read in place. A frame may be overwritten while it is in use if the consumer is nearly a
+    ring behind, intact() says whether the last frame read survived. Copy the frame first if it must.
+
+    With NumPy a frame is an ndarray view of 'elements' values of the dtype. Without it a frame is a
+    memoryview cast to the matching format and the complex types are interleaved float pairs. The count
+    is written with a single aligned store, a consumer polls it with a short back off when it has caught up.
+
+    PUBLIC INTERFACE:
+
+    Create a stream as its producer. There is one producer per stream name. The dtype is one of DTYPES.
+
+        producer = Producer( name, elements, dtype='complex64', frames=DEFAULT_FRAMES, shared=True )
+
+    Write the next frame from anything with the buffer interface of the right size, or fill the next
+    frame in place and publish it.
+
+        producer.write( data )
+        frame = producer.claim()
+        producer.publish()
+
+    Close the stream, which removes it.
+
+        producer.close()
+
+    Open a stream as a consumer in any LOCAL process, or in this process if it is not shared.
+
+        consumer = Consumer( name, shared=True )
+
+    The next frame or None if none arrives within the timeout, None waits for ever.
+
+        frame = consumer.read( timeout=None )
+        consumer.intact()
+        consumer.close()
+
+    Counts are kept in producer.written, consumer.read_count and consumer.lost.
+"""
+
+# System imports
+import struct
+from multiprocessing import shared_memory
+from time import monotonic, sleep
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Application imports
+from defs import *
+import log
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Block header and layout
+HEADER = struct.Struct('!2sHIII16s')
+MAGIC = b'FS'
+VERSION = 1
+COUNT_OFFSET = 64
+FRAME_OFFSET = 128
+ALIGN = 64
+# Frames in a ring unless given
+DEFAULT_FRAMES = 64
+# Prefix of the shared memory name of a stream
+PREFIX = 'fw_stream_'
+# Longest sleep when waiting for a frame
+POLL_MAX = 0.001
+
+# Element types {dtype: (format, item-size, items per element)}
+DTYPES = {
+    'int8': ('b', 1, 1),
+    'uint8': ('B', 1, 1),
+    'int16': ('h', 2, 1),
+    'uint16': ('H', 2, 1),
+    'int32': ('i', 4, 1),
+    'float32': ('f', 4, 1),
+    'float64': ('d', 8, 1),
+    'complex64': ('f', 4, 2),
+    'complex128': ('d', 8, 2),
+}
+
+class Producer:
+
+    def __init__(self, name, elements, dtype='complex64', frames=DEFAULT_FRAMES, shared=True):
+        if dtype not in DTYPES:
+            raise ValueError('Unknown stream dtype %s' % dtype)
+        if frames < 2:
+            raise ValueError('A stream needs at least 2 frames')
+        fmt, size, per = DTYPES[dtype]
+        self.__name = name
+        self.__frame_bytes = elements * size * per
+        self.__stride = _round_up(self.__frame_bytes)
+        self.__frames = frames
+        self.__block = _Block(name, FRAME_OFFSET + self.__stride * frames, shared, True)
+        HEADER.pack_into(self.__block.buf, 0, MAGIC, VERSION, self.__frame_bytes, frames, elements, dtype.encode('ascii'))
+        self.__count = self.__block.buf[COUNT_OFFSET:COUNT_OFFSET + 8].cast('Q')
+        self.__count[0] = 0
+        # Writable views of each frame
+        self.__views = _views(self.__block.buf, elements, dtype, self.__stride, frames, True)
+        self.__raw = self.__block.buf
+        self.written = 0
+
+    def write(self, data):
+        n = self.written
+        data = memoryview(data).cast('B')
+        if len(data) != self.__frame_bytes:
+            raise ValueError('Frame is %d bytes, stream %s takes %d' % (len(data), self.__name, self.__frame_bytes))
+        off = FRAME_OFFSET + (n % self.__frames) * self.__stride
+        self.__raw[off:off + self.__frame_bytes] = data
+        self.__publish(n)
+
+    def claim(self):
+        return self.__views[self.written % self.__frames]
+
+    def publish(self):
+        self.__publish(self.written)
+
+    def close(self):
+        self.__count.release()
+        self.__views = None
+        self.__raw = None
+        self.__block.close(True)
+
+    # ====================================================================
+    # PRIVATE
+
+    def __publish(self, n):
+        self.__count[0] = n + 1
+        self.written = n + 1
+
+class Consumer:
+
+    def __init__(self, name, shared=True):
+        self.__name = name
+        self.__block = _Block(name, 0, shared, False)
+        magic, version, self.__frame_bytes, self.__frames, elements, dtype = HEADER.unpack_from(self.__block.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self.__block.close(False)
+            raise ValueError('%s is not a stream' % name)
+        dtype = dtype.rstrip(b'\x00').decode('ascii')
+        stride = _round_up(self.__frame_bytes)
+        self.__count = self.__block.buf[COUNT_OFFSET:COUNT_OFFSET + 8].cast('Q')
+        self.__views = _views(self.__block.buf, elements, dtype, stride, self.__frames, False)
+        # The next frame to read and the last one read
+        self.__seq = self.__count[0]
+        self.__last = None
+        self.read_count = 0
+        self.lost = 0
+
+    def read(self, timeout=None):
+        count = self.__count[0]
+        if count <= self.__seq:
+            count = self.__wait(timeout)
+            if count == None:
+                return None
+        if count - self.__seq >= self.__frames:
+            # Overtaken, the frame we want may be being written
+            seq = count - self.__frames // 2
+            self.lost += seq - self.__seq
+            self.__seq = seq
+        self.__last = self.__seq
+        self.__seq += 1
+        self.read_count += 1
+        return self.__views[self.__last % self.__frames]
+
+    def intact(self):
+        return self.__last != None and self.__count[0] < self.__last + self.__frames
+
+    def close(self):
+        self.__count.release()
+        self.__views = None
+        self.__block.close(False)
+
+    # ====================================================================
+    # PRIVATE
+
+    # Poll for the next frame, returns the count or None on timeout
+    def __wait(self, timeout):
+        deadline = None if timeout == None else monotonic() + timeout
+        delay = 0.0
+        while True:
+            sleep(delay)
+            count = self.__count[0]
+            if count > self.__seq:
+                return count
+            if deadline != None and monotonic() >= deadline:
+                return None
+            delay = min(POLL_MAX, delay * 2 + 0.00002)
+
+# ====================================================================
+# PRIVATE
+
+# Streams within this process {name: bytearray}
+_local = {}
+
+# The memory of a stream, shared or local
+class _Block:
+
+    def __init__(self, name, size, shared, create):
+        self.__name = name
+        self.__shm = None
+        if shared:
+            if create:
+                self.__shm = shared_memory.SharedMemory(name=PREFIX + name, create=True, size=size)
+            else:
+                self.__shm = shared_memory.SharedMemory(name=PREFIX + name)
+            self.buf = self.__shm.buf
+        else:
+            if create:
+                if name in _local:
+                    raise FileExistsError('Stream %s already exists' % name)
+                _local[name] = bytearray(size)
+            elif name not in _local:
+                raise FileNotFoundError('No stream %s' % name)
+            self.buf = memoryview(_local[name])
+
+    def close(self, remove):
+        self.buf = None
+        if self.__shm != None:
+            try:
+                self.__shm.close()
+            except BufferError:
+                # Frames still held, the mapping goes when they do
+                log.warning("Stream - %s closed with frames still in use", self.__name)
+            if remove:
+                self.__shm.unlink()
+        elif remove:
+            _local.pop(self.__name, None)
+
+def _round_up(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+# A view of each frame of a block
+def _views(buf, elements, dtype, stride, frames, writable):
+    fmt, size, per = DTYPES[dtype]
+    views = []
+    for i in range(frames):
+        off = FRAME_OFFSET + i * stride
+        if np != None:
+            view = np.frombuffer(buf, dtype=dtype, count=elements, offset=off)
+            view.flags.writeable = writable
+        else:
+            view = buf[off:off + elements * size * per].cast(fmt)
+            if not writable:
+                view = view.toreadonly()
+        views.append(view)
+    return views
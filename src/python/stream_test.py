@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# stream_test.py
+#
+# Stream channel tests
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import unittest
+import os
+import array
+import multiprocessing as mp
+
+# Application imports
+from defs import *
+import stream
+
+# ====================================================================
+# Test code
+# Run with 'python stream_test.py'. Frames are 4 int32 values all set to the
+# frame number so a frame read shows which write it came from.
+
+ELEMENTS = 4
+FRAMES = 8
+# Longest to wait for the other process
+WAIT = 5.0
+
+def frame(n):
+    return array.array('i', [n] * ELEMENTS)
+
+# A consumer in another process, puts the first value of each of n frames on the
+# results q as it reads them and then its counts
+def consume(name, n, ready, results):
+    consumer = stream.Consumer(name)
+    ready.set()
+    for i in range(n):
+        f = consumer.read(timeout=WAIT)
+        if f == None:
+            break
+        results.put(int(f[0]))
+        del f
+    results.put([consumer.read_count, consumer.lost])
+    consumer.close()
+
+class Ring(unittest.TestCase):
+
+    def setUp(self):
+        # Unique as shared memory outlives a failed run
+        self.name = 'test_%d_%s' % (os.getpid(), self._testMethodName)
+
+    def producer(self, shared=False, frames=FRAMES):
+        self.p = stream.Producer(self.name, ELEMENTS, 'int32', frames=frames, shared=shared)
+        self.addCleanup(self.p.close)
+        return self.p
+
+    def consumer(self, shared=False):
+        c = stream.Consumer(self.name, shared=shared)
+        self.addCleanup(c.close)
+        return c
+
+    def test_in_order(self):
+        p = self.producer()
+        c = self.consumer()
+        for i in range(3 * FRAMES):
+            p.write(frame(i))
+            f = c.read(timeout=0)
+            self.assertEqual(list(f), [i] * ELEMENTS)
+            self.assertTrue(c.intact())
+        del f
+        self.assertEqual(c.read(timeout=0.01), None)
+        self.assertEqual((p.written, c.read_count, c.lost), (3 * FRAMES, 3 * FRAMES, 0))
+
+    def test_claim_publish(self):
+        p = self.producer()
+        c = self.consumer()
+        f = p.claim()
+        for i in range(ELEMENTS):
+            f[i] = 7
+        self.assertEqual(c.read(timeout=0.01), None)
+        p.publish()
+        self.assertEqual(list(c.read(timeout=0)), [7] * ELEMENTS)
+
+    def test_starts_at_next(self):
+        p = self.producer()
+        p.write(frame(0))
+        c = self.consumer()
+        self.assertEqual(c.read(timeout=0.01), None)
+        p.write(frame(1))
+        self.assertEqual(c.read(timeout=0)[0], 1)
+
+    def test_lapped(self):
+        p = self.producer()
+        slow = self.consumer()
+        fast = self.consumer()
+        for i in range(20):
+            p.write(frame(i))
+            fast.read(timeout=0)
+        # Moved on to half a ring behind, the frames passed over are lost
+        got = []
+        f = slow.read(timeout=0)
+        while f != None:
+            got.append(f[0])
+            f = slow.read(timeout=0.01)
+        self.assertEqual(got, list(range(20 - FRAMES // 2, 20)))
+        self.assertEqual((slow.read_count, slow.lost), (FRAMES // 2, 20 - FRAMES // 2))
+        # The other consumer is not held up or affected
+        self.assertEqual((fast.read_count, fast.lost), (20, 0))
+
+    def test_not_intact(self):
+        p = self.producer(frames=4)
+        c = self.consumer()
+        self.assertFalse(c.intact())
+        p.write(frame(0))
+        f = c.read(timeout=0)
+        p.write(frame(1))
+        p.write(frame(2))
+        self.assertTrue(c.intact())
+        # Once the ring comes round the writer may be filling the slot
+        p.write(frame(3))
+        self.assertFalse(c.intact())
+        g = p.claim()
+        for i in range(ELEMENTS):
+            g[i] = 99
+        self.assertEqual(f[0], 99)
+        self.assertFalse(c.intact())
+        del f, g
+
+    def test_bad_frame(self):
+        p = self.producer()
+        self.assertRaises(ValueError, p.write, array.array('i', [0] * (ELEMENTS + 1)))
+        self.assertRaises(ValueError, stream.Producer, self.name + 'x', ELEMENTS, 'int128', shared=False)
+        self.assertRaises(FileNotFoundError, stream.Consumer, self.name + 'y', shared=False)
+
+    def test_other_process(self):
+        p = self.producer(shared=True)
+        ready = mp.Event()
+        results = mp.Queue()
+        n = 3 * FRAMES
+        proc = mp.Process(target=consume, args=(self.name, n, ready, results))
+        proc.start()
+        self.assertTrue(ready.wait(WAIT))
+        # Half a ring at a time so the consumer is never lapped
+        values = []
+        for i in range(n):
+            p.write(frame(i))
+            if i % (FRAMES // 2) == FRAMES // 2 - 1:
+                while len(values) <= i:
+                    values.append(results.get(timeout=WAIT))
+        self.assertEqual(results.get(timeout=WAIT), [n, 0])
+        proc.join(WAIT)
+        self.assertEqual(proc.exitcode, 0)
+        self.assertEqual(values, list(range(n)))
+
+# Entry point
+if __name__ == '__main__':
+    unittest.main()
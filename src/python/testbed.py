@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# testbed.py
+#
+# A topology of LOCAL processes run inside one test process
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    The tests run real GenServer and PubSub instances so messages take the real routing, envelope
+    and wire format path. Every LOCAL process of the topology is started by GlobalInit and ProcessInit
+    as it would be, but all of them run in the process of the test. Each has its own task registry,
+    router, forwarder and gen-servers and they talk over the queues of their links, so a message to
+    another process is encoded and decoded as it is between real processes.
+
+    PUBLIC INTERFACE:
+
+    Start the topology, local is as the LOCAL section [[process-name, [task-name, ...]], ...] and
+    groups the optional GROUPS section {task-name: policy}. The optional remote processes are
+    [[process-name, [task-name, ...], ip, in-port, out-port, link-options], ...] with the options in
+    configuration form. The optional multicast groups are the MULTICAST section {topic-class: text}.
+    The IMC server is started for either, whatever listens on the out-port or joins the group
+    stands in for the remote machines.
+
+        bed = Testbed( local, groups=None, remote=None, multicast=None )
+
+    The objects returned by ProcessInit.start_of_day() for a process, see framework_mgr.
+
+        params = bed.params( process )
+        gs_inst = bed.gs( process )
+
+    Stop everything.
+
+        bed.close()
+"""
+
+# System imports
+import os
+import io
+import tempfile
+import threading
+import contextlib
+
+# Application imports
+from defs import *
+import framework_mgr
+
+# ====================================================================
+# PUBLIC
+# API
+
+class Testbed:
+
+    def __init__(self, local, groups=None, remote=None, multicast=None):
+        lines = ['[LOCAL]'] + ['%s = %s' % (proc, ','.join(tasks)) for proc, tasks in local]
+        if remote != None:
+            lines += ['[REMOTE]'] + ['%s = %s:%s,%d,%d:%s' % (proc, ','.join(tasks), ip, port_in, port_out, opts)
+                                     for proc, tasks, ip, port_in, port_out, opts in remote]
+        if multicast != None:
+            lines += ['[MULTICAST]'] + ['%s = %s' % (cls, text) for cls, text in multicast.items()]
+        if groups != None:
+            lines += ['[GROUPS]'] + ['%s = %s' % (task, policy) for task, policy in groups.items()]
+        fd, self.__path = tempfile.mkstemp(suffix='.cfg', prefix='testbed')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        # The start up is chatty
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.__global = framework_mgr.GlobalInit(self.__path)
+            r, g = self.__global.start_of_day()
+            if not r:
+                os.remove(self.__path)
+                raise ValueError('Testbed configuration rejected %s' % (lines))
+            self.__procs = {}
+            for i, proc in enumerate(g[LOCAL][1]):
+                qs = g['PARENT'] if i == 0 else g['CHILDREN'][proc[0]]
+                fm = framework_mgr.ProcessInit([LOCAL, proc], g[REMOTE], g['IMC'], qs, g['ROUTES'])
+                self.__procs[proc[0]] = [fm, fm.start_of_day()]
+
+    def params(self, process):
+        return self.__procs[process][1]
+
+    def gs(self, process):
+        return self.__procs[process][1]['GS']
+
+    def close(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for fm, params in self.__procs.values():
+                params['GS'].server_term_all()
+            # Each forwarder takes up to a second to see it is stopped so wait for them together
+            ends = [threading.Thread(target=fm.end_of_day) for fm, params in self.__procs.values()]
+            for t in ends:
+                t.start()
+            for t in ends:
+                t.join()
+            self.__global.end_of_day()
+        os.remove(self.__path)
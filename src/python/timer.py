@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# timer.py
+#
+# Hierarchical timer wheel
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    All the timers of a process run on one thread. A threading.Timer per timeout costs a thread each
+    and a heap costs log n per insert, the wheel costs neither.
+
+    Time is counted in ticks of TICK seconds. The wheel has LEVELS levels of SLOTS slots. Level 0 has
+    a slot for each of the next SLOTS ticks, level 1 a slot for each of the next SLOTS level 0 rotations
+    and so on, which covers about 49 days with the defaults. A timer goes in the lowest level with room
+    for its expiry tick so adding one is a shift, a mask and a set insert and cancelling it is a set
+    remove. Each time level 0 comes round the next slot of the level above is emptied into the levels
+    below. A timer beyond the rotation of the top level waits in an overflow set and is put back each
+    time the top level comes round. The thread sleeps until the next tick at which timers are due or come down from a level
+    above, so an idle wheel costs nothing. When it wakes it jumps over the ticks with nothing to do and
+    an empty wheel is moved on to the present when a timer is added, so a long idle spell does not have
+    to be stepped through.
+
+    A timer fires within one tick of its time, never before it. Repeating timers are put back for the
+    time they were due plus the interval so they do not drift. Repeats missed because the thread was
+    held up are skipped rather than fired in a burst.
+
+    PUBLIC INTERFACE:
+
+    Create a wheel. The thread starts with the first timer. The clock, seconds as a float, is for tests.
+
+        wheel = TimerWheel( clock=monotonic )
+
+    Call callback(*args) on the wheel thread after delay seconds and then every interval seconds if an
+    interval is given. The callback must be quick, typically it sends a message.
+
+        ref = wheel.add( delay, callback, args=(), interval=None )
+
+    Cancel a timer. Returns False if it has already fired and does not repeat or was cancelled.
+
+        wheel.cancel( ref )
+
+    The number of timers waiting.
+
+        n = wheel.pending()
+
+    Stop the thread. Timers still waiting do not fire.
+
+        wheel.stop()
+"""
+
+# System imports
+import threading
+from time import monotonic
+
+# Application imports
+from defs import *
+import log
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Tick in seconds
+TICK = 0.001
+# Wheel size, each level is SLOTS times the span of the one below
+BITS = 8
+SLOTS = 1 << BITS
+MASK = SLOTS - 1
+LEVELS = 4
+# Ticks in a rotation of the top level, timers further ahead overflow
+MAX_TICKS = (1 << (BITS * LEVELS)) - 1
+
+class TimerWheel:
+
+    def __init__(self, clock=monotonic):
+        # [[set(TimerRef), ...], ...] for each level
+        self.__wheels = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+        # Timers beyond the rotation of the top level
+        self.__overflow = set()
+        self.__clock = clock
+        self.__start = clock()
+        # The last tick processed
+        self.__now = 0
+        # The tick the thread will next wake at or None if it waits for a timer
+        self.__wake = None
+        self.__count = 0
+        self.__cv = threading.Condition()
+        self.__thread = None
+        self.__term = False
+
+    def add(self, delay, callback, args=(), interval=None):
+        ref = TimerRef(callback, args, None if interval == None else max(1, round(interval / TICK)))
+        with self.__cv:
+            t = self.__clock()
+            if self.__count == 0:
+                # Nothing to step through so catch up with the present
+                self.__now = max(self.__now, self.__tick_at(t))
+            # The tick in progress may be part gone so never fire early
+            expiry = self.__tick_at(t + delay) + 1
+            ref.expiry = max(expiry, self.__now + 1)
+            self.__insert(ref)
+            self.__count += 1
+            if self.__thread == None:
+                self.__term = False
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+            elif self.__wake == None or ref.expiry < self.__wake or self.__tick_at(t) >= self.__wake:
+                # Sooner than the thread would wake or it is already late
+                self.__cv.notify()
+        return ref
+
+    def cancel(self, ref):
+        with self.__cv:
+            if ref.slot == None:
+                return False
+            ref.slot.discard(ref)
+            ref.slot = None
+            self.__count -= 1
+            return True
+
+    def pending(self):
+        return self.__count
+
+    def stop(self):
+        with self.__cv:
+            thread = self.__thread
+            self.__thread = None
+            self.__term = True
+            self.__cv.notify()
+        if thread != None:
+            thread.join()
+
+    # ====================================================================
+    # PRIVATE
+
+    def __tick_at(self, t):
+        return int((t - self.__start) / TICK)
+
+    # Put a timer in the lowest level which has room for it
+    def __insert(self, ref):
+        expiry = max(ref.expiry, self.__now)
+        if (expiry >> (BITS * LEVELS)) != (self.__now >> (BITS * LEVELS)):
+            # Not in this rotation of the top level
+            slot = self.__overflow
+        else:
+            level = 0
+            while level < LEVELS - 1 and (expiry >> (BITS * (level + 1))) != (self.__now >> (BITS * (level + 1))):
+                level += 1
+            slot = self.__wheels[level][(expiry >> (BITS * level)) & MASK]
+        slot.add(ref)
+        ref.slot = slot
+
+    # Move on one tick and return the timers which are due
+    def __tick(self):
+        self.__now += 1
+        now = self.__now
+        # At the end of a rotation bring down the timers of the next slot of each level above
+        top = 1
+        while top < LEVELS and (now & ((1 << (BITS * top)) - 1)) == 0:
+            top += 1
+        if (now & MAX_TICKS) == 0:
+            # The top level has come round, those now in range go in before it is emptied down
+            refs = list(self.__overflow)
+            self.__overflow.clear()
+            for ref in refs:
+                self.__insert(ref)
+        for level in range(top - 1, 0, -1):
+            slot = self.__wheels[level][(now >> (BITS * level)) & MASK]
+            refs = list(slot)
+            slot.clear()
+            for ref in refs:
+                self.__insert(ref)
+        slot = self.__wheels[0][now & MASK]
+        due = list(slot)
+        slot.clear()
+        for ref in due:
+            if ref.interval != None:
+                # Repeats missed while we were held up are skipped
+                ref.expiry = max(ref.expiry + ref.interval, now + 1)
+                self.__insert(ref)
+            else:
+                ref.slot = None
+                self.__count -= 1
+        return due
+
+    # The next tick at which timers are due or come down from a level above
+    # Any slot occupied in the rest of a level's rotation comes before those of the level above
+    def __next_wake(self):
+        if self.__count == 0:
+            return None
+        for level in range(LEVELS):
+            shift = BITS * level
+            wheel = self.__wheels[level]
+            pos = (self.__now >> shift) & MASK
+            for n in range(1, SLOTS - pos):
+                if len(wheel[pos + n]) > 0:
+                    return ((self.__now >> shift) + n) << shift
+        return ((self.__now >> (BITS * LEVELS)) + 1) << (BITS * LEVELS)
+
+    def __run(self):
+        while True:
+            due = []
+            with self.__cv:
+                if self.__term:
+                    return
+                target = self.__tick_at(self.__clock())
+                while self.__now < target:
+                    # Jump to the next tick with something to do
+                    wake = self.__next_wake()
+                    if wake == None or wake > target:
+                        self.__now = target
+                    else:
+                        self.__now = wake - 1
+                        due.extend(self.__tick())
+                if len(due) == 0:
+                    self.__wake = self.__next_wake()
+                    if self.__wake == None:
+                        self.__cv.wait()
+                    else:
+                        self.__cv.wait(max(0.0, self.__start + self.__wake * TICK - self.__clock()))
+                    self.__wake = None
+            for ref in due:
+                try:
+                    ref.callback(*ref.args)
+                except Exception as err:
+                    log.error("TimerWheel - timer callback failed, %s", err)
+
+# A waiting timer
+class TimerRef:
+
+    __slots__ = ('callback', 'args', 'interval', 'expiry', 'slot')
+
+    def __init__(self, callback, args, interval):
+        self.callback = callback
+        self.args = args
+        # Ticks between repeats or None for once only
+        self.interval = interval
+        self.expiry = 0
+        # The wheel slot the timer is in or None if it is not waiting
+        self.slot = None
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# timer_test.py
+#
+# Timer wheel tests
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import unittest
+import threading
+from time import monotonic, sleep
+
+# Application imports
+from defs import *
+import timer
+
+# ====================================================================
+# Test code
+# Run with 'python timer_test.py'. A Clock which can be moved on stands in
+# for hours of idle time or for timers far enough ahead to be in the upper levels.
+
+# Longest to wait for a timer which is due
+WAIT = 2.0
+
+# The real clock plus an offset
+class Clock:
+
+    def __init__(self):
+        self.offset = 0.0
+
+    def __call__(self):
+        return monotonic() + self.offset
+
+    def advance(self, seconds):
+        self.offset += seconds
+
+class Wheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = timer.TimerWheel(self.clock)
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    # Move the clock on, the wheel thread waits on the real clock so a timer
+    # due at once is added to wake it
+    def move(self, seconds):
+        self.clock.advance(seconds)
+        self.wheel.add(0.0, lambda: None)
+
+    # Add a timer which records the clock when it fires
+    def add(self, delay, interval=None):
+        fired = []
+        event = threading.Event()
+        def callback():
+            fired.append(self.clock())
+            event.set()
+        ref = self.wheel.add(delay, callback, interval=interval)
+        return ref, fired, event
+
+    def test_fires(self):
+        t = self.clock()
+        _, fired, event = self.add(0.02)
+        self.assertTrue(event.wait(WAIT))
+        self.assertGreaterEqual(fired[0], t + 0.02)
+        self.assertEqual(self.wheel.pending(), 0)
+
+    def test_fires_after_idle(self):
+        _, _, event = self.add(0.001)
+        self.assertTrue(event.wait(WAIT))
+        for idle in [1200.0, 86400.0]:
+            self.clock.advance(idle)
+            start = monotonic()
+            _, fired, event = self.add(0.01)
+            self.assertLess(monotonic() - start, 0.05)
+            self.assertTrue(event.wait(WAIT))
+            # Late by no more than scheduling, not by the idle time
+            self.assertLess(monotonic() - start, 0.2)
+
+    def test_cascade(self):
+        # In level 1, 2 and 3 with 1 ms ticks and 256 slots
+        delays = [2.0, 100.0, 20000.0]
+        t = self.clock()
+        timers = [self.add(delay) for delay in delays]
+        for delay, (_, fired, event) in zip(delays, timers):
+            # Move on to short of the delay and then past it
+            self.move(t + delay - 1.0 - self.clock())
+            sleep(0.3)
+            self.assertEqual(fired, [])
+            self.move(1.0)
+            self.assertTrue(event.wait(WAIT), delay)
+            self.assertGreaterEqual(fired[0], t + delay)
+        sleep(0.1)
+        self.assertEqual(self.wheel.pending(), 0)
+
+    def test_beyond_range(self):
+        # Past the rotation of the top level, this one and the one after
+        span = timer.MAX_TICKS * timer.TICK
+        delays = [span + 500.0, 2.5 * span]
+        t = self.clock()
+        timers = [self.add(delay) for delay in delays]
+        cancelled, cancelled_fired, _ = self.add(span + 100.0)
+        self.assertTrue(self.wheel.cancel(cancelled))
+        for delay, (_, fired, event) in zip(delays, timers):
+            # Past where the wheel would run out and then short of the delay
+            for at in [t + span + 10.0, t + delay - 1.0]:
+                self.move(at - self.clock())
+                sleep(0.3)
+                self.assertEqual(fired, [])
+            self.move(1.0)
+            self.assertTrue(event.wait(WAIT), delay)
+            self.assertGreaterEqual(fired[0], t + delay)
+        sleep(0.1)
+        self.assertEqual(cancelled_fired, [])
+        self.assertEqual(self.wheel.pending(), 0)
+
+    def test_interval_and_cancel(self):
+        ref, fired, event = self.add(0.01, interval=0.01)
+        other, other_fired, _ = self.add(0.05)
+        self.assertTrue(self.wheel.cancel(other))
+        self.assertFalse(self.wheel.cancel(other))
+        sleep(0.2)
+        self.assertTrue(self.wheel.cancel(ref))
+        n = len(fired)
+        self.assertGreater(n, 3)
+        sleep(0.1)
+        self.assertEqual(len(fired), n)
+        self.assertEqual(other_fired, [])
+        self.assertEqual(self.wheel.pending(), 0)
+
+# Entry point
+if __name__ == '__main__':
+    unittest.main()
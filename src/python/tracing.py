@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# tracing.py
+#
+# Sampled end-to-end message tracing
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Tracing is opt-in and sampled. When a process is started with a trace rate of N then one
+    in every N messages sent with gen_server_msg() carries a trace header. The header travels
+    with the message in the trace field of its envelope (see envelope) across threads,
+    processes and the IMC link. Each hop stamps the header and the gen-server which finally
+    dispatches the message completes the trace into the local collector of that process.
+
+    A trace header is
+        [trace-id, [(hop, host, monotonic-ns, wall-ns), ...]]
+    The delay between two hops on the same host uses the monotonic clock. Between hosts the
+    monotonic clocks are unrelated so the wall clock is used and the accuracy depends on how
+    well the machines are synchronised.
+
+    Hops are:
+        send        - gen_server_msg()
+        fwd         - picked up by the forwarder in the destination process
+        imc.send    - picked up by the IMC server for sending
+        imc.recv    - received by the remote IMC server
+        imc.disp    - picked up by the IMC dispatcher in the destination process
+        get         - retrieved by gen_server_msg_get()
+        dispatch    - about to be dispatched by the gen-server
+        done        - dispatcher returned
+
+    PUBLIC INTERFACE:
+
+    Create a tracer sampling one in 'every' messages. The framework manager does this when
+    ProcessInit is given a trace rate and returns the tracer as 'TRACE'.
+
+        tracer = Tracer( every )
+
+    Report per-hop latency in nanoseconds over all completed traces.
+
+        {'hop->hop': {'count', 'mean', ... }, ..., 'total': {...}} = tracer.report()
+
+    Clear the collector.
+
+        tracer.reset()
+"""
+
+# System imports
+import os
+import socket
+import zlib
+import threading
+from time import monotonic_ns, time_ns
+
+# Application imports
+import metrics as mt
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Compact host identifier stamped on each hop
+HOST = zlib.crc32(socket.gethostname().encode()) & 0xffff
+
+# Add a hop to a trace header
+def stamp(trace, hop):
+    trace[1].append((hop, HOST, monotonic_ns(), time_ns()))
+
+class Tracer:
+
+    def __init__(self, every):
+        self.__every = every
+        self.__n = 0
+        self.__id = os.getpid() << 32
+        # Collected latencies {hop->hop: Histogram}
+        self.__hops = {}
+        self.__lock = threading.Lock()
+
+    # Start a trace if this message is sampled else return None
+    def start(self):
+        self.__n += 1
+        if self.__n % self.__every != 0:
+            return None
+        trace = [self.__id + self.__n, []]
+        stamp(trace, 'send')
+        return trace
+
+    # Add the final stamp and collect the trace
+    def complete(self, trace, hop='done'):
+        stamp(trace, hop)
+        stamps = trace[1]
+        with self.__lock:
+            for a, b in zip(stamps, stamps[1:]):
+                self.__record('%s->%s' % (a[0], b[0]), delta(a, b))
+            self.__record('total', delta(stamps[0], stamps[-1]))
+
+    def report(self):
+        with self.__lock:
+            return {k: h.snapshot() for k, h in self.__hops.items()}
+
+    def reset(self):
+        with self.__lock:
+            self.__hops = {}
+
+    # ====================================================================
+    # PRIVATE
+
+    def __record(self, key, value):
+        h = self.__hops.get(key)
+        if h == None:
+            h = mt.Histogram()
+            self.__hops[key] = h
+        h.record(value)
+
+# Time between two stamps
+def delta(a, b):
+    if a[1] == b[1]:
+        return b[2] - a[2]
+    return b[3] - a[3]
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# wire.py
+#
+# Language neutral encoding of message payloads
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Pickle can only be read by Python. The wire format is a small typed encoding which the Julia and Go
+    gen-servers can read and write so a task can move to one of them and stay in the same topology.
+    There is no schema, each value carries a one byte type tag. All numbers are big-endian.
+
+        tag   type      follows
+        0x00  nil
+        0x01  false
+        0x02  true
+        0x03  int       int8
+        0x04  int       int16
+        0x05  int       int32
+        0x06  int       int64
+        0x07  float     float64
+        0x08  string    length uint32, UTF-8 bytes
+        0x09  bytes     length uint32, bytes
+        0x0a  list      count uint32, count values
+        0x0b  map       count uint32, count key and value pairs, keys are not lists or maps
+
+    An integer is written in the smallest of the four sizes which holds it. Tuples are written as lists
+    and come back as lists. Anything else, including integers outside int64, raises WireError.
+
+    On a link with the wire option the body of each envelope, see envelope, is in this format rather than
+    pickled and the WIRE flag is set in the envelope header. The envelope header is already fixed binary
+    so a whole message can be read without Python. A peer in another language:
+        - sends a request by putting its task name in the sender field and a non-zero request id in the
+          corr field of the header and giving the payload as [sender, data]
+        - answers a request with the payload [REPLY, corr, response] and the corr of the request
+        - ignores envelopes without the WIRE flag, they come from Python peers on other links
+    The messages in a BATCH envelope have no header of their own so a request id only survives the
+    wire format in a message sent on its own, as gen_server_request() and gen_server_response() do.
+
+    PUBLIC INTERFACE:
+
+    Encode and decode a value.
+
+        data = dumps( value )
+        value = loads( data )
+"""
+
+# System imports
+import struct
+
+# Application imports
+from defs import *
+
+# ====================================================================
+# PUBLIC
+# API
+
+# Type tags
+NIL = 0x00
+FALSE = 0x01
+TRUE = 0x02
+INT8 = 0x03
+INT16 = 0x04
+INT32 = 0x05
+INT64 = 0x06
+FLOAT64 = 0x07
+STRING = 0x08
+BYTES = 0x09
+LIST = 0x0a
+MAP = 0x0b
+
+class WireError(ValueError):
+    pass
+
+def dumps(value):
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+def loads(data):
+    value, off = _decode(memoryview(data), 0)
+    if off != len(data):
+        raise WireError('%d bytes left over' % (len(data) - off))
+    return value
+
+# ====================================================================
+# PRIVATE
+
+_B = struct.Struct('!Bb')
+_H = struct.Struct('!Bh')
+_I = struct.Struct('!Bi')
+_Q = struct.Struct('!Bq')
+_D = struct.Struct('!Bd')
+_L = struct.Struct('!BI')
+_b = struct.Struct('!b')
+_h = struct.Struct('!h')
+_i = struct.Struct('!i')
+_q = struct.Struct('!q')
+_d = struct.Struct('!d')
+_u = struct.Struct('!I')
+
+# Types which may be map keys
+_KEYS = (str, int, float, bool, bytes, type(None))
+
+def _encode(v, out):
+    t = type(v)
+    if t is str:
+        b = v.encode('utf-8')
+        out += _L.pack(STRING, len(b))
+        out += b
+    elif t is int:
+        if -0x80 <= v < 0x80:
+            out += _B.pack(INT8, v)
+        elif -0x8000 <= v < 0x8000:
+            out += _H.pack(INT16, v)
+        elif -0x80000000 <= v < 0x80000000:
+            out += _I.pack(INT32, v)
+        elif -0x8000000000000000 <= v < 0x8000000000000000:
+            out += _Q.pack(INT64, v)
+        else:
+            raise WireError('integer %d does not fit int64' % v)
+    elif t is list or t is tuple:
+        out += _L.pack(LIST, len(v))
+        for item in v:
+            _encode(item, out)
+    elif v is None:
+        out.append(NIL)
+    elif t is bool:
+        out.append(TRUE if v else FALSE)
+    elif t is float:
+        out += _D.pack(FLOAT64, v)
+    elif t is dict:
+        out += _L.pack(MAP, len(v))
+        for key, item in v.items():
+            if not isinstance(key, _KEYS):
+                raise WireError('map key %r is not a scalar' % (key,))
+            _encode(key, out)
+            _encode(item, out)
+    elif t is bytes or t is bytearray:
+        out += _L.pack(BYTES, len(v))
+        out += v
+    # Subclasses such as the gen-server request types go as their base type
+    elif isinstance(v, str):
+        _encode(str(v), out)
+    elif isinstance(v, bool):
+        _encode(bool(v), out)
+    elif isinstance(v, int):
+        _encode(int(v), out)
+    elif isinstance(v, float):
+        _encode(float(v), out)
+    elif isinstance(v, (list, tuple)):
+        _encode(list(v), out)
+    elif isinstance(v, dict):
+        _encode(dict(v), out)
+    else:
+        raise WireError('cannot encode %s' % t.__name__)
+
+def _decode(data, off):
+    try:
+        tag = data[off]
+        off += 1
+        if tag == STRING:
+            n = _u.unpack_from(data, off)[0]
+            off += 4
+            end = off + n
+            if end > len(data):
+                raise WireError('string runs past the end')
+            return str(data[off:end], 'utf-8'), end
+        elif tag == INT8:
+            return _b.unpack_from(data, off)[0], off + 1
+        elif tag == INT16:
+            return _h.unpack_from(data, off)[0], off + 2
+        elif tag == INT32:
+            return _i.unpack_from(data, off)[0], off + 4
+        elif tag == INT64:
+            return _q.unpack_from(data, off)[0], off + 8
+        elif tag == LIST:
+            n = _u.unpack_from(data, off)[0]
+            off += 4
+            items = []
+            for _ in range(n):
+                item, off = _decode(data, off)
+                items.append(item)
+            return items, off
+        elif tag == NIL:
+            return None, off
+        elif tag == FALSE:
+            return False, off
+        elif tag == TRUE:
+            return True, off
+        elif tag == FLOAT64:
+            return _d.unpack_from(data, off)[0], off + 8
+        elif tag == MAP:
+            n = _u.unpack_from(data, off)[0]
+            off += 4
+            items = {}
+            for _ in range(n):
+                key, off = _decode(data, off)
+                if type(key) is list or type(key) is dict:
+                    raise WireError('map key is not a scalar')
+                items[key], off = _decode(data, off)
+            return items, off
+        elif tag == BYTES:
+            n = _u.unpack_from(data, off)[0]
+            off += 4
+            end = off + n
+            if end > len(data):
+                raise WireError('bytes run past the end')
+            return bytes(data[off:end]), end
+        else:
+            raise WireError('unknown tag 0x%02x at %d' % (tag, off - 1))
+    except (IndexError, struct.error):
+        raise WireError('truncated at %d' % off)
+    except UnicodeDecodeError as err:
+        raise WireError('bad string, %s' % err)
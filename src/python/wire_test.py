@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# wire_test.py
+#
+# Wire format tests
+#
+# Copyright (C) 2021 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import unittest
+import pickle
+import math
+from time import perf_counter
+
+# Application imports
+from defs import *
+import wire
+import envelope
+from envelope import Envelope
+import gen_server as gs
+
+# ====================================================================
+# Test code
+# Run with 'python wire_test.py'. The throughput figures are printed for
+# comparison with pickle, only a very low floor is asserted.
+
+# A typical message, a request with a small record
+MESSAGE = ['CLIENT', ['SET', 7, {'freq': 14.074, 'mode': 'FT8', 'gain': -12, 'on': True}, [1, 2, 3]]]
+THROUGHPUT_N = 20000
+
+class RoundTrip(unittest.TestCase):
+
+    def check(self, value, expect=None):
+        self.assertEqual(wire.loads(wire.dumps(value)), value if expect == None else expect)
+
+    def test_scalars(self):
+        for v in [None, True, False, 0, 1, -1, 3.5, -0.0, 1e300, '', 'abc', 'ünïcødé ✓', b'', b'\x00\xff']:
+            self.check(v)
+        self.assertTrue(math.isnan(wire.loads(wire.dumps(float('nan')))))
+        self.assertEqual(wire.loads(wire.dumps(float('inf'))), float('inf'))
+
+    def test_int_sizes(self):
+        for v, size in [(127, 2), (-128, 2), (128, 3), (-32768, 3), (32768, 5), (2**31 - 1, 5), (-2**31, 5),
+                        (2**31, 9), (2**63 - 1, 9), (-2**63, 9)]:
+            data = wire.dumps(v)
+            self.assertEqual(len(data), size, v)
+            self.assertEqual(wire.loads(data), v)
+
+    def test_containers(self):
+        self.check([])
+        self.check({})
+        self.check([1, 'a', [2, [3, [None]]], {'k': [b'v', 1.5]}])
+        self.check({1: 'one', 'two': 2, None: [], 2.5: {}, b'k': True, False: 0})
+        # Tuples come back as lists
+        self.check((1, (2, 3)), [1, [2, 3]])
+
+    def test_subclasses(self):
+        # The gen-server request types go as plain lists and strings
+        self.check(gs.Reply([REPLY, 3, 'ok']), [REPLY, 3, 'ok'])
+        self.check([gs.ReplyTo('A', 9), 'x'], ['A', 'x'])
+
+    def test_bytes(self):
+        # Fixed encodings other implementations must agree with
+        self.assertEqual(wire.dumps(None), b'\x00')
+        self.assertEqual(wire.dumps([True, False]), b'\x0a\x00\x00\x00\x02\x02\x01')
+        self.assertEqual(wire.dumps(-2), b'\x03\xfe')
+        self.assertEqual(wire.dumps(300), b'\x04\x01\x2c')
+        self.assertEqual(wire.dumps(1.0), b'\x07\x3f\xf0\x00\x00\x00\x00\x00\x00')
+        self.assertEqual(wire.dumps('hi'), b'\x08\x00\x00\x00\x02hi')
+        self.assertEqual(wire.dumps(b'\x01'), b'\x09\x00\x00\x00\x01\x01')
+        self.assertEqual(wire.dumps({'a': 1}), b'\x0b\x00\x00\x00\x01\x08\x00\x00\x00\x01a\x03\x01')
+
+    def test_errors(self):
+        for v in [2**63, -2**63 - 1, object(), {(1, 2): 'tuple key'}, {1, 2}]:
+            with self.assertRaises(wire.WireError):
+                wire.dumps(v)
+        data = wire.dumps(MESSAGE)
+        for n in range(len(data)):
+            with self.assertRaises(wire.WireError):
+                wire.loads(data[:n])
+        with self.assertRaises(wire.WireError):
+            wire.loads(data + b'\x00')
+        with self.assertRaises(wire.WireError):
+            wire.loads(b'\x7f')
+        with self.assertRaises(wire.WireError):
+            wire.loads(b'\x08\x00\x00\x00\x02\xff\xfe')
+        with self.assertRaises(wire.WireError):
+            wire.loads(b'\x0b\x00\x00\x00\x01\x0a\x00\x00\x00\x00\x00')
+
+class Envelopes(unittest.TestCase):
+
+    def test_round_trip(self):
+        env = Envelope('TASK', MESSAGE, sender='CLIENT', corr=42, priority=envelope.URGENT)
+        data = env.encode(wire=True)
+        self.assertTrue(envelope.is_wire(data))
+        self.assertFalse(envelope.is_wire(env.encode()))
+        self.assertEqual(envelope.peek(data), 'TASK')
+        out = envelope.decode(envelope.retarget(data, 'TASK@P'))
+        self.assertEqual((out.dest, out.sender, out.corr, out.priority, out.sent, out.payload),
+                         ('TASK@P', 'CLIENT', 42, envelope.URGENT, env.sent, MESSAGE))
+
+    def test_traced(self):
+        trace = [7, [['send', 1, 2, 3]]]
+        data = Envelope('TASK', ['x'], trace=trace).encode(wire=True)
+        self.assertTrue(envelope.traced(data))
+        out = envelope.decode(data)
+        self.assertEqual((out.payload, out.trace), (['x'], trace))
+
+    def test_batch(self):
+        batch = [['A', ['one']], ['B', [1, 2]]]
+        out = envelope.decode(Envelope(BATCH, batch).encode(wire=True))
+        self.assertEqual((out.dest, out.payload), (BATCH, batch))
+
+class Throughput(unittest.TestCase):
+
+    def rate(self, encode, decode):
+        n = THROUGHPUT_N
+        t = perf_counter()
+        for _ in range(n):
+            data = encode(MESSAGE)
+        t_enc = perf_counter() - t
+        t = perf_counter()
+        for _ in range(n):
+            decode(data)
+        t_dec = perf_counter() - t
+        return n / t_enc, n / t_dec, len(data)
+
+    def test_throughput(self):
+        enc, dec, size = self.rate(wire.dumps, wire.loads)
+        p_enc, p_dec, p_size = self.rate(lambda m: pickle.dumps(m, pickle.HIGHEST_PROTOCOL), pickle.loads)
+        print('\nwire   encode %8.0f/s decode %8.0f/s %d bytes' % (enc, dec, size))
+        print('pickle encode %8.0f/s decode %8.0f/s %d bytes' % (p_enc, p_dec, p_size))
+        self.assertGreater(enc, 1000)
+        self.assertGreater(dec, 1000)
+
+    def test_envelope_throughput(self):
+        env = Envelope('TASK', MESSAGE, sender='CLIENT', corr=1)
+        enc, dec, size = self.rate(lambda m: env.encode(wire=True), envelope.decode)
+        print('\nwire envelope encode %8.0f/s decode %8.0f/s %d bytes' % (enc, dec, size))
+        self.assertGreater(enc, 1000)
+        self.assertGreater(dec, 1000)
+
+# Entry point
+if __name__ == '__main__':
+    unittest.main()